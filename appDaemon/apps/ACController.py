@@ -1,441 +1,810 @@
-import appdaemon.plugins.hass.hassapi as hass
-from datetime import datetime, timedelta
-import time
-
-
-#
-# AC Controller app
-#
-# Args:
-#
-
-class ACController(hass.Hass):
-  target_room_min_temperature = 18    # Minimum room temperature, always turn on AC even during high prices if we go under this
-  target_room_temperature     = 23    # Ideal room temperature, try to reach this target under ideal pricing circumstances
-  target_room_max_temperature = 24    # Maximum allowed room temperature, do not try to collect more heat even if price is low
-
-  min_mean_price_multiplier = 0.5     # If the current price is lower than this mean multiplier, recommend running AC fulltime
-  max_mean_price_multiplier = 1.5     # If the current price is higher than this mean multiplier, recommend shutting down AC
-
-  min_absolute_price        = 5.0     # If the current price is lower than this absolute price, recommend running AC fulltime
-  max_absolute_price        = 30.0    # If the current price is higher than this absolute price, recommend shutting down AC
-
-  min_state_change_time         = 1800      # Amount of seconds before another state change is allowed to reduce oscillating behavior
-  ignore_change_time_temp_diff  = 2         # We ignore the waiting time between state changes if the temp diff between current room temp
-                                            # and target temp is too large
-                                            # This can happens when the price changes radically from one hour to the next
-
-  state_update_timer            = 5        # How many seconds between two state updates
-
-  manual_override_end_time      = datetime.now()  # Defines when manual override will stop
-  #manual_override_target_temp   = 23              # What temperature to set when manual override is active
-
-  # Updated in EnergyCalculations.py
-  absolute_electricity_price_c_kWh_id = "sensor.electricity_price"
-  electricity_price_mean_c_kWh_id = "sensor.electricity_price_mean_c_kWh"
-
-  entity_id_climate_control = "climate.153931628243065_climate"
-  entity_id_weather_forecast = "weather.forecast_home"
-  entity_id_room_temperature = "sensor.climate_living_room_temperature"
-
-
-  target_room_min_temperature_id = "input_number.target_room_min_temperature"
-  target_room_temperature_id = "input_number.target_room_temperature"
-  target_room_max_temperature_id = "input_number.target_room_max_temperature"
-  
-  min_mean_price_multiplier_id = "input_number.min_mean_price_multiplier"
-  max_mean_price_multiplier_id = "input_number.max_mean_price_multiplier"
-  
-  min_absolute_price_id = "input_number.min_absolute_price"
-  max_absolute_price_id = "input_number.max_absolute_price"
-  
-  min_state_change_time_id = "input_number.min_state_change_time"
-  ignore_change_time_temp_diff_id = "input_number.ignore_change_time_temp_diff"
-
-  manual_override_set_id = "input_boolean.manual_override_set"
-
-
-  # TODO: AC energy multiplier curve based on outside and inside temp difference. AC is more effective during hours when outside temp
-  #       is higher, which can be used to make a better price estimation when we move from pure electricity pricing calculation to
-  #       heat generation calculation for multiple heat sources (AC, direct electricity heating element, wood furnace, gas, ...)
-  #       It also makes sense to calculate like this with only using AC, as it makes a real price difference depending on how
-  #       effective the AC is during certain hours
-
-
-
-  # Working variables
-  last_state_change_time = 0
-
-
-  def initialize(self):
-    # Define all variables inside the instance of this class
-    self.last_state_change_time = datetime.now() - timedelta(seconds=self.min_state_change_time+1)
-    self.initialize_all_parameters()
-    self.update_internal_parameters()
-
-    # Calculate the next time to run the function, 1 second past the next full minute
-    now = datetime.now()
-    next_minute = now + timedelta(minutes=1)
-    start_time = next_minute.replace(second=2, microsecond=0)
-
-    # Schedule the function to run every state_update_timer seconds
-    # self.run_every(self.control_climate, "now", self.state_update_timer)
-    self.run_minutely(self.control_climate, start=start_time)
-    
-
-  def create_input_date(self, entity_id, name):
-    # Check if the entity already exists
-    entity_state = self.get_state(entity_id)
-    # entity_state = None
-    
-    if entity_state is None:
-      # Entity doesn't exist, so create it with the initial value
-      self.log(f"Creating {entity_id} with initial value")
-      now = datetime.now()
-      self.set_state(entity_id, state="", attributes={
-          "year": now.year,
-          "month": now.month,
-          "day": now.day,
-          "hour": now.hour,
-          "second": now.second,
-          "friendly_name": name
-      })
-
-  def create_numeric_entity(self, entity_id, name, initial_value, unit_of_measurement):
-      # Check if the entity already exists
-      entity_state = self.get_state(entity_id)
-      
-      if entity_state is None:
-          # Entity doesn't exist, so create it with the initial value
-          self.log(f"Creating {entity_id} with initial value {initial_value}")
-          self.set_state(entity_id, state=initial_value, attributes={
-              "unit_of_measurement": unit_of_measurement,
-              "friendly_name": name
-          })
-
-  def create_input_number(self, entity_id, name, initial, min_value, max_value, step):
-    # Check if the entity already exists
-    entity_state = self.get_state(entity_id)
-    # entity_state = None
-    
-    if entity_state is None:
-      # Entity doesn't exist, so create it with the initial value
-      self.log(f"Creating {entity_id} with initial value {initial}")
-      self.set_state(entity_id, state=initial, attributes={
-          "min": min_value,
-          "max": max_value,
-          "step": step,
-          "mode": "slider",
-          #"mode": "slider-entity-row",
-          "friendly_name": name
-      })
-    #else:
-      # Entity exists, don't overwrite it
-      #self.log(f"{entity_id} already exists with value {entity_state}")
-
-  def create_input_boolean(self, entity_id, name, initial_state):
-    # Check if the entity already exists
-    entity_state = self.get_state(entity_id)
-
-    if entity_state is None:
-      # Entity doesn't exist, so create it with the initial state
-      self.log(f"Creating {entity_id} with initial state {initial_state}")
-      self.set_state(entity_id, state=initial_state, attributes={"friendly_name": name})
-
-
-  def initialize_all_parameters(self):
-    # Dynamically create or set default values for input_number entities only if they don't exist
-    # self.log(f"Update all parameters")
-    self.create_input_number(self.target_room_min_temperature_id, "Min Room Temperature", 18, 10, 30, 0.5)
-    self.create_input_number(self.target_room_temperature_id, "Target Room Temperature", 23, 10, 30, 0.5)
-    self.create_input_number(self.target_room_max_temperature_id, "Max Room Temperature", 24, 10, 30, 0.5)
-    
-    self.create_input_number(self.min_mean_price_multiplier_id, "Min Mean Price Multiplier", 0.5, 0.1, 2.0, 0.1)
-    self.create_input_number(self.max_mean_price_multiplier_id, "Max Mean Price Multiplier", 1.5, 0.1, 2.0, 0.1)
-    
-    self.create_input_number(self.min_absolute_price_id, "Min Absolute Price", 5.0, 0.0, 100.0, 0.5)
-    self.create_input_number(self.max_absolute_price_id, "Max Absolute Price", 30.0, 0.0, 100.0, 0.5)
-    
-    self.create_input_number(self.min_state_change_time_id, "Min State Change Time (sec)", 1800, 0, 3600, 60)
-    self.create_input_number(self.ignore_change_time_temp_diff_id, "Temp Diff to Ignore Time", 2, 0, 10, 0.5)
-
-    self.create_input_boolean(self.manual_override_set_id, "AC manual override set", "off")
-
-    # self.create_input_date(self.manual_override_end_time_id, "Manual control end time")
-
-    # manual_override_end_time
-    #manual_override_target_temp   
-
-    self.listen_event(self.change_state, event = "call_service")
-
-    # Set up state listeners (callbacks) for when these values change
-    self.listen_state(self.input_number_changed, self.target_room_min_temperature_id)
-    self.listen_state(self.input_number_changed, self.target_room_temperature_id)
-    self.listen_state(self.input_number_changed, self.target_room_max_temperature_id)
-    
-    self.listen_state(self.input_number_changed, self.min_mean_price_multiplier_id)
-    self.listen_state(self.input_number_changed, self.max_mean_price_multiplier_id)
-    
-    self.listen_state(self.input_number_changed, self.min_absolute_price_id)
-    self.listen_state(self.input_number_changed, self.max_absolute_price_id)
-    
-    self.listen_state(self.input_number_changed, self.min_state_change_time_id)
-    self.listen_state(self.input_number_changed, self.ignore_change_time_temp_diff_id)
-
-    self.listen_state(self.input_boolean_changed, self.manual_override_set_id)
-
-    # self.listen_state(self.input_datetime_changed, self.manual_override_end_time_id)
-
-
-  def update_internal_parameters(self):
-    # Update our local properties for ease of use
-    self.target_room_min_temperature = float(self.get_state(self.target_room_min_temperature_id))
-    self.target_room_temperature = float(self.get_state(self.target_room_temperature_id))
-    self.target_room_max_temperature = float(self.get_state(self.target_room_max_temperature_id))
-
-    self.min_mean_price_multiplier = float(self.get_state(self.min_mean_price_multiplier_id))
-    self.max_mean_price_multiplier = float(self.get_state(self.max_mean_price_multiplier_id))
-
-    self.min_absolute_price = float(self.get_state(self.min_absolute_price_id))
-    self.max_absolute_price = float(self.get_state(self.max_absolute_price_id))
-
-    self.min_state_change_time = int(self.get_state(self.min_state_change_time_id))
-    self.ignore_change_time_temp_diff = float(self.get_state(self.ignore_change_time_temp_diff_id))
-
-
-  def change_state(self,event_name,data, kwargs):
-    entity_id = data["service_data"]["entity_id"]
-    new_value = data["service_data"].get("value")
-
-    # self.log(data)
-    
-    if entity_id == self.target_room_min_temperature_id:
-        self.set_state(self.target_room_min_temperature_id, state=new_value)
-        
-    elif entity_id == self.target_room_temperature_id:
-        self.set_state(self.target_room_temperature_id, state=new_value)
-        
-    elif entity_id == self.target_room_max_temperature_id:
-        self.set_state(self.target_room_max_temperature_id, state=new_value)
-        
-    elif entity_id == self.min_mean_price_multiplier_id:
-        self.set_state(self.min_mean_price_multiplier_id, state=new_value)
-        
-    elif entity_id == self.max_mean_price_multiplier_id:
-        self.set_state(self.max_mean_price_multiplier_id, state=new_value)
-        
-    elif entity_id == self.min_absolute_price_id:
-        self.set_state(self.min_absolute_price_id, state=new_value)
-        
-    elif entity_id == self.max_absolute_price_id:
-        self.set_state(self.max_absolute_price_id, state=new_value)
-        
-    elif entity_id == self.min_state_change_time_id:
-        self.set_state(self.min_state_change_time_id, state=new_value)
-        
-    elif entity_id == self.ignore_change_time_temp_diff_id:
-        self.set_state(self.ignore_change_time_temp_diff_id, state=new_value)
-
-    #elif entity_id == self.manual_override_end_time_id:
-    #    new_time = data["service_data"].get("time")
-    #    self.set_state(self.manual_override_end_time_id, state=new_value)
-
-    #if(data["service"] == "turn_off" and data["service_data"]["entity_id"] == self.input_boolean):
-    #    self.log(self.input_boolean + "switched off")
-    #    self.set_state(self.input_boolean, state = "off")
-    #if(data["service"] == "turn_on" and data["service_data"]["entity_id"] == self.input_boolean):
-    #    self.log(self.input_boolean + "switched on")
-    #    self.set_state(self.input_boolean, state = "on")
-
-
-  def input_number_changed(self, entity, attribute, old, new, kwargs):
-      # Log whenever an input_number value changes
-      self.log(f"{entity} changed from {old} to {new}")
-      
-      # Update the internal values after the change
-      self.update_internal_parameters()
-
-      # Allow immediate AC state update
-      self.last_state_change_time = datetime.now() - timedelta(seconds=self.min_state_change_time+1)
-
-
-  def input_boolean_changed(self, entity, attribute, old, new, kwargs):
-      # Log whenever an input_number value changes
-      self.log(f"{entity} changed from {old} to {new}")
-      
-      # Update the internal values after the change
-      self.update_internal_parameters()
-
-      # Allow immediate AC state update
-      self.last_state_change_time = datetime.now() - timedelta(seconds=self.min_state_change_time+1)
-
-
-  def input_datetime_changed(self, entity, attribute, old, new, kwargs):
-      # Log whenever an input_datetime value changes
-      self.log(f"{entity} changed from {old} to {new}")
-      
-      # Update the internal values after the change
-      self.update_internal_parameters()
-
-      # Allow immediate AC state update
-      self.last_state_change_time = datetime.now() - timedelta(seconds=self.min_state_change_time+1)
-
-
-  def normalize_value(self, value_now, max_value, min_value):
-    if max_value == min_value:
-      raise ValueError("max_value and min_value cannot be the same value to avoid division by zero.")
-    
-    normalized_value = (value_now - min_value) / (max_value - min_value)
-    
-    # Clamp the value to be within the range [0, 1]
-    normalized_value = max(0, min(1, normalized_value))
-    
-    return normalized_value
-
-
-  # Calculates the target temperature for this hour based on readings and price
-  def calculate_target_temperature(self):
-    inside_temperature = self.get_state(self.entity_id_room_temperature, attribute="state")
-    inside_temperature = float(inside_temperature)
-
-    mean_price = float(self.get_state(self.electricity_price_mean_c_kWh_id))
-    mean_price_min = mean_price * self.min_mean_price_multiplier
-    mean_price_max = mean_price * self.max_mean_price_multiplier
-    price_now = float(self.get_state(self.absolute_electricity_price_c_kWh_id))
-
-    if (price_now < 0):
-      price_now = 0
-    self.log(f"Price now: {price_now}, Mean price {mean_price}")
-    # self.log(f"Today+tomorrow full prices {len(hourly_prices)} items: {hourly_prices}")
-
-    if (inside_temperature < self.target_room_min_temperature):
-      return self.target_room_min_temperature
-    
-    if (inside_temperature > self.target_room_max_temperature):
-      return self.target_room_max_temperature
-    
-    if (price_now > self.max_absolute_price):
-      return self.target_room_min_temperature
-    
-    if (price_now < self.min_absolute_price):
-      return self.target_room_max_temperature
-    
-    if (price_now > mean_price_max):
-      return self.target_room_min_temperature
-    
-    if (price_now < mean_price_min):
-      return self.target_room_max_temperature
-    
-    if (price_now >= mean_price):
-      # Calculate linear curve down to min temp based on how much higher than mean_price we are right now
-      # How much should we reduce ideal room temp based on how much over mean price we are?
-      # Higher price means we will accept lower temperatures before starting AC
-      temp_reduction = self.normalize_value(price_now, mean_price_max, mean_price) * (self.target_room_temperature - self.target_room_min_temperature)
-      return self.target_room_temperature - temp_reduction
-    
-    if (price_now < mean_price):
-      # Calculate linear curve up to max temp based on how much lower than mean_price we are right now
-      temp_increase = self.normalize_value(price_now, mean_price, mean_price_min) * (self.target_room_max_temperature - self.target_room_temperature)
-      return self.target_room_temperature + temp_increase
-    
-    return self.target_room_temperature
-  
-
-  def control_AC(self, target_temperature):
-    inside_temperature = self.get_state(self.entity_id_room_temperature, attribute="state")
-    inside_temperature = float(inside_temperature)
-    ac_power = self.get_state(self.entity_id_climate_control, attribute="power")
-    ac_mode = self.get_state(self.entity_id_climate_control, attribute="power")
-    ac_state = self.get_state(self.entity_id_climate_control, attribute="state")
-    ac_fan_mode = self.get_state(self.entity_id_climate_control, attribute="fan_mode")
-    ac_swing_mode = self.get_state(self.entity_id_climate_control, attribute="swing_mode")
-    ac_current_target_temperature = self.get_state(self.entity_id_climate_control, attribute="temperature")
-    ac_prompt_tone = self.get_state(self.entity_id_climate_control, attribute="prompt_tone")
-    # self.log(f"AC state: {ac_state}")
-    
-    self.log(f"Room temp: {inside_temperature}, Target temp: {target_temperature}, AC temp: {ac_current_target_temperature}")
-    self.log(f"Time since last state change: {datetime.now() - self.last_state_change_time}")
-
-    if ( (datetime.now() - self.last_state_change_time) < timedelta(seconds=self.min_state_change_time) ):
-      if ( (abs(ac_current_target_temperature - target_temperature)) < self.ignore_change_time_temp_diff ):
-        # Not yet time for a scheduled state change and the temperature deviation is not large enough, don't do anything
-        return
-
-    if (inside_temperature >= target_temperature):
-      # Make sure AC is shut down
-      if (ac_state != "fan_only"):
-        self.log(f"Turn off AC - Use fan only mode");
-        self.last_state_change_time = datetime.now()
-        self.call_service("climate/set_hvac_mode", entity_id=self.entity_id_climate_control, hvac_mode="fan_only")
-        time.sleep(2)
-
-      if (ac_fan_mode != "Silent"):
-        self.log(f"Set fan to silent")
-        self.call_service("climate/set_fan_mode", entity_id=self.entity_id_climate_control, fan_mode="Silent")
-        time.sleep(2)
-
-    else:
-      # Make sure AC is running and has the correct target temperatures
-      if (ac_power == False):
-        self.log(f"Turn on AC");
-        self.last_state_change_time = datetime.now()
-        self.call_service("climate/turn_on", entity_id=self.entity_id_climate_control)
-        time.sleep(2)
-      
-      if (target_temperature != ac_current_target_temperature):
-        self.log(f"Set AC temperature to {target_temperature}");
-        self.last_state_change_time = datetime.now()
-        self.call_service("climate/set_temperature", entity_id=self.entity_id_climate_control, temperature=target_temperature)
-        time.sleep(2)
-
-      if (ac_state != "heat"):
-        self.log(f"Set AC to heat")
-        self.last_state_change_time = datetime.now()
-        self.call_service("climate/set_hvac_mode", entity_id=self.entity_id_climate_control, hvac_mode="heat")
-        time.sleep(2)
-
-      if (ac_fan_mode != "Medium"):
-        self.log(f"Set AC fan to Medium")
-        self.last_state_change_time = datetime.now()
-        self.call_service("climate/set_fan_mode", entity_id=self.entity_id_climate_control, fan_mode="Medium")
-        time.sleep(2)
-
-      if (ac_swing_mode != "Horizontal"):
-        self.log(f"Set AC swing mode to Horizontal")
-        self.last_state_change_time = datetime.now()
-        self.call_service("climate/set_swing_mode", entity_id=self.entity_id_climate_control, swing_mode="Horizontal")
-        time.sleep(2)
-
-
-  def update_custom_sensors(self, target_temperature):
-    # Update or create a custom sensor to store this data
-    ac_state = self.get_state(self.entity_id_climate_control, attribute="state")
-    ac_on_off_state = 0
-    self.log(f"Add state to history: {ac_state}")
-    if (ac_state == "heat"):
-      ac_on_off_state = 1
-    self.set_state("sensor.ac_on_off_history", state=ac_on_off_state, attributes={
-        "unit_of_measurement": "",
-        "friendly_name": "AC activity history"
-    })
-
-    self.set_state("sensor.ac_target_temperature_history", state=target_temperature, attributes={
-        "unit_of_measurement": "C",
-        "friendly_name": "AC target temp history"
-    })
-
-
-
-
-  def control_climate(self, kwargs):
-    # 
-    # self.call_service("climate/set_temperature", entity_id="climate.153931628243065_climate", temperature=21)
-    # self.log("AC control updated")
-    self.log(f"")
-    target_temperature = self.calculate_target_temperature()
-    # Round to closest half degree
-    target_temperature = round(target_temperature * 2) / 2
-
-    self.control_AC(target_temperature)
-    self.update_custom_sensors(target_temperature)
-  
+import appdaemon.plugins.hass.hassapi as hass
+from datetime import datetime, timedelta
+from StateSnapshot import StateSnapshot
+from ActuationQueue import ActuationQueue
+from StatePublisher import StatePublisher
+from HeatingScheduleOptimizer import HeatingScheduleOptimizer
+from HeatSourceArbiter import HeatSourceArbiter
+from HeatPumpStateMachine import HeatPumpStateMachine
+from WeatherForecast import WeatherForecast
+from ClimateZone import ClimateZone
+from TimeSeriesStore import get_series
+from Instrumentation import Instrumentation
+from TickLog import TickLog
+from ParameterRegistry import ParameterRegistry
+
+
+#
+# AC Controller app
+#
+# Args:
+#   actuation_spacing: Minimum seconds between two commands sent to the same AC unit (default 2)
+#   actuation_device_spacing: Optional per device override of actuation_spacing, climate entity_id -> seconds
+#   publish_max_age: Seconds after which an unchanged custom sensor is written again anyway (default 900, 0 disables)
+#   control_mode: "polling" evaluates every minute (default), "reactive" evaluates when the room temperature, the price
+#                 sensors or a parameter changes
+#   reactive_debounce: Seconds to collect input changes into one evaluation in reactive mode (default 5)
+#   watchdog_interval: Seconds between forced evaluations in reactive mode, in case an event got lost (default 900)
+#   use_schedule_optimizer: Plan the target temperature over the whole known price curve instead of only looking at
+#                           the current price (default false), see HeatingScheduleOptimizer.py
+#   heat_loss_rate, heating_rate, ac_power_kw, outdoor_temperature, comfort_cost, cop_intercept, cop_slope: Optional
+#                           overrides of the thermal model and comfort cost used by the optimizer. A fitted model from
+#                           ThermalModelLearner.py replaces heat_loss_rate and heating_rate as soon as it is available
+#   use_heat_source_arbiter: Compare the AC with the other heat sources of the house for every price slot and only
+#                            heat with the AC when it is needed in the cheapest source mix (default false). Otherwise
+#                            the AC only keeps the min temperature. See HeatSourceArbiter.py
+#   heat_sources: Heat sources for the arbiter, see HeatSourceArbiter.py. Defaults to the AC only, as heat pump "ac"
+#   heat_pump_source: Name of the AC unit in heat_sources (default ac)
+#   use_weather_forecast: Plan with the hourly forecast of weather.forecast_home instead of the constant
+#                         outdoor_temperature, when the schedule optimizer or the heat source arbiter is used (default
+#                         true). Without a forecast the constant is used. See WeatherForecast.py
+#   forecast_refresh_minutes: Minutes between forecast reads besides the updates of the weather entity (default 60)
+#   zones: Optional list of AC units to control, each with a name, climate_entity and room_temperature_entity. All zones
+#          share the parameters and prices and are evaluated in the same tick. The custom sensors of a zone get the
+#          zone name as suffix, e.g. sensor.ac_on_off_history_bedroom. Without zones the single AC unit below is used
+#   zone_stagger: Minimum seconds between two compressor starts on different zones (default 20)
+#   heat_on_band: Degrees the room has to be below the target temperature to start heating (default 0)
+#   heat_off_band: Degrees the room has to be above the target temperature to stop heating (default 0.5)
+#   min_run_time: Seconds the AC heats before it may be stopped (default min_state_change_time)
+#   min_off_time: Seconds the AC is off before it may be started, skipped when the room is ignore_change_time_temp_diff
+#                 below the target (default min_state_change_time). See HeatPumpStateMachine.py
+#   use_load_coordinator: Do not heat while LoadCoordinator.py has no power budget for the AC unit (default false)
+#   time_series_directory: Directory to persist the decision history in across restarts (default none, kept in memory),
+#                          see TimeSeriesStore.py
+#   instrumentation_interval: Seconds between updates of the tick duration, scheduler lag and API call sensors (default
+#                             0, only the metrics endpoint), see Instrumentation.py
+#   metrics_endpoint: Name of the Prometheus text endpoint (default ac_controller_metrics, empty disables it)
+#   log_level: "debug" logs every step of every tick, "info" (default) one record per log_sample_every ticks plus the
+#              full record of every tick with an AC command or an error, "changes" only those, "errors" only errors.
+#              See TickLog.py
+#   log_sample_every: Write every n-th tick in the info log level (default 15)
+#
+
+class ACController(hass.Hass):
+  target_room_min_temperature = 18    # Minimum room temperature, always turn on AC even during high prices if we go under this
+  target_room_temperature     = 23    # Ideal room temperature, try to reach this target under ideal pricing circumstances
+  target_room_max_temperature = 24    # Maximum allowed room temperature, do not try to collect more heat even if price is low
+
+  min_mean_price_multiplier = 0.5     # If the current price is lower than this mean multiplier, recommend running AC fulltime
+  max_mean_price_multiplier = 1.5     # If the current price is higher than this mean multiplier, recommend shutting down AC
+
+  min_absolute_price        = 5.0     # If the current price is lower than this absolute price, recommend running AC fulltime
+  max_absolute_price        = 30.0    # If the current price is higher than this absolute price, recommend shutting down AC
+
+  min_state_change_time         = 1800      # Amount of seconds before another state change is allowed to reduce oscillating behavior
+  ignore_change_time_temp_diff  = 2         # We ignore the waiting time before starting the AC if the room is this much below the target temp
+                                            # This can happens when the price changes radically from one hour to the next
+
+  heat_on_band                  = 0.0      # Degrees below the target temperature to start heating
+  heat_off_band                 = 0.5      # Degrees above the target temperature to stop heating
+  min_run_time                  = None     # Seconds the AC heats before it may stop, None uses min_state_change_time
+  min_off_time                  = None     # Seconds the AC is off before it may start, None uses min_state_change_time
+
+  state_update_timer            = 5        # How many seconds between two state updates
+
+  actuation_spacing             = 2        # Minimum seconds between two commands sent to the AC, can be set per device in apps.yaml
+  publish_max_age               = 900      # Rewrite unchanged custom sensors after this many seconds, so they survive an HA restart
+
+  control_mode                  = "polling"  # "polling" runs control_climate every minute, "reactive" runs it when an input changes
+  reactive_debounce             = 5        # Seconds to collect input changes into one evaluation in reactive mode
+  watchdog_interval             = 900      # Seconds between forced evaluations in reactive mode
+
+  zone_stagger                  = 20       # Seconds between two compressor starts on different zones
+  use_load_coordinator          = False    # Respect the power budgets published by LoadCoordinator.py
+  time_series_directory         = None     # Persist the decision history here, None keeps it in memory
+
+  instrumentation_interval      = 0        # Seconds between updates of the instrumentation sensors, 0 only serves the endpoint
+  metrics_endpoint              = "ac_controller_metrics"  # Prometheus text endpoint of the instrumentation
+
+  log_level                     = "info"   # debug, info, changes or errors, see TickLog.py
+  log_sample_every              = 15       # Ticks between two records without a decision in the info log level
+
+  use_schedule_optimizer        = False    # Plan the target temperatures ahead over the full price curve
+  heat_loss_rate                = 0.02     # Fraction of the inside/outside temperature difference the house loses per hour
+  heating_rate                  = 1.0      # Degrees per hour the AC adds to the room when heating
+  ac_power_kw                   = 1.0      # Average electrical power of the AC when heating
+  outdoor_temperature           = 0.0      # Outdoor temperature assumed by the plan
+  comfort_cost                  = 5.0      # Cost in cent of one degree hour below the target temperature
+
+  use_heat_source_arbiter       = False    # Only heat with the AC when no other heat source is cheaper
+  heat_pump_source              = "ac"     # Name of the AC unit in heat_sources
+  cop_intercept                 = 3.0      # COP of the AC at 0 C outdoor, for the default heat_sources
+  cop_slope                     = 0.08     # COP change of the AC per degree outdoor, for the default heat_sources
+                                           # and the constant heating_rate, which is measured at outdoor_temperature
+
+  use_weather_forecast          = True     # Plan with the outdoor temperature forecast when there is one
+  forecast_refresh_minutes      = 60       # Minutes between forecast reads besides the weather entity updates
+
+  manual_override_set           = False    # Mirrors input_boolean.manual_override_set, a change re-evaluates right away
+  manual_override_end_time      = datetime.now()  # Defines when manual override will stop
+  #manual_override_target_temp   = 23              # What temperature to set when manual override is active
+
+  # Updated in EnergyCalculations.py
+  absolute_electricity_price_c_kWh_id = "sensor.electricity_price"
+  electricity_price_mean_c_kWh_id = "sensor.electricity_price_mean_c_kWh"
+
+  # The single AC unit controlled when no zones are configured in apps.yaml
+  entity_id_climate_control = "climate.153931628243065_climate"
+  entity_id_weather_forecast = "weather.forecast_home"
+  entity_id_room_temperature = "sensor.climate_living_room_temperature"
+
+  # Updated in ThermalModelLearner.py
+  entity_id_thermal_model = "sensor.ac_thermal_model"
+
+  heat_source_plan_id = "sensor.heat_source_plan"
+
+
+  target_room_min_temperature_id = "input_number.target_room_min_temperature"
+  target_room_temperature_id = "input_number.target_room_temperature"
+  target_room_max_temperature_id = "input_number.target_room_max_temperature"
+  
+  min_mean_price_multiplier_id = "input_number.min_mean_price_multiplier"
+  max_mean_price_multiplier_id = "input_number.max_mean_price_multiplier"
+  
+  min_absolute_price_id = "input_number.min_absolute_price"
+  max_absolute_price_id = "input_number.max_absolute_price"
+  
+  min_state_change_time_id = "input_number.min_state_change_time"
+  ignore_change_time_temp_diff_id = "input_number.ignore_change_time_temp_diff"
+
+  manual_override_set_id = "input_boolean.manual_override_set"
+
+  # The parameters above as input_number and input_boolean entities, see ParameterRegistry.py
+  parameters = [
+      {"name": "target_room_min_temperature", "friendly_name": "Min Room Temperature", "initial": 18, "min": 10, "max": 30, "step": 0.5},
+      {"name": "target_room_temperature", "friendly_name": "Target Room Temperature", "initial": 23, "min": 10, "max": 30, "step": 0.5},
+      {"name": "target_room_max_temperature", "friendly_name": "Max Room Temperature", "initial": 24, "min": 10, "max": 30, "step": 0.5},
+
+      {"name": "min_mean_price_multiplier", "friendly_name": "Min Mean Price Multiplier", "initial": 0.5, "min": 0.1, "max": 2.0, "step": 0.1},
+      {"name": "max_mean_price_multiplier", "friendly_name": "Max Mean Price Multiplier", "initial": 1.5, "min": 0.1, "max": 2.0, "step": 0.1},
+
+      {"name": "min_absolute_price", "friendly_name": "Min Absolute Price", "initial": 5.0, "min": 0.0, "max": 100.0, "step": 0.5},
+      {"name": "max_absolute_price", "friendly_name": "Max Absolute Price", "initial": 30.0, "min": 0.0, "max": 100.0, "step": 0.5},
+
+      {"name": "min_state_change_time", "friendly_name": "Min State Change Time (sec)", "initial": 1800, "min": 0, "max": 3600, "step": 60, "type": int},
+      {"name": "ignore_change_time_temp_diff", "friendly_name": "Temp Diff to Ignore Time", "initial": 2, "min": 0, "max": 10, "step": 0.5},
+
+      {"name": "manual_override_set", "friendly_name": "AC manual override set", "initial": "off", "domain": "input_boolean"},
+  ]
+
+
+  # The AC is compared with the other heat sources (direct electricity heating element, wood furnace, gas, ...) by the cost of one
+  # kWh of heat, with a COP curve based on the outdoor temperature, see HeatSourceArbiter.py
+
+
+
+  # Working variables
+  zones = None                      # ClimateZone per AC unit, see ClimateZone.py
+  snapshot = None                   # Per-tick StateSnapshot, created at the start of every control_climate run
+  saved_state_reads_total = 0       # Number of get_state round trips saved by the snapshots since startup
+  actuation_queue = None            # Sends the AC commands in the background, see ActuationQueue.py
+  publisher = None                  # Skips writes of unchanged custom sensors, see StatePublisher.py
+  tick_log = None                   # One structured log record per tick, see TickLog.py
+  control_timer = None              # Pending debounced evaluation in reactive mode
+  evaluations = 0                   # Number of zone evaluations since startup
+  heat_source_arbiter = None        # Cheapest heat source per price slot, see HeatSourceArbiter.py
+  heat_source_plan = None           # Cached plan of the arbiter and the inputs it was calculated for
+  heat_source_plan_key = None
+  heat_source_plan_attributes = None
+  weather_forecast = None           # Outdoor temperature forecast per price slot, see WeatherForecast.py
+  parameter_registry = None         # Keeps the parameters up to date with their entities, see ParameterRegistry.py
+
+
+  def initialize(self):
+    # Define all variables inside the instance of this class
+    self.zones = []
+    for zone in self.args.get("zones") or []:
+      self.zones.append(ClimateZone(zone["name"], zone["climate_entity"], zone["room_temperature_entity"]))
+    if not self.zones:
+      self.zones.append(ClimateZone(None, self.entity_id_climate_control, self.entity_id_room_temperature))
+    self.log(f"Controlling {len(self.zones)} zones: {', '.join(zone.label() for zone in self.zones)}")
+
+    self.publisher = StatePublisher(self, max_age=self.args.get("publish_max_age", self.publish_max_age))
+    self.instrumentation = Instrumentation(self, "ac_controller", self.publisher,
+                                           publish_interval=self.args.get("instrumentation_interval", self.instrumentation_interval),
+                                           endpoint=self.args.get("metrics_endpoint", self.metrics_endpoint))
+    self.control_climate = self.instrumentation.timed("control_climate", self.control_climate)
+    self.tick_log = TickLog(self, level=self.args.get("log_level", self.log_level),
+                            sample_every=self.args.get("log_sample_every", self.log_sample_every))
+    self.actuation_queue = ActuationQueue(self, self.publisher,
+                                          default_spacing=self.args.get("actuation_spacing", self.actuation_spacing),
+                                          device_spacing=self.args.get("actuation_device_spacing", {}),
+                                          stagger=self.args.get("zone_stagger", self.zone_stagger))
+    self.parameter_registry = ParameterRegistry(self, self.parameters, on_change=self.parameter_changed)
+    for name in ["heat_on_band", "heat_off_band", "min_run_time", "min_off_time"]:
+      setattr(self, name, self.args.get(name, getattr(self, name)))
+    directory = self.args.get("time_series_directory", self.time_series_directory)
+    for zone in self.zones:
+      zone.heat_pump_state = self.restore_heat_pump_state(zone)
+      zone.on_off_series = get_series(zone.on_off_history_id, directory=directory)
+      zone.target_temperature_series = get_series(zone.target_temperature_history_id, directory=directory)
+
+    self.use_schedule_optimizer = self.args.get("use_schedule_optimizer", self.use_schedule_optimizer)
+    self.use_load_coordinator = self.args.get("use_load_coordinator", self.use_load_coordinator)
+    for name in ["heat_loss_rate", "heating_rate", "ac_power_kw", "outdoor_temperature", "comfort_cost", "cop_intercept", "cop_slope"]:
+      setattr(self, name, self.args.get(name, getattr(self, name)))
+
+    self.use_heat_source_arbiter = self.args.get("use_heat_source_arbiter", self.use_heat_source_arbiter)
+    if self.use_heat_source_arbiter:
+      self.heat_pump_source = self.args.get("heat_pump_source", self.heat_pump_source)
+      heat_sources = self.args.get("heat_sources") or [
+          {"name": self.heat_pump_source, "type": "heat_pump", "power_kw": self.ac_power_kw,
+           "cop_intercept": self.cop_intercept, "cop_slope": self.cop_slope}
+      ]
+      self.heat_source_arbiter = HeatSourceArbiter(heat_sources)
+
+    if (self.use_schedule_optimizer or self.use_heat_source_arbiter) and self.args.get("use_weather_forecast", self.use_weather_forecast):
+      self.weather_forecast = WeatherForecast(self, self.entity_id_weather_forecast,
+                                              refresh_minutes=self.args.get("forecast_refresh_minutes", self.forecast_refresh_minutes))
+
+    # Calculate the next time to run the function, 1 second past the next full minute
+    now = datetime.now()
+    next_minute = now + timedelta(minutes=1)
+    start_time = next_minute.replace(second=2, microsecond=0)
+
+    self.control_mode = self.args.get("control_mode", self.control_mode)
+    if self.control_mode == "reactive":
+      # Evaluate when one of the inputs changes, with a slow watchdog in case an event got lost
+      self.reactive_debounce = self.args.get("reactive_debounce", self.reactive_debounce)
+      self.watchdog_interval = self.args.get("watchdog_interval", self.watchdog_interval)
+      for zone in self.zones:
+        self.listen_state(self.control_input_changed, zone.entity_id_room_temperature)
+        if self.use_load_coordinator:
+          self.listen_state(self.control_input_changed, zone.load_budget_id, attribute="allowed")
+      self.listen_state(self.control_input_changed, self.absolute_electricity_price_c_kWh_id)
+      self.listen_state(self.control_input_changed, self.electricity_price_mean_c_kWh_id)
+      self.run_every(self.instrumentation.periodic(self.control_climate, start_time, self.watchdog_interval),
+                     start_time, self.watchdog_interval, force=True)
+    else:
+      # Schedule the function to run every state_update_timer seconds
+      # self.run_every(self.control_climate, "now", self.state_update_timer)
+      self.run_minutely(self.instrumentation.periodic(self.control_climate, start_time, 60), start=start_time)
+    
+
+  def terminate(self):
+    # Called by AppDaemon when the app is stopped or reloaded, writes the persisted decision history to disk
+    for zone in self.zones:
+      zone.on_off_series.flush()
+      zone.target_temperature_series.flush()
+
+
+  def create_input_date(self, entity_id, name):
+    # Check if the entity already exists
+    entity_state = self.get_state(entity_id)
+    # entity_state = None
+    
+    if entity_state is None:
+      # Entity doesn't exist, so create it with the initial value
+      self.log(f"Creating {entity_id} with initial value")
+      now = datetime.now()
+      self.set_state(entity_id, state="", attributes={
+          "year": now.year,
+          "month": now.month,
+          "day": now.day,
+          "hour": now.hour,
+          "second": now.second,
+          "friendly_name": name
+      })
+
+  def create_numeric_entity(self, entity_id, name, initial_value, unit_of_measurement):
+      # Check if the entity already exists
+      entity_state = self.get_state(entity_id)
+      
+      if entity_state is None:
+          # Entity doesn't exist, so create it with the initial value
+          self.log(f"Creating {entity_id} with initial value {initial_value}")
+          self.set_state(entity_id, state=initial_value, attributes={
+              "unit_of_measurement": unit_of_measurement,
+              "friendly_name": name
+          })
+
+  def parameter_changed(self, name, old, new):
+    # Re-evaluate right away, the min run and off times still apply so a parameter edit can not short-cycle the AC
+    self.schedule_control()
+
+
+  def control_input_changed(self, entity, attribute, old, new, kwargs):
+    if old != new:
+      self.schedule_control()
+
+
+  def schedule_control(self):
+    # Coalesce all input changes within reactive_debounce seconds into one evaluation
+    if self.control_mode != "reactive" or self.control_timer is not None:
+      return
+    self.control_timer = self.run_in(self.reactive_control, self.reactive_debounce)
+
+
+  def reactive_control(self, kwargs):
+    self.control_timer = None
+    self.control_climate(kwargs)
+
+
+  def state_change_allowed(self, kwargs):
+    # min_state_change_time has passed, re-evaluate the change that had to wait
+    for zone in self.zones:
+      if zone.label() == kwargs.get("zone"):
+        zone.state_change_timer = None
+    self.control_climate({"force": True})
+
+
+  def normalize_value(self, value_now, max_value, min_value):
+    if max_value == min_value:
+      raise ValueError("max_value and min_value cannot be the same value to avoid division by zero.")
+    
+    normalized_value = (value_now - min_value) / (max_value - min_value)
+    
+    # Clamp the value to be within the range [0, 1]
+    normalized_value = max(0, min(1, normalized_value))
+    
+    return normalized_value
+
+
+  # Calculates the target temperature for this price slot based on readings and price
+  # Returns None when a sensor has no value yet
+  def calculate_target_temperature(self, zone):
+    try:
+      inside_temperature = float(self.snapshot.get(zone.entity_id_room_temperature))
+      mean_price = float(self.snapshot.get(self.electricity_price_mean_c_kWh_id))
+      price_now = float(self.snapshot.get(self.absolute_electricity_price_c_kWh_id))
+    except (TypeError, ValueError):
+      # unknown / unavailable, e.g. right after a restart before EnergyCalculations published the prices
+      self.tick_log.error("Missing room temperature or electricity prices, not controlling zone %s", zone.label())
+      return None
+
+    mean_price_min = mean_price * self.min_mean_price_multiplier
+    mean_price_max = mean_price * self.max_mean_price_multiplier
+
+    if (price_now < 0):
+      price_now = 0
+    self.tick_log.set("price", price_now)
+    self.tick_log.set("mean", mean_price)
+    # self.log(f"Today+tomorrow full prices {len(hourly_prices)} items: {hourly_prices}")
+
+    if (inside_temperature < self.target_room_min_temperature):
+      return self.target_room_min_temperature
+    
+    if (inside_temperature > self.target_room_max_temperature):
+      return self.target_room_max_temperature
+
+    if self.use_heat_source_arbiter and not self.heat_pump_needed():
+      # Another heat source is cheaper in this price slot and covers the heat demand, only keep the min temperature
+      self.tick_log.set("heat_source", self.current_heat_sources()[0])
+      return self.target_room_min_temperature
+
+    if self.use_schedule_optimizer:
+      self.update_heating_schedule(zone, inside_temperature)
+      scheduled_temperature = self.scheduled_target_temperature(zone)
+      if scheduled_temperature is not None:
+        self.tick_log.set("planned", scheduled_temperature)
+        return scheduled_temperature
+      # No plan covering this price slot, fall back to the price rules below
+    
+    if (price_now > self.max_absolute_price):
+      return self.target_room_min_temperature
+    
+    if (price_now < self.min_absolute_price):
+      return self.target_room_max_temperature
+    
+    if (price_now > mean_price_max):
+      return self.target_room_min_temperature
+    
+    if (price_now < mean_price_min):
+      return self.target_room_max_temperature
+    
+    if (price_now >= mean_price):
+      # Calculate linear curve down to min temp based on how much higher than mean_price we are right now
+      # How much should we reduce ideal room temp based on how much over mean price we are?
+      # Higher price means we will accept lower temperatures before starting AC
+      temp_reduction = self.normalize_value(price_now, mean_price_max, mean_price) * (self.target_room_temperature - self.target_room_min_temperature)
+      return self.target_room_temperature - temp_reduction
+    
+    if (price_now < mean_price):
+      # Calculate linear curve up to max temp based on how much lower than mean_price we are right now
+      temp_increase = self.normalize_value(price_now, mean_price, mean_price_min) * (self.target_room_max_temperature - self.target_room_temperature)
+      return self.target_room_temperature + temp_increase
+    
+    return self.target_room_temperature
+  
+
+  def update_heating_schedule(self, zone, inside_temperature):
+    # Only re-plan when new prices arrived or a parameter changed, otherwise the cached plan is used
+    prices = self.snapshot.get(self.electricity_price_mean_c_kWh_id, attribute="prices")
+    prices_start = self.snapshot.get(self.electricity_price_mean_c_kWh_id, attribute="start")
+    slot_minutes = self.price_slot_minutes()
+    if prices is None or prices_start is None:
+      return
+
+    heat_loss_rate, heating_rate_intercept, heating_rate_slope = self.thermal_model()
+
+    start = self.aware(datetime.fromisoformat(prices_start))
+    outdoor_temperatures = self.outdoor_temperatures(start, slot_minutes, len(prices))
+
+    key = (tuple(prices), prices_start, slot_minutes, tuple(outdoor_temperatures),
+           self.target_room_min_temperature, self.target_room_temperature, self.target_room_max_temperature,
+           heat_loss_rate, heating_rate_intercept, heating_rate_slope, self.ac_power_kw, self.comfort_cost)
+    if key == zone.heating_schedule_key:
+      return
+
+    # Plan from the current price slot to the end of the known prices
+    first_slot = max(0, int((datetime.now().astimezone() - start).total_seconds() // (slot_minutes * 60)))
+    remaining_prices = prices[first_slot:]
+
+    # A cold period ahead lowers the heating rate and raises the heat loss in its slots, so the plan heats up before it
+    outdoor_temperatures = outdoor_temperatures[first_slot:]
+    heating_rates = self.heating_rates(outdoor_temperatures, heating_rate_intercept, heating_rate_slope)
+
+    optimizer = HeatingScheduleOptimizer(heat_loss_rate, self.heating_rate, self.ac_power_kw, self.comfort_cost)
+    targets, heating = optimizer.plan(remaining_prices, inside_temperature, outdoor_temperatures,
+                                      self.target_room_min_temperature, self.target_room_temperature, self.target_room_max_temperature,
+                                      heating_rates=heating_rates, slot_hours=slot_minutes / 60)
+
+    zone.heating_schedule = {"start": start + timedelta(minutes=first_slot * slot_minutes), "slot_minutes": slot_minutes,
+                             "start_temperature": inside_temperature, "targets": targets, "heating": heating}
+    zone.heating_schedule_key = key
+    heating_hours = sum(heating) * slot_minutes / 60
+    self.tick_log.decision("New heating schedule for zone %s for %s slots of %s minutes, heating %s hours",
+                           zone.label(), len(targets), slot_minutes, heating_hours)
+
+    self.publisher.publish(zone.heating_schedule_id, heating_hours, attributes={
+        "unit_of_measurement": "h",
+        "friendly_name": "AC planned heating hours",
+        "start": zone.heating_schedule["start"].isoformat(),
+        "slot_minutes": slot_minutes,
+        "targets": targets,
+        "heating": heating
+    })
+
+
+  def update_heat_source_plan(self):
+    # Only re-plan when new prices arrived or a parameter changed, per tick the current slot is looked up in the plan
+    prices = self.snapshot.get(self.electricity_price_mean_c_kWh_id, attribute="prices")
+    prices_start = self.snapshot.get(self.electricity_price_mean_c_kWh_id, attribute="start")
+    slot_minutes = self.price_slot_minutes()
+    if prices is None or prices_start is None:
+      return
+
+    heat_loss_rate, heating_rate_intercept, heating_rate_slope = self.thermal_model()
+    outdoor_temperatures = self.outdoor_temperatures(self.aware(datetime.fromisoformat(prices_start)), slot_minutes, len(prices))
+    key = (tuple(prices), prices_start, slot_minutes, tuple(outdoor_temperatures), self.target_room_temperature,
+           heat_loss_rate, heating_rate_intercept, heating_rate_slope)
+    if key != self.heat_source_plan_key:
+      heating_rates = self.heating_rates(outdoor_temperatures, heating_rate_intercept, heating_rate_slope)
+      heat_demands = [self.heat_demand_kw(outdoor, heat_loss_rate, heating_rate)
+                      for outdoor, heating_rate in zip(outdoor_temperatures, heating_rates)]
+      if None in heat_demands:
+        heat_demands = None
+      cheapest, costs, mix = self.heat_source_arbiter.plan(prices, outdoor_temperatures, heat_demands)
+      self.heat_source_plan = {"start": self.aware(datetime.fromisoformat(prices_start)), "slot_minutes": slot_minutes,
+                               "cheapest": cheapest, "costs": costs, "mix": mix}
+      self.heat_source_plan_key = key
+      self.heat_source_plan_attributes = {
+          "friendly_name": "Cheapest heat source",
+          "start": prices_start,
+          "slot_minutes": slot_minutes,
+          "sources": [source["name"] for source in self.heat_source_arbiter.sources],
+          "cheapest": cheapest,
+          "heat_costs": [[round(cost, 2) for cost in slot_costs] for slot_costs in costs]
+      }
+      self.tick_log.decision("New heat source plan for %s slots, the AC is cheapest in %s",
+                             len(cheapest), cheapest.count(self.heat_pump_source))
+
+    current = self.current_heat_sources()
+    if current is not None:
+      self.publisher.publish(self.heat_source_plan_id, current[0], attributes=self.heat_source_plan_attributes)
+
+
+  def outdoor_temperatures(self, start, slot_minutes, count):
+    # Outdoor temperature of every price slot from start, served from the forecast cache between forecast updates
+    if self.weather_forecast is None:
+      return [self.outdoor_temperature] * count
+    return self.weather_forecast.temperatures(start, slot_minutes, count, default=self.outdoor_temperature)
+
+
+  def heating_rates(self, outdoor_temperatures, heating_rate_intercept, heating_rate_slope):
+    # Degrees per hour the AC adds in every slot. The fitted model has its own outdoor slope, the constant heating_rate
+    # follows the COP curve relative to the COP at outdoor_temperature
+    if heating_rate_slope != 0:
+      return [max(0, heating_rate_intercept + heating_rate_slope * outdoor) for outdoor in outdoor_temperatures]
+    reference_cop = max(1.0, self.cop_intercept + self.cop_slope * self.outdoor_temperature)
+    return [heating_rate_intercept * max(1.0, self.cop_intercept + self.cop_slope * outdoor) / reference_cop
+            for outdoor in outdoor_temperatures]
+
+
+  def heat_demand_kw(self, outdoor_temperature, heat_loss_rate, heating_rate):
+    # Heat needed to hold the target temperature, from the thermal model: the AC heats the room heating_rate degrees
+    # per hour with power_kw * COP kW, which gives the kWh per degree of the room. None without a heat pump source
+    for source in self.heat_source_arbiter.sources:
+      if source["name"] == self.heat_pump_source and source["type"] == "heat_pump" and heating_rate > 0:
+        kwh_per_degree = self.heat_source_arbiter.heat_capacity(source, outdoor_temperature) / heating_rate
+        return heat_loss_rate * max(0, self.target_room_temperature - outdoor_temperature) * kwh_per_degree
+    return None
+
+
+  def current_heat_sources(self):
+    # (cheapest source, source mix) of the current price slot, None when the plan does not cover it
+    if self.heat_source_plan is None:
+      return None
+    elapsed = datetime.now().astimezone() - self.heat_source_plan["start"]
+    index = int(elapsed.total_seconds() // (self.heat_source_plan["slot_minutes"] * 60))
+    if index < 0 or index >= len(self.heat_source_plan["cheapest"]):
+      return None
+    return self.heat_source_plan["cheapest"][index], self.heat_source_plan["mix"][index]
+
+
+  def heat_pump_needed(self):
+    # The AC is needed when it is the cheapest source or the cheaper ones can not cover the demand, or without a plan
+    current = self.current_heat_sources()
+    if current is None:
+      return True
+    cheapest, mix = current
+    return cheapest == self.heat_pump_source or (mix.get(self.heat_pump_source) or 0) > 0
+
+
+  def price_slot_minutes(self):
+    # Length of one price slot, 60 until EnergyCalculations publishes sub-hourly prices
+    return self.snapshot.get(self.electricity_price_mean_c_kWh_id, attribute="slot_minutes") or 60
+
+
+  def aware(self, timestamp):
+    # Price slot times are timezone aware, older versions of EnergyCalculations published local times
+    if timestamp.tzinfo is None:
+      return timestamp.astimezone()
+    return timestamp
+
+
+  def thermal_model(self):
+    # Returns (heat_loss_rate, heating_rate_intercept, heating_rate_slope)
+    # Use the fitted model when ThermalModelLearner has one, otherwise the configured constant heating rate
+    if self.snapshot.get(self.entity_id_thermal_model) == "fitted":
+      heat_loss_rate = self.snapshot.get(self.entity_id_thermal_model, attribute="heat_loss_rate")
+      heating_rate_intercept = self.snapshot.get(self.entity_id_thermal_model, attribute="heating_rate_intercept")
+      heating_rate_slope = self.snapshot.get(self.entity_id_thermal_model, attribute="heating_rate_slope")
+      if None not in (heat_loss_rate, heating_rate_intercept, heating_rate_slope):
+        return heat_loss_rate, heating_rate_intercept, heating_rate_slope
+    return self.heat_loss_rate, self.heating_rate, 0.0
+
+
+  def scheduled_target_temperature(self, zone):
+    # Target temperature of the current price slot from the cached plan
+    if zone.heating_schedule is None:
+      return None
+    elapsed = datetime.now().astimezone() - zone.heating_schedule["start"]
+    index = int(elapsed.total_seconds() // (zone.heating_schedule["slot_minutes"] * 60))
+    if index < 0 or index >= len(zone.heating_schedule["targets"]):
+      return None
+    target = zone.heating_schedule["targets"][index]
+    if zone.heating_schedule["heating"][index]:
+      # In a cold period the room can cool down even with the AC running, the plan still heats and so must the AC
+      slot_start = zone.heating_schedule["targets"][index - 1] if index > 0 else zone.heating_schedule["start_temperature"]
+      target = max(target, slot_start + 0.5)
+    return target
+
+
+  def control_AC(self, zone, target_temperature):
+    # Only called after calculate_target_temperature found a room temperature
+    inside_temperature = float(self.snapshot.get(zone.entity_id_room_temperature))
+    ac_power = self.snapshot.get(zone.entity_id_climate_control, attribute="power")
+    ac_state = self.snapshot.get(zone.entity_id_climate_control)
+    ac_fan_mode = self.snapshot.get(zone.entity_id_climate_control, attribute="fan_mode")
+    ac_swing_mode = self.snapshot.get(zone.entity_id_climate_control, attribute="swing_mode")
+    ac_current_target_temperature = self.snapshot.get(zone.entity_id_climate_control, attribute="temperature")
+    # self.log(f"AC state: {ac_state}")
+    
+    self.tick_log.set("room", inside_temperature)
+    self.tick_log.set("target", target_temperature)
+    self.tick_log.set("ac_target", ac_current_target_temperature)
+    self.tick_log.set("ac_state", ac_state)
+    now = datetime.now()
+    machine = self.heat_pump_state_machine()
+    if zone.heat_pump_state is None:
+      # First evaluation without a published state, continue in the mode the AC is in
+      zone.heat_pump_state = machine.initial_state("heating" if ac_state == "heat" else "off")
+    if zone.heat_pump_state["since"] is not None:
+      self.tick_log.detail("Heat pump %s since %s", zone.heat_pump_state["mode"], now - zone.heat_pump_state["since"])
+
+    zone.last_control_blocked = False
+    if self.load_throttled(zone):
+      # Not enough power left in the house, stop heating right away without waiting for min_run_time
+      zone.heat_pump_state, transition = machine.force(zone.heat_pump_state, "off", now)
+      if (ac_state == "heat"):
+        self.tick_log.decision("No power budget from the load coordinator - Use fan only mode")
+        self.actuation_queue.enqueue("climate/set_hvac_mode", zone.entity_id_climate_control, hvac_mode="fan_only")
+      self.publish_heat_pump_state(zone)
+      return
+
+    zone.heat_pump_state, transition = machine.step(zone.heat_pump_state, inside_temperature, target_temperature, now)
+    self.tick_log.set("heat_pump", zone.heat_pump_state["mode"])
+    if transition is not None:
+      self.tick_log.decision("Heat pump %s, %s transitions today", transition, zone.heat_pump_state["transitions"])
+    blocked_until = zone.heat_pump_state["blocked_until"]
+    if blocked_until is not None:
+      # The room left the hysteresis band but the min run or off time has not passed yet, keep the current mode
+      zone.last_control_blocked = True
+      self.tick_log.detail("Waiting until %s before leaving the %s mode", blocked_until, zone.heat_pump_state["mode"])
+      if self.control_mode == "reactive" and zone.state_change_timer is None:
+        # Nothing else might trigger an evaluation when the waiting time is over
+        zone.state_change_timer = self.run_in(self.state_change_allowed, (blocked_until - now).total_seconds() + 1, zone=zone.label())
+
+    if (zone.heat_pump_state["mode"] == "off"):
+      # Make sure AC is shut down
+      if (ac_state != "fan_only"):
+        self.tick_log.decision("Turn off AC - Use fan only mode")
+        self.actuation_queue.enqueue("climate/set_hvac_mode", zone.entity_id_climate_control, hvac_mode="fan_only")
+
+      if (ac_fan_mode != "Silent"):
+        self.tick_log.decision("Set fan to silent")
+        self.actuation_queue.enqueue("climate/set_fan_mode", zone.entity_id_climate_control, fan_mode="Silent")
+
+    else:
+      # Make sure AC is running and has the correct target temperatures
+      # Inside the hysteresis band the AC thermostat holds the room at the target, a new target is not a new start
+      if (ac_power == False):
+        self.tick_log.decision("Turn on AC")
+        self.actuation_queue.enqueue("climate/turn_on", zone.entity_id_climate_control)
+      
+      if (target_temperature != ac_current_target_temperature):
+        self.tick_log.decision("Set AC temperature to %s", target_temperature)
+        self.actuation_queue.enqueue("climate/set_temperature", zone.entity_id_climate_control, temperature=target_temperature)
+
+      if (ac_state != "heat"):
+        self.tick_log.decision("Set AC to heat")
+        self.actuation_queue.enqueue("climate/set_hvac_mode", zone.entity_id_climate_control, hvac_mode="heat")
+
+      if (ac_fan_mode != "Medium"):
+        self.tick_log.decision("Set AC fan to Medium")
+        self.actuation_queue.enqueue("climate/set_fan_mode", zone.entity_id_climate_control, fan_mode="Medium")
+
+      if (ac_swing_mode != "Horizontal"):
+        self.tick_log.decision("Set AC swing mode to Horizontal")
+        self.actuation_queue.enqueue("climate/set_swing_mode", zone.entity_id_climate_control, swing_mode="Horizontal")
+
+    self.publish_heat_pump_state(zone)
+
+
+  def heat_pump_state_machine(self):
+    # Made per tick, min_state_change_time and ignore_change_time_temp_diff are parameters that can change any time
+    min_run_time = self.min_state_change_time if self.min_run_time is None else self.min_run_time
+    min_off_time = self.min_state_change_time if self.min_off_time is None else self.min_off_time
+    return HeatPumpStateMachine(self.heat_on_band, self.heat_off_band, min_run_time, min_off_time,
+                                override_temperature_diff=self.ignore_change_time_temp_diff)
+
+
+  def publish_heat_pump_state(self, zone):
+    state = zone.heat_pump_state
+    self.publisher.publish(zone.heat_pump_state_id, state["mode"], attributes={
+        "friendly_name": "AC heat pump state",
+        "since": state["since"].isoformat() if state["since"] is not None else None,
+        "day": state["day"].isoformat() if state["day"] is not None else None,
+        "transitions_today": state["transitions"],
+        "starts_today": state["starts"],
+        "blocked_until": state["blocked_until"].isoformat() if state["blocked_until"] is not None else None
+    })
+
+
+  def restore_heat_pump_state(self, zone):
+    # Continue with the published state after a restart, so a restart does not allow a short cycle or reset the counters
+    # None when there is no valid state, the first evaluation then starts from the mode of the AC
+    state = self.get_state(zone.heat_pump_state_id, attribute="all") or {}
+    attributes = state.get("attributes") or {}
+    try:
+      since = attributes.get("since")
+      day = attributes.get("day")
+      return self.heat_pump_state_machine().initial_state(
+          state.get("state"),
+          since=datetime.fromisoformat(since) if since else None,
+          day=datetime.fromisoformat(day).date() if day else None,
+          transitions=int(attributes.get("transitions_today") or 0),
+          starts=int(attributes.get("starts_today") or 0))
+    except (TypeError, ValueError):
+      return None
+
+
+  def load_throttled(self, zone):
+    # Only an explicit "not allowed" throttles, a missing budget sensor must not stop the heating
+    return self.use_load_coordinator and self.snapshot.get(zone.load_budget_id, attribute="allowed") == False
+
+
+  def update_custom_sensors(self, zone, target_temperature):
+    # Update or create a custom sensor to store this data
+    # Note: the snapshot holds the AC state from the start of the tick, before any commands sent by control_AC
+    ac_state = self.snapshot.get(zone.entity_id_climate_control)
+    ac_on_off_state = 0
+    self.tick_log.detail("Add state to history: %s", ac_state)
+    if (ac_state == "heat"):
+      ac_on_off_state = 1
+    zone.on_off_series.append(datetime.now(), ac_on_off_state)
+    zone.target_temperature_series.append(datetime.now(), target_temperature)
+    self.publisher.publish(zone.on_off_history_id, ac_on_off_state, attributes={
+        "unit_of_measurement": "",
+        "friendly_name": "AC activity history"
+    })
+
+    self.publisher.publish(zone.target_temperature_history_id, target_temperature, attributes={
+        "unit_of_measurement": "C",
+        "friendly_name": "AC target temp history"
+    })
+
+
+
+
+  def control_climate(self, kwargs, snapshot=None):
+    # 
+    # self.call_service("climate/set_temperature", entity_id="climate.153931628243065_climate", temperature=21)
+    # self.log("AC control updated")
+    self.tick_log.start("control_climate")
+    try:
+      self.control_zones(kwargs, snapshot)
+    finally:
+      self.tick_log.finish()
+
+
+  def control_zones(self, kwargs, snapshot=None):
+    # Read every entity only once during this tick, the price sensors are shared by all zones
+    # ACControllerAsync hands in a snapshot it already filled with concurrent reads
+    if snapshot is None:
+      snapshot = StateSnapshot(self)
+      if len(self.zones) > 1:
+        # One get_state call for all AC units instead of one per zone
+        snapshot.prefetch_domain("climate")
+    self.snapshot = snapshot
+    if self.use_heat_source_arbiter:
+      # Shared by all zones
+      self.update_heat_source_plan()
+
+    # In reactive mode, skip the zones where none of the inputs changed since the last evaluation
+    # Polling mode and the watchdog always evaluate
+    force = kwargs.get("force", self.control_mode != "reactive")
+    evaluated = 0
+    for zone in self.zones:
+      control_inputs = self.control_inputs(zone)
+      if not force and not zone.last_control_blocked and control_inputs == zone.last_control_inputs:
+        continue
+      zone.last_control_inputs = control_inputs
+      evaluated += 1
+      if len(self.zones) > 1:
+        self.tick_log.scope(zone.label())
+
+      target_temperature = self.calculate_target_temperature(zone)
+      if target_temperature is None:
+        # Try again on the next tick or input change
+        zone.last_control_inputs = None
+        continue
+      # Round to closest half degree
+      target_temperature = round(target_temperature * 2) / 2
+
+      self.control_AC(zone, target_temperature)
+      self.update_custom_sensors(zone, target_temperature)
+
+    self.tick_log.scope(None)
+    self.tick_log.set("evaluated", evaluated)
+    if evaluated == 0:
+      self.tick_log.detail("No input changed since the last evaluation, skipping")
+      return
+    self.evaluations += evaluated
+
+    self.saved_state_reads_total += self.snapshot.saved_round_trips()
+    self.tick_log.detail("State snapshot: %s get_state calls for %s lookups, %s round trips saved (%s since startup)",
+                         self.snapshot.fetches, self.snapshot.lookups, self.snapshot.saved_round_trips(), self.saved_state_reads_total)
+    self.tick_log.detail("State writes: %s written, %s unchanged writes suppressed since startup",
+                         self.publisher.writes, self.publisher.suppressed)
+    self.tick_log.detail("%s zone evaluations since startup (%s mode)", self.evaluations, self.control_mode)
+
+
+  def control_inputs(self, zone):
+    # Everything calculate_target_temperature depends on
+    # With the schedule optimizer the current price slot selects the target from the plan
+    current_slot = None
+    if self.use_schedule_optimizer:
+      current_slot = int(datetime.now().timestamp() // (self.price_slot_minutes() * 60))
+    return (current_slot,
+            self.heat_pump_needed() if self.use_heat_source_arbiter else None,
+            self.load_throttled(zone),
+            self.snapshot.get(zone.entity_id_room_temperature),
+            self.snapshot.get(self.absolute_electricity_price_c_kWh_id),
+            self.snapshot.get(self.electricity_price_mean_c_kWh_id),
+            self.target_room_min_temperature, self.target_room_temperature, self.target_room_max_temperature,
+            self.min_mean_price_multiplier, self.max_mean_price_multiplier,
+            self.min_absolute_price, self.max_absolute_price,
+            self.min_state_change_time, self.ignore_change_time_temp_diff)
+  
@@ -0,0 +1,62 @@
+from ACController import ACController
+from StateSnapshot import StateSnapshot
+
+
+#
+# AC Controller app, asyncio variant
+#
+# The same control as ACController.py with the same args, selected in apps.yaml with module: ACControllerAsync and
+# class: ACControllerAsync. A tick starts as a coroutine on the AppDaemon event loop and reads the room temperatures,
+# climate units and price sensors, and the thermal model and power budgets when they are used, concurrently into the
+# StateSnapshot of the tick. The decisions and the AC commands then run unchanged in the app's own worker thread with
+# that snapshot, so they never overlap with the other callbacks of the app, like in ACController. The worker thread is
+# only held for the decisions and the writes, not for one read round trip after the other.
+#
+# The instrumentation measures both halves: control_climate is the prefetch on the event loop, and
+# control_climate_prefetched the decisions and the writes in the worker thread.
+#
+
+class ACControllerAsync(ACController):
+
+  def initialize(self):
+    ACController.initialize(self)
+    self.control_climate_prefetched = self.instrumentation.timed("control_climate_prefetched", self.control_climate_prefetched)
+
+
+  async def control_climate(self, kwargs):
+    snapshot = StateSnapshot(self)
+    await snapshot.prefetch_concurrently(self.tick_entity_ids())
+    # Only the control args, the kwargs of a scheduler callback also carry AppDaemon's own entries
+    force = kwargs.get("force", self.control_mode != "reactive")
+    await self.run_in(self.control_climate_prefetched, 0, snapshot=snapshot, force=force)
+
+
+  def control_climate_prefetched(self, kwargs):
+    snapshot = kwargs.pop("snapshot")
+    ACController.control_climate(self, kwargs, snapshot)
+
+
+  def tick_entity_ids(self):
+    # Every entity control_zones reads from the snapshot
+    entity_ids = [self.absolute_electricity_price_c_kWh_id, self.electricity_price_mean_c_kWh_id]
+    if self.use_schedule_optimizer or self.use_heat_source_arbiter:
+      entity_ids.append(self.entity_id_thermal_model)
+    for zone in self.zones:
+      entity_ids.append(zone.entity_id_room_temperature)
+      entity_ids.append(zone.entity_id_climate_control)
+      if self.use_load_coordinator:
+        entity_ids.append(zone.load_budget_id)
+    return entity_ids
+
+
+  async def reactive_control(self, kwargs):
+    self.control_timer = None
+    await self.control_climate(kwargs)
+
+
+  async def state_change_allowed(self, kwargs):
+    # The min run or off time has passed, re-evaluate the switch that had to wait
+    for zone in self.zones:
+      if zone.label() == kwargs.get("zone"):
+        zone.state_change_timer = None
+    await self.control_climate({"force": True})
@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta
+
+
+#
+# Actuation queue
+#
+# Queues call_service commands per device and drains them through run_in callbacks, so the caller can return
+# right away instead of sleeping between commands. Commands to the same device are sent with at least
+# "spacing" seconds between them, and redundant commands are merged into the smallest sequence the unit accepts.
+# With a stagger, commands that start a compressor are also spread out across devices, so a tick that turns on
+# many zones does not start all of them in the same second.
+#
+
+class ActuationQueue:
+  queue_depth_id = "sensor.ac_actuation_queue_depth"
+  drain_latency_id = "sensor.ac_actuation_drain_latency"
+
+  def __init__(self, app, publisher, default_spacing=2, device_spacing=None, merge_hvac_mode_into_temperature=True, stagger=0):
+    self.app = app
+    self.publisher = publisher                          # StatePublisher used for the queue sensors
+    self.default_spacing = default_spacing              # Seconds between two commands to the same device
+    self.device_spacing = device_spacing or {}          # Per device override of the spacing, entity_id -> seconds
+    self.merge_hvac_mode_into_temperature = merge_hvac_mode_into_temperature  # climate.set_temperature accepts hvac_mode
+    self.stagger = stagger                              # Seconds between two compressor starts on different devices
+
+    self.pending = {}         # entity_id -> list of commands waiting to be sent
+    self.drain_handles = {}   # entity_id -> run_in handle of the next scheduled drain
+    self.last_sent = {}       # entity_id -> time the last command was sent
+    self.next_start = None    # Earliest time the next compressor start may be sent, on any device
+    self.start_slots = {}     # entity_id -> time slot reserved for a compressor start that had to wait
+    self.last_drain_latency = 0.0
+
+
+  def spacing(self, entity_id):
+    return self.device_spacing.get(entity_id, self.default_spacing)
+
+
+  def depth(self):
+    return sum(len(commands) for commands in self.pending.values())
+
+
+  def enqueue(self, service, entity_id, **data):
+    commands = self.pending.setdefault(entity_id, [])
+    commands.append({"service": service, "data": data, "enqueued": datetime.now()})
+    self.pending[entity_id] = self.compact(commands)
+
+    if entity_id not in self.drain_handles:
+      # Respect the spacing towards the last command that was already sent to this device
+      delay = 0
+      if entity_id in self.last_sent:
+        elapsed = (datetime.now() - self.last_sent[entity_id]).total_seconds()
+        delay = max(0, self.spacing(entity_id) - elapsed)
+      self.drain_handles[entity_id] = self.app.run_in(self.drain, delay, entity_id=entity_id)
+
+    self.update_sensors()
+
+
+  def compact(self, commands):
+    # Reduce a list of commands to one device to the smallest equivalent sequence
+    # The same service sent twice only needs to be sent once with the latest data
+    merged = []
+    by_service = {}
+    for command in commands:
+      service = command["service"]
+      if service in by_service:
+        by_service[service]["data"].update(command["data"])
+      else:
+        by_service[service] = {"service": service, "data": dict(command["data"]), "enqueued": command["enqueued"]}
+        merged.append(by_service[service])
+
+    # set_hvac_mode followed by set_temperature can be sent as one set_temperature with an hvac_mode
+    hvac_command = by_service.get("climate/set_hvac_mode")
+    temperature_command = by_service.get("climate/set_temperature")
+    if self.merge_hvac_mode_into_temperature and hvac_command is not None and temperature_command is not None:
+      temperature_command["data"]["hvac_mode"] = hvac_command["data"]["hvac_mode"]
+      temperature_command["enqueued"] = min(temperature_command["enqueued"], hvac_command["enqueued"])
+      merged.remove(hvac_command)
+      hvac_command = temperature_command
+
+    # Setting any hvac mode other than off turns the unit on, no need for a separate turn_on
+    turn_on_command = by_service.get("climate/turn_on")
+    if turn_on_command is not None and hvac_command is not None and hvac_command["data"].get("hvac_mode") not in (None, "off"):
+      hvac_command["enqueued"] = min(hvac_command["enqueued"], turn_on_command["enqueued"])
+      merged.remove(turn_on_command)
+
+    return merged
+
+
+  def starts_compressor(self, command):
+    return command["service"] == "climate/turn_on" or command["data"].get("hvac_mode") == "heat"
+
+
+  def drain(self, kwargs):
+    entity_id = kwargs["entity_id"]
+    commands = self.pending.get(entity_id, [])
+    if not commands:
+      self.drain_handles.pop(entity_id, None)
+      return
+
+    now = datetime.now()
+    if self.stagger > 0 and self.starts_compressor(commands[0]) and self.start_slots.pop(entity_id, None) is None:
+      # Give every compressor start its own slot, stagger seconds after the previous one on any device
+      slot = now if self.next_start is None else max(now, self.next_start)
+      self.next_start = slot + timedelta(seconds=self.stagger)
+      if slot > now:
+        self.start_slots[entity_id] = slot
+        self.drain_handles[entity_id] = self.app.run_in(self.drain, (slot - now).total_seconds(), entity_id=entity_id)
+        return
+
+    command = commands.pop(0)
+    self.app.call_service(command["service"], entity_id=entity_id, **command["data"])
+    self.last_sent[entity_id] = now
+    self.last_drain_latency = (now - command["enqueued"]).total_seconds()
+
+    if commands:
+      self.drain_handles[entity_id] = self.app.run_in(self.drain, self.spacing(entity_id), entity_id=entity_id)
+    else:
+      del self.pending[entity_id]
+      self.drain_handles.pop(entity_id, None)
+
+    self.update_sensors()
+
+
+  def update_sensors(self):
+    self.publisher.publish(self.queue_depth_id, self.depth(), attributes={
+        "unit_of_measurement": "commands",
+        "friendly_name": "AC actuation queue depth"
+    })
+
+    self.publisher.publish(self.drain_latency_id, round(self.last_drain_latency, 3), attributes={
+        "unit_of_measurement": "s",
+        "friendly_name": "AC actuation drain latency"
+    })
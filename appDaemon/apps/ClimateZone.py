@@ -0,0 +1,37 @@
+#
+# Climate zone
+#
+# One AC unit and the room sensor it is controlled by, plus the working variables ACController keeps per unit.
+# Configured with the zones list in apps.yaml, see ACController.py.
+#
+
+class ClimateZone:
+
+  def __init__(self, name, entity_id_climate_control, entity_id_room_temperature):
+    self.name = name                                              # None for the single default zone
+    self.entity_id_climate_control = entity_id_climate_control
+    self.entity_id_room_temperature = entity_id_room_temperature
+
+    # Custom sensors, the default zone keeps the original entity ids
+    suffix = "" if name is None else "_" + name
+    self.on_off_history_id = "sensor.ac_on_off_history" + suffix
+    self.target_temperature_history_id = "sensor.ac_target_temperature_history" + suffix
+    self.heating_schedule_id = "sensor.ac_heating_schedule" + suffix
+    self.heat_pump_state_id = "sensor.ac_heat_pump_state" + suffix
+
+    # Published by LoadCoordinator.py
+    self.load_budget_id = "sensor.load_budget_" + entity_id_climate_control.replace(".", "_")
+
+    # Working variables
+    self.heat_pump_state = None       # State of the HeatPumpStateMachine, None until the first evaluation
+    self.state_change_timer = None    # Pending evaluation for when the min run or off time has passed in reactive mode
+    self.last_control_inputs = None   # Inputs of the last evaluation, used to skip evaluations when nothing changed
+    self.last_control_blocked = False # True if the last evaluation wanted a switch but had to wait for the min run or off time
+    self.heating_schedule = None      # Cached plan from the HeatingScheduleOptimizer, dict with start, targets and heating
+    self.heating_schedule_key = None  # Inputs the cached plan was made for
+    self.on_off_series = None         # Decisions kept in the TimeSeriesStore, see TimeSeriesStore.py
+    self.target_temperature_series = None
+
+
+  def label(self):
+    return "default" if self.name is None else self.name
@@ -0,0 +1,160 @@
+from datetime import datetime
+
+
+#
+# Cost attribution
+#
+# Splits the energy cost of the house between sub-metered devices, e.g. the AC heat pump against the rest of the
+# house. Every device is a power sensor (W or kW) or an energy sensor (kWh or Wh) of Home Assistant, read by a state
+# listener only: a power sensor is integrated over time between its state changes, an energy sensor counts its
+# increases. Nothing is read from the recorder.
+#
+# EnergyCalculations hands every costed interval to attribute(): the P1 meter delta and the energy cost of the
+# interval, which was priced with the tariff slots the interval falls in. Each device gets the energy it used since
+# the last interval at the average price of the interval, the rest of the house gets what is left. The sub-meters and
+# the P1 meter do not update at the same moment, so when the devices add up to more than the P1 delta they are scaled
+# down to it. The monthly fixed costs are not attributed, they are only in the running total.
+#
+# The running costs are published as one sensor per device, sensor.energy_cost_<name>, plus
+# sensor.energy_cost_rest_of_house, all in one batch every publish_interval seconds.
+#
+# Devices:
+#   - name: ac
+#     entity_id: sensor.ac_power
+#     type: power             power (default) or energy
+#     unit: W                 W (default) or kW for power, kWh (default) or Wh for energy
+#
+
+class MeteredDevice:
+  scales = {"power": {"W": 0.001, "kW": 1.0}, "energy": {"kWh": 1.0, "Wh": 0.001}}
+
+  def __init__(self, name, entity_id, kind="power", unit=None):
+    if kind not in self.scales:
+      raise ValueError(f"Unknown type {kind} of device {name}, expected power or energy")
+    if unit is None:
+      unit = "W" if kind == "power" else "kWh"
+    if unit not in self.scales[kind]:
+      raise ValueError(f"Unknown unit {unit} of device {name}, expected one of {', '.join(self.scales[kind])}")
+    self.name = name
+    self.entity_id = entity_id
+    self.kind = kind
+    self.scale = self.scales[kind][unit]      # Sensor value to kW or kWh
+    self.sensor_id = "sensor.energy_cost_" + name
+
+    self.value = None                         # Last sensor value in kW or kWh, None while unknown
+    self.value_time = None                    # When the power value was set
+    self.pending_kwh = 0.0                    # Used since the last attributed interval
+
+    # Running totals
+    self.energy_kwh = 0.0
+    self.cost_euro = 0.0
+
+
+  def update(self, state, now):
+    try:
+      value = float(state) * self.scale
+    except (TypeError, ValueError):
+      value = None
+
+    if self.kind == "power":
+      self.integrate(now)
+    elif value is not None and self.value is not None and value >= self.value:
+      # A lower value is a reset or a replaced meter, counting continues from it
+      self.pending_kwh += value - self.value
+    self.value = value
+    self.value_time = now
+
+
+  def integrate(self, now):
+    # Energy of the current power value up to now
+    if self.value is not None and self.value_time is not None and now > self.value_time:
+      self.pending_kwh += self.value * (now - self.value_time).total_seconds() / 3600
+    self.value_time = now
+
+
+class CostAttribution:
+
+  def __init__(self, app, publisher, devices, publish_interval=300):
+    self.app = app
+    self.publisher = publisher
+    self.devices = {}                         # entity_id -> MeteredDevice
+    for device in devices:
+      metered = MeteredDevice(device["name"], device["entity_id"], device.get("type", "power"), device.get("unit"))
+      self.devices[metered.entity_id] = metered
+    self.rest = MeteredDevice("rest_of_house", None, "energy")
+
+    now = datetime.now()
+    for device in self.devices.values():
+      device.update(app.get_state(device.entity_id), now)
+      app.listen_state(self.device_changed, device.entity_id)
+    if publish_interval:
+      app.run_every(self.publish, "now", publish_interval)
+
+
+  def device_changed(self, entity, attribute, old, new, kwargs):
+    self.devices[entity].update(new, datetime.now())
+
+
+  def discard(self, now):
+    # Forget the energy used since the last interval, e.g. when the P1 interval it belongs to was not costed
+    for device in self.devices.values():
+      if device.kind == "power":
+        device.integrate(now)
+      device.pending_kwh = 0.0
+
+
+  def attribute(self, house_kwh, energy_cost_cents, now):
+    device_kwh = 0.0
+    for device in self.devices.values():
+      if device.kind == "power":
+        device.integrate(now)
+      device_kwh += device.pending_kwh
+
+    scale = 1.0
+    if device_kwh > house_kwh:
+      scale = max(0.0, house_kwh) / device_kwh
+    price = energy_cost_cents / house_kwh if house_kwh > 0 else 0.0
+
+    for device in self.devices.values():
+      kwh = device.pending_kwh * scale
+      device.energy_kwh += kwh
+      device.cost_euro += kwh * price / 100
+      device.pending_kwh = 0.0
+    rest_kwh = max(0.0, house_kwh - device_kwh * scale)
+    self.rest.energy_kwh += rest_kwh
+    self.rest.cost_euro += rest_kwh * price / 100
+
+
+  def publish(self, kwargs=None):
+    total_euro = sum(device.cost_euro for device in self.devices.values()) + self.rest.cost_euro
+    for device in list(self.devices.values()) + [self.rest]:
+      self.publisher.publish(device.sensor_id, round(device.cost_euro, 2), attributes={
+          "energy_kwh": round(device.energy_kwh, 2),
+          "share": round(device.cost_euro / total_euro, 3) if total_euro > 0 else None,
+          "unit_of_measurement": "€",
+          "friendly_name": f"Energy cost {device.name.replace('_', ' ')}",
+          "icon": "mdi:currency-eur",
+          "state_class": "total_increasing"
+      })
+
+
+  def restore_from_sensors(self):
+    # First start without a checkpoint, continue from the published sensors once
+    for device in list(self.devices.values()) + [self.rest]:
+      state = self.app.get_state(device.sensor_id, attribute="all") or {}
+      try:
+        device.cost_euro = float(state.get("state"))
+        device.energy_kwh = float((state.get("attributes") or {}).get("energy_kwh", 0.0))
+      except (TypeError, ValueError):
+        continue
+
+
+  def totals(self):
+    # name -> [kWh, euro], for the checkpoint
+    return {device.name: [device.energy_kwh, device.cost_euro] for device in list(self.devices.values()) + [self.rest]}
+
+
+  def restore(self, totals):
+    for device in list(self.devices.values()) + [self.rest]:
+      if device.name in totals:
+        device.energy_kwh, device.cost_euro = totals[device.name]
@@ -1,282 +1,634 @@
-import appdaemon.plugins.hass.hassapi as hass
-from datetime import datetime, timedelta
-
-
-
-class EnergyCalculations(hass.Hass):
-   vaasa_elektriska_monthly_cost   = 4.00    # Vaasa elektriska monthly subscription cost in euro
-   electric_grid_monthly_cost      = 52.11   # Electric grid connection monthly cost in euro
-
-   day_transfer_charge           = 3.87      # Grid transfer cost in cent/kWh from 07 - 22
-   night_transfer_charge         = 1.31      # Grid transfer cost in cent/kWh from 22 - 07
-   vaasa_elektriska_transfer_charge = 0.41   # Vaasa elektriska pörssisähkö transfer charge in cent/kWh
-   electricity_tax      = 2.87               # Electricity tax c/kWh
-                                             # Currently not in use
-
-   update_interval_minutes = 1               # How often the energy calculations will be updated
-
-   entity_id_running_energy_costs = "sensor.running_energy_costs"
-   entity_id_nordpool_sensor  = "sensor.nordpool_kwh_fi_eur_3_10_024"
-
-   day_transfer_charge_id = "input_number.day_transfer_charge"
-   night_transfer_charge_id = "input_number.night_transfer_charge"
-
-   absolute_electricity_price_c_kWh_id = "sensor.electricity_price"
-   absolute_electricity_price_E_kWh_id = "sensor.electricity_price_E_kWh"
-   mean_electricity_price_c_kWh_id     = "sensor.electricity_price_mean_c_kWh"
-
-
-   def initialize(self):
-      # Calculate the next time to run the function, 1 second past the next full minute
-      now = datetime.now()
-      next_minute = now + timedelta(minutes=1)
-      start_time = next_minute.replace(second=1, microsecond=0)
-
-      self.initialize_all_parameters()
-
-      # Schedule the function to run at 1 second past every new minute
-      # self.run_every(self.main_update_routine, "now", 1)
-      self.run_every(self.main_update_routine, start_time, self.update_interval_minutes * 60)
-      # self.run_minutely(self.main_update_routine, start=start_time)
-
-
-   def initialize_all_parameters(self):
-      # Dynamically create or set default values for input_number entities only if they don't exist
-      self.create_input_number(self.day_transfer_charge_id, "Electricity Grid Day Transfer Charge", 3.87, 0.0, 10.0, 0.1)
-      self.create_input_number(self.night_transfer_charge_id, "Electricity Grid Night Transfer Charge", 1.31, 0.0, 10.0, 0.1)
-
-      self.listen_event(self.change_state, event = "call_service")
-
-      # Set up state listeners (callbacks) for when these values change
-      self.listen_state(self.input_number_changed, self.day_transfer_charge_id)
-      self.listen_state(self.input_number_changed, self.night_transfer_charge_id)
-
-
-   def update_internal_parameters(self):
-      # Update our local properties for ease of use
-      self.day_transfer_charge = float(self.get_state(self.day_transfer_charge_id))
-      self.night_transfer_charge = float(self.get_state(self.night_transfer_charge_id))
-
-
-   def change_state(self,event_name,data, kwargs):
-      entity_id = data["service_data"]["entity_id"]
-      new_value = data["service_data"].get("value")
-
-      if entity_id == self.day_transfer_charge_id:
-         self.set_state(self.day_transfer_charge_id, state=new_value)
-
-      elif entity_id == self.night_transfer_charge_id:
-         self.set_state(self.night_transfer_charge_id, state=new_value)
-
-
-   def input_number_changed(self, entity, attribute, old, new, kwargs):
-      # Log whenever an input_number value changes
-      self.log(f"{entity} changed from {old} to {new}")
-      
-      # Update the internal values after the change
-      self.update_internal_parameters()
-
-      # Allow immediate AC state update
-      self.last_state_change_time = datetime.now() - timedelta(seconds=self.min_state_change_time+1)
-
-
-   def create_input_number(self, entity_id, name, initial, min_value, max_value, step):
-      # Check if the entity already exists
-      entity_state = self.get_state(entity_id)
-      # entity_state = None
-      
-      if entity_state is None:
-         # Entity doesn't exist, so create it with the initial value
-         self.log(f"Creating {entity_id} with initial value {initial}")
-         self.set_state(entity_id, state=initial, attributes={
-            "min": min_value,
-            "max": max_value,
-            "step": step,
-            "mode": "slider",
-            #"mode": "slider-entity-row",
-            "friendly_name": name
-         })
-      #else:
-         # Entity exists, don't overwrite it
-         #self.log(f"{entity_id} already exists with value {entity_state}")
-
-
-   def main_update_routine(self, kwargs):
-      self.update_energy_price()
-      self.calculate_energy_cost()
-
-
-   def calculate_energy_cost(self):
-      if self.update_interval_minutes != 1:
-         self.log(f"### ERROR: update_interval_minutes must be 1 but is {self.update_interval_minutes}. You need to add support for that ###")
-         return
-
-      # Fetch current electricity price
-      price = self.get_state(self.absolute_electricity_price_c_kWh_id, attribute="state")
-      # Fetch total energy use (kWh) up to this point
-      current_energy_import = self.get_state("sensor.p1_meter_energy_import", attribute="state")
-      
-      # Convert to floats if not None (handles missing sensor data)
-      if price is not None and current_energy_import is not None:
-         price = float(price)
-         current_energy_import = float(current_energy_import)
-         self.log(f"Current energy value: {current_energy_import}")
-
-         # Get historical energy import value from exactly one minute ago
-         last_energy_import = self.get_last_energy_import()
-         self.log(f"Last energy value: {last_energy_import}")
-         self.log(f"Energy delta: {round(current_energy_import - last_energy_import, 3)}")
-
-         if last_energy_import is not None:
-            # Calculate the energy used in the last minute (current - previous)
-            energy_used_last_minute = current_energy_import - last_energy_import
-
-            # Calculate the cost for the energy used in the last minute (€/kWh * kWh used)
-            cost_last_minute_cents = price * energy_used_last_minute
-
-            # Calculate the cost for monthly expenses used in the last minute
-            minutes_in_month = self.calculate_minutes_in_month()
-            fixed_interval_cost_cents = (self.vaasa_elektriska_monthly_cost + self.electric_grid_monthly_cost) / minutes_in_month * 100
-            self.log(f"Fixed interval cost (vaasa elektriska + grid cost) {round(fixed_interval_cost_cents, 3)} cent")
-
-            # Fetch the current state of the sensor (convert to float, default to 0 if it doesn't exist)
-            current_cost_euro = self.get_state(self.entity_id_running_energy_costs)
-            if current_cost_euro is None:
-               current_cost_euro = 0.0
-            else:
-               current_cost_euro = float(current_cost_euro)
-               
-            self.log(f"Current cost: {round(current_cost_euro, 2)}")
-
-            # Add the cost for the last interval
-            new_cost_euro = current_cost_euro + (cost_last_minute_cents / 100) + (fixed_interval_cost_cents / 100)
-
-            # Add the monthly cost for the last interval
-            
-            self.log(f"Energy used last minute: {energy_used_last_minute:.6f} kWh, Price: {price:.6f} c/kWh, Cost: {cost_last_minute_cents:.6f} cents, Total cost: {new_cost_euro} euro")
-               
-            # Store the cost as an entity in Home Assistant (sensor entity)
-            self.set_state(self.entity_id_running_energy_costs, state=new_cost_euro, attributes={
-               "unit_of_measurement": "€",
-               "friendly_name": "Running Energy Costs",
-               "icon": "mdi:currency-eur",
-               "state_class": "total_increasing"
-            })
-         else:
-               self.log("No historical data found for the previous minute, skipping calculation.")
-      else:
-         self.log("Missing data from one or more sensors, skipping this minute.")
-
-
-   def get_last_energy_import(self):
-      # Fetch the historical data for sensor.p1_meter_energy_import exactly one minute ago
-      now = datetime.now()
-      one_minute_ago = now - timedelta(minutes=1)
-      
-      history = self.get_history(entity_id="sensor.p1_meter_energy_import", start_time=one_minute_ago, end_time=now)
-      # self.log(f"History: {history}")
-      
-      if history and len(history[0]) > 0:
-         # Return the state of the entity at the latest historical entry one minute ago
-         return float(history[0][0]['state'])
-      else:
-         return None
-
-
-   def update_energy_price(self):
-    current_hour = datetime.now().hour
-    hourly_prices = self.calculate_hourly_prices()
-    price_now = hourly_prices[current_hour]
-    mean_price = self.calculate_mean_value(hourly_prices)
-
-    self.set_state(self.absolute_electricity_price_c_kWh_id, state=price_now, attributes={
-        "unit_of_measurement": "c/kWh",
-        "friendly_name": "Electricity price history"
-    })
-
-    self.set_state(self.absolute_electricity_price_E_kWh_id, state=price_now/100, attributes={
-        "unit_of_measurement": "E/kWh",
-        "friendly_name": "Electricity price history Euro/kWh"
-    })
-
-    self.set_state(self.mean_electricity_price_c_kWh_id, state=mean_price, attributes={
-        "unit_of_measurement": "c/kWh",
-        "friendly_name": "Electricity price mean history Cent/kWh"
-    })
-
-
-   def calculate_hourly_prices(self):
-      today = self.get_state(self.entity_id_nordpool_sensor, attribute="today")
-      tomorrow_valid = self.get_state(self.entity_id_nordpool_sensor, attribute="tomorrow_valid")
-      tomorrow = self.get_state(self.entity_id_nordpool_sensor, attribute="tomorrow")
-      if (tomorrow_valid == True):
-         hourly_prices = today + tomorrow
-      else:
-         # Hacky solution to allow calculations any time of the day, even when tomorrow is not available
-         # Will probably yield acceptable results for the morning/early day, but can be way off in afternoon/evening
-         # The hope is that the next day pricing will have arrived by then
-         # self.log(f"No price for tomorrow, using todays prices as estimation for tomorrow")
-         hourly_prices = today + today
-
-      # self.log(f"Today+tomorrow base prices {len(hourly_prices)} items: {hourly_prices}")
-
-      # Add the Vaasa Elektriska fixed transfer charge
-      for i in range(len(hourly_prices)):
-         hourly_prices[i] = hourly_prices[i] + self.vaasa_elektriska_transfer_charge
-
-      # Add the electricity tax
-      #for i in range(len(hourly_prices)):
-      #   hourly_prices[i] = hourly_prices[i] + self.electricity_tax
-
-      # Add the night / day grid transfer charge
-      for i in range(len(hourly_prices)):
-         if ( (i % 24) >= 22 or (i % 24) < 7):
-            # Night transfer charge
-            hourly_prices[i] = hourly_prices[i] + self.night_transfer_charge
-         else:
-            # Day transfer charge
-            hourly_prices[i] = hourly_prices[i] + self.day_transfer_charge
-
-      for i in range(len(hourly_prices)):
-         # Safety in case once in a blue moon we get negative prices
-         # Setting it to 0 will avoid any strange calculations later on
-         # This will have minimal effect in practice and will almost never be applied
-         if (hourly_prices[i] < 0):
-            hourly_prices[i] = 0
-
-      # Round each price to one decimal place
-      hourly_prices = [round(price, 1) for price in hourly_prices]
-
-      return hourly_prices
-   
-
-   def calculate_mean_value(self, item_list):
-      # Calculate the mean value of the hourly prices
-      if item_list:  # Check if the list is not empty
-         mean_value = sum(item_list) / len(item_list)
-      else:
-         mean_value = 0  # or handle empty list case appropriately
-      mean_value = round(mean_value, 1)
-      return mean_value
-   
-
-   def calculate_minutes_in_month(self):
-      # Get the current date
-      now = datetime.now()
-
-      # Get the first day of the next month
-      if now.month == 12:
-         next_month = datetime(now.year + 1, 1, 1)
-      else:
-         next_month = datetime(now.year, now.month + 1, 1)
-
-      # Calculate the number of days in the current month
-      days_in_month = (next_month - datetime(now.year, now.month, 1)).days
-
-      # Number of minutes in a day
-      minutes_per_day = 24 * 60
-
-      # Calculate total minutes in the current month
-      minutes_in_month = days_in_month * minutes_per_day
-
+import appdaemon.plugins.hass.hassapi as hass
+import json
+import os
+from datetime import datetime, timedelta
+from StatePublisher import StatePublisher
+from TimeSeriesStore import get_series
+from Instrumentation import Instrumentation
+from TickLog import TickLog
+from ParameterRegistry import ParameterRegistry
+from EnergyCostRecompute import EnergyCostRecompute
+from CostAttribution import CostAttribution
+
+
+
+class EnergyCalculations(hass.Hass):
+   vaasa_elektriska_monthly_cost   = 4.00    # Vaasa elektriska monthly subscription cost in euro
+   electric_grid_monthly_cost      = 52.11   # Electric grid connection monthly cost in euro
+
+   day_transfer_charge           = 3.87      # Grid transfer cost in cent/kWh from 07 - 22
+   night_transfer_charge         = 1.31      # Grid transfer cost in cent/kWh from 22 - 07
+   vaasa_elektriska_transfer_charge = 0.41   # Vaasa elektriska pörssisähkö transfer charge in cent/kWh
+   electricity_tax      = 2.87               # Electricity tax c/kWh
+                                             # Currently not in use
+   vat_multiplier       = 1.255              # VAT multiplier, currently not in use
+
+   # Tariff composition applied to every spot price (c/kWh), in this order:
+   #   ("add", attribute)                       adds the value of the attribute to every hour
+   #   ("day_night", day_attribute, night_attribute) adds the day charge 07 - 22 and the night charge 22 - 07
+   #   ("multiply", attribute)                  multiplies every hour with the value of the attribute
+   # The components are folded into one adder and one multiplier per hour of the day, so adding a tax or
+   # VAT component does not add another pass over the prices
+   tariff_components = [
+      ("add", "vaasa_elektriska_transfer_charge"),
+      #("add", "electricity_tax"),
+      ("day_night", "day_transfer_charge", "night_transfer_charge"),
+      #("multiply", "vat_multiplier"),
+   ]
+
+   update_interval_minutes = 1               # How often the energy calculations will be updated
+   publish_max_age = 900                     # Rewrite unchanged price sensors after this many seconds, so they survive an HA restart
+
+   entity_id_running_energy_costs = "sensor.running_energy_costs"
+   entity_id_nordpool_sensor  = "sensor.nordpool_kwh_fi_eur_3_10_024"
+   entity_id_energy_import    = "sensor.p1_meter_energy_import"
+   entity_id_energy_costs_recompute = "sensor.energy_costs_recompute"
+
+   energy_import_seed_minutes = 5            # How many minutes of recorder history to seed the reading buffer with at startup
+
+   time_series_capacity       = 16384        # Values kept per series in the TimeSeriesStore, about 11 days of minutes
+   time_series_retention      = 7 * 24 * 3600  # Seconds of history kept per series
+   time_series_directory      = None         # Directory to persist the series in across restarts, apps.yaml arg, None keeps them in memory
+
+   # The running cost is kept in memory and checkpointed to an append-only file, apps.yaml arg checkpoint_file. The
+   # file is live data, keep it out of the apps directory. Without a file the running cost continues from the HA
+   # sensor after a restart
+   checkpoint_file               = None
+   checkpoint_interval_minutes   = 5         # How often the running cost is written to the checkpoint file
+   checkpoint_max_lines          = 1000      # Rewrite the checkpoint file with only the last checkpoint when it gets this long
+
+   # Bulk recompute of the costs of a date range from the recorder history, see EnergyCostRecompute.py. Fire the event
+   # energy_costs_recompute with start and optionally end (ISO dates or times, end defaults to now). With apply: true
+   # the running cost is replaced by the recomputed total, the range then has to start when the counting started and
+   # end now. One chunk of history is processed per callback, so the minute ticks keep running in between. The per
+   # hour and per month tables are written as CSV files to recompute_directory, apps.yaml arg, keep it out of the apps
+   # directory. Without a directory only the monthly totals are published in sensor.energy_costs_recompute
+   recompute_event               = "energy_costs_recompute"
+   recompute_chunk_days          = 1         # Days of recorder history per get_history call, apps.yaml arg
+   recompute_directory           = None
+
+   # Cost of sub-metered devices against the rest of the house, see CostAttribution.py. apps.yaml arg cost_devices, a
+   # list of devices with name, entity_id, type (power or energy) and unit
+   cost_devices                  = []
+   cost_attribution_interval     = 300       # Seconds between the batched updates of the device cost sensors, apps.yaml arg
+
+   # Tick duration, scheduler lag and API call sensors and Prometheus text endpoint, see Instrumentation.py
+   # apps.yaml args instrumentation_interval (0, the default, disables the sensors) and metrics_endpoint (empty
+   # disables it)
+   instrumentation_interval      = 0
+   metrics_endpoint              = "energy_calculations_metrics"
+
+   # One structured log record per tick, see TickLog.py. apps.yaml args log_level (debug, info, changes or errors)
+   # and log_sample_every (ticks between two records without a decision in the info log level)
+   log_level                     = "info"
+   log_sample_every              = 15
+
+   day_transfer_charge_id = "input_number.day_transfer_charge"
+   night_transfer_charge_id = "input_number.night_transfer_charge"
+
+   # The transfer charges as input_number entities, see ParameterRegistry.py
+   parameters = [
+      {"name": "day_transfer_charge", "friendly_name": "Electricity Grid Day Transfer Charge", "initial": 3.87, "min": 0.0, "max": 10.0, "step": 0.1},
+      {"name": "night_transfer_charge", "friendly_name": "Electricity Grid Night Transfer Charge", "initial": 1.31, "min": 0.0, "max": 10.0, "step": 0.1},
+   ]
+
+   absolute_electricity_price_c_kWh_id = "sensor.electricity_price"
+   absolute_electricity_price_E_kWh_id = "sensor.electricity_price_E_kWh"
+   mean_electricity_price_c_kWh_id     = "sensor.electricity_price_mean_c_kWh"
+
+
+   def initialize(self):
+      # Calculate the next time to run the function, 1 second past the next full minute
+      now = datetime.now()
+      next_minute = now + timedelta(minutes=1)
+      start_time = next_minute.replace(second=1, microsecond=0)
+
+      # Skips writes of unchanged price sensors, see StatePublisher.py
+      self.publisher = StatePublisher(self, max_age=self.args.get("publish_max_age", self.publish_max_age))
+      self.instrumentation = Instrumentation(self, "energy_calculations", self.publisher,
+                                             publish_interval=self.args.get("instrumentation_interval", self.instrumentation_interval),
+                                             endpoint=self.args.get("metrics_endpoint", self.metrics_endpoint))
+      self.main_update_routine = self.instrumentation.timed("main_update_routine", self.main_update_routine)
+      self.tick_log = TickLog(self, level=self.args.get("log_level", self.log_level),
+                              sample_every=self.args.get("log_sample_every", self.log_sample_every))
+
+      self.parameter_registry = ParameterRegistry(self, self.parameters, on_change=self.parameter_changed)
+
+      # Today+tomorrow tariff vector with one price per market time unit (slot), rebuilt only when the nordpool prices
+      # or the charge parameters change
+      self.tariff_cache = None
+      self.tariff_cache_key = None
+      self.tariff_cache_mean = None
+      self.tariff_cache_start = None     # Timezone aware start time of the first slot in the vector (today 00:00)
+      self.tariff_cache_slot_minutes = 60
+      self.tariff_cache_dirty = True
+      self.listen_state(self.nordpool_prices_changed, self.entity_id_nordpool_sensor, attribute="all")
+
+      # (time, kWh) P1 meter readings and the prices, filled by a state listener instead of querying the recorder
+      # The series are shared with the other apps, see TimeSeriesStore.py
+      directory = self.args.get("time_series_directory", self.time_series_directory)
+      self.energy_import_readings = get_series(self.entity_id_energy_import, capacity=self.time_series_capacity,
+                                               retention=self.time_series_retention, directory=directory)
+      self.price_history = get_series(self.absolute_electricity_price_c_kWh_id, capacity=self.time_series_capacity,
+                                      retention=self.time_series_retention, directory=directory)
+      # Meter reading and time up to which the energy cost has already been calculated
+      self.last_energy_import = None
+      self.last_cost_time = None
+      self.price_now = None
+      self.seed_energy_import_readings()
+      self.listen_state(self.energy_import_changed, self.entity_id_energy_import)
+
+      # Running cost in euro, continued from the last checkpoint. The minutes between the checkpoint and now are
+      # back-filled by the first calculate_energy_cost, from the meter reading difference
+      self.checkpoint_file = self.args.get("checkpoint_file", self.checkpoint_file)
+      if self.checkpoint_file:
+         os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_file)), exist_ok=True)
+      self.checkpoint_lines = 0
+      self.last_checkpoint_time = None
+      self.running_cost_euro = None
+      self.cost_attribution = None
+      cost_devices = self.args.get("cost_devices", self.cost_devices)
+      if cost_devices:
+         self.cost_attribution = CostAttribution(self, self.publisher, cost_devices,
+                                                 publish_interval=self.args.get("cost_attribution_interval", self.cost_attribution_interval))
+      self.load_checkpoint()
+
+      self.recompute_directory = self.args.get("recompute_directory", self.recompute_directory)
+      self.recompute = None                  # Running EnergyCostRecompute and the event that started it
+      self.recompute_data = None
+      self.listen_event(self.recompute_requested, self.recompute_event)
+
+      # Schedule the function to run at 1 second past every new minute
+      # self.run_every(self.main_update_routine, "now", 1)
+      self.run_every(self.instrumentation.periodic(self.main_update_routine, start_time, self.update_interval_minutes * 60),
+                     start_time, self.update_interval_minutes * 60)
+      # self.run_minutely(self.main_update_routine, start=start_time)
+
+
+   def parameter_changed(self, name, old, new):
+      # The transfer charges are part of the tariff vector
+      self.tariff_cache_dirty = True
+
+
+   def nordpool_prices_changed(self, entity, attribute, old, new, kwargs):
+      # The nordpool state also changes every hour, the cache key decides if the prices really changed
+      self.tariff_cache_dirty = True
+
+
+   def main_update_routine(self, kwargs, nordpool=None):
+      # nordpool is the full state of the nordpool sensor when EnergyCalculationsAsync already read it
+      self.tick_log.start("main_update_routine")
+      try:
+         self.update_energy_price(nordpool)
+         self.calculate_energy_cost()
+         self.tick_log.detail("State writes: %s written, %s unchanged writes suppressed since startup",
+                              self.publisher.writes, self.publisher.suppressed)
+      finally:
+         self.tick_log.finish()
+
+
+   def seed_energy_import_readings(self):
+      # The only recorder query, used once at startup so the first interval after a restart is not lost
+      # Not needed when the persisted series already has a reading from the seed window
+      now = datetime.now()
+      start_time = now - timedelta(minutes=self.energy_import_seed_minutes)
+      latest = self.energy_import_readings.latest()
+      if latest is not None and latest[0] >= start_time.timestamp():
+         self.last_energy_import = latest[1]
+         self.log(f"Energy import series already has a reading from {datetime.fromtimestamp(latest[0])}, not seeding")
+         return
+
+      history = self.get_history(entity_id=self.entity_id_energy_import, start_time=start_time, end_time=now)
+
+      if history and len(history[0]) > 0:
+         for entry in history[0]:
+            self.add_energy_import_reading(entry['state'], datetime.fromisoformat(entry['last_changed']).astimezone().replace(tzinfo=None))
+      else:
+         self.add_energy_import_reading(self.get_state(self.entity_id_energy_import), now)
+
+      latest = self.energy_import_readings.latest()
+      if latest is not None:
+         self.last_energy_import = latest[1]
+      self.log(f"Seeded energy import series, {len(self.energy_import_readings)} readings")
+
+
+   def energy_import_changed(self, entity, attribute, old, new, kwargs):
+      self.add_energy_import_reading(new, datetime.now())
+
+
+   def add_energy_import_reading(self, state, timestamp):
+      # Skip unknown / unavailable meter states
+      try:
+         reading = float(state)
+      except (TypeError, ValueError):
+         return
+      self.energy_import_readings.append(timestamp, reading)
+
+
+   def calculate_energy_cost(self):
+      if self.update_interval_minutes != 1:
+         self.tick_log.error("### ERROR: update_interval_minutes must be 1 but is %s. You need to add support for that ###", self.update_interval_minutes)
+         return
+
+      now = datetime.now()
+      # Price of this minute from update_energy_price, latest total energy use (kWh) from the reading buffer
+      price = self.price_now
+      current_energy_import = self.get_current_energy_import()
+      if price is None or current_energy_import is None:
+         self.tick_log.error("Missing data from one or more sensors, skipping this minute.")
+         return
+
+      last_energy_import = self.last_energy_import
+      self.tick_log.set("energy", current_energy_import)
+      self.tick_log.set("last_energy", last_energy_import)
+
+      if last_energy_import is not None and current_energy_import < last_energy_import:
+         # The meter was reset or replaced, start counting again from the new reading
+         self.tick_log.error("Energy import went backwards from %s to %s, resetting", last_energy_import, current_energy_import)
+         last_energy_import = None
+
+      if last_energy_import is None or self.last_cost_time is None:
+         self.tick_log.detail("No previous energy reading yet, skipping calculation.")
+         self.last_energy_import = current_energy_import
+         self.last_cost_time = now
+         if self.cost_attribution is not None:
+            self.cost_attribution.discard(now)
+         return
+
+      # Usually one minute, more after a skipped tick or a restart
+      energy_cost_cents, fixed_cost_cents = self.interval_cost_cents(self.last_cost_time, last_energy_import, now, current_energy_import, price)
+      cost_cents = energy_cost_cents + fixed_cost_cents
+      if self.cost_attribution is not None:
+         self.cost_attribution.attribute(current_energy_import - last_energy_import, energy_cost_cents, now)
+      self.last_energy_import = current_energy_import
+      self.last_cost_time = now
+      self.running_cost_euro += cost_cents / 100
+
+      self.tick_log.set("price", price)
+      self.tick_log.set("cost_cents", cost_cents)
+      self.tick_log.set("total_euro", self.running_cost_euro)
+
+      self.publish_running_cost()
+
+      if self.last_checkpoint_time is None or now - self.last_checkpoint_time >= timedelta(minutes=self.checkpoint_interval_minutes):
+         self.write_checkpoint()
+
+
+   def publish_running_cost(self):
+      # Store the cost as an entity in Home Assistant (sensor entity)
+      self.publisher.publish(self.entity_id_running_energy_costs, self.running_cost_euro, attributes={
+         "unit_of_measurement": "€",
+         "friendly_name": "Running Energy Costs",
+         "icon": "mdi:currency-eur",
+         "state_class": "total_increasing"
+      })
+
+
+   def recompute_requested(self, event_name, data, kwargs):
+      try:
+         start = self.local_time(data["start"])
+         end = self.local_time(data["end"]) if data.get("end") else datetime.now()
+      except (KeyError, TypeError, ValueError) as error:
+         self.log(f"Invalid {event_name} event {data}: {error}", level="WARNING")
+         return
+      if start >= end:
+         self.log(f"Invalid {event_name} event {data}: start is not before end", level="WARNING")
+         return
+      if self.recompute is not None:
+         self.log(f"Ignoring {event_name} event {data}, the recompute from {self.recompute.start} is still running", level="WARNING")
+         return
+
+      self.recompute = EnergyCostRecompute(self, chunk_days=self.args.get("recompute_chunk_days", self.recompute_chunk_days))
+      self.recompute.begin(start, end)
+      self.recompute_data = data
+      self.log(f"Recomputing the energy costs from {start} to {end}")
+      self.run_in(self.recompute_next_chunk, 0)
+
+
+   def recompute_next_chunk(self, kwargs):
+      # One get_history round trip per callback, the worker thread is released in between like in ThermalModelLearner
+      if not self.recompute.process_chunk():
+         self.run_in(self.recompute_next_chunk, 1)
+         return
+
+      recompute, data = self.recompute, self.recompute_data
+      self.recompute = None
+      self.recompute_data = None
+      start, end = recompute.start, recompute.end
+      hours, months, summary = recompute.results()
+      self.log(f"Recomputed the energy costs from {start} to {end}: {summary}")
+
+      files = []
+      if self.recompute_directory:
+         os.makedirs(self.recompute_directory, exist_ok=True)
+         name = f"{start:%Y%m%d%H%M}_{end:%Y%m%d%H%M}"
+         for table, rows in [("hours", hours), ("months", months)]:
+            path = os.path.join(self.recompute_directory, f"energy_costs_{table}_{name}.csv")
+            recompute.write_csv(path, rows)
+            files.append(path)
+
+      self.publisher.publish(self.entity_id_energy_costs_recompute, summary["total_euro"], attributes=dict(summary, **{
+         "months": {row[0]: row[4] for row in months},
+         "files": files,
+         "unit_of_measurement": "€",
+         "friendly_name": "Recomputed energy costs"
+      }))
+
+      if data.get("apply"):
+         if data.get("end") or recompute.last_reading is None:
+            self.log("Not applying the recomputed costs, the range has to end now and have meter readings", level="WARNING")
+            return
+         # Continue counting from the newest reading the recompute used
+         self.running_cost_euro = summary["total_euro"]
+         self.last_energy_import = recompute.last_reading[1]
+         self.last_cost_time = end
+         self.publish_running_cost()
+         self.write_checkpoint()
+         self.log(f"Running cost replaced by the recomputed {self.running_cost_euro} euro")
+
+
+   def local_time(self, value):
+      # Naive local time of an ISO date or time, with or without offset
+      timestamp = datetime.fromisoformat(str(value))
+      if timestamp.tzinfo is not None:
+         timestamp = timestamp.astimezone().replace(tzinfo=None)
+      return timestamp
+
+
+   def interval_cost_cents(self, start_time, start_energy, end_time, end_energy, price_now):
+      # Energy and fixed monthly costs from start_time to end_time, one pass over the minutes in between
+      # The energy of every minute comes from the reading series, the price from the price series, so a gap after a
+      # restart is priced like the minutes would have been. Minutes without readings get an equal share of the energy
+      minutes = max(1, round((end_time - start_time).total_seconds() / 60))
+      if minutes > 1:
+         self.tick_log.decision("Back-filling %s minutes of energy cost since %s", minutes, start_time)
+
+      energy_cost_cents = 0.0
+      fixed_cost_cents = 0.0
+      previous_energy = start_energy
+      for minute in range(1, minutes + 1):
+         if minute == minutes:
+            minute_time, energy, price = end_time, end_energy, price_now
+         else:
+            minute_time = start_time + (end_time - start_time) * minute / minutes
+            energy = self.energy_import_readings.value_at(minute_time)
+            if energy is None or energy < previous_energy or energy > end_energy:
+               energy = start_energy + (end_energy - start_energy) * minute / minutes
+            price = self.price_history.value_at(minute_time)
+            if price is None:
+               price = price_now
+
+         # Cost for the energy used in this minute (c/kWh * kWh used) and the monthly expenses of one minute
+         fixed_interval_cost_cents = (self.vaasa_elektriska_monthly_cost + self.electric_grid_monthly_cost) / self.calculate_minutes_in_month(minute_time) * 100
+         energy_cost_cents += price * (energy - previous_energy)
+         fixed_cost_cents += fixed_interval_cost_cents
+         previous_energy = energy
+
+      return energy_cost_cents, fixed_cost_cents
+
+
+   def load_checkpoint(self):
+      # The last complete line of the checkpoint file, a line cut off by a crash is ignored
+      checkpoint = None
+      if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+         with open(self.checkpoint_file) as checkpoint_file:
+            for line in checkpoint_file:
+               self.checkpoint_lines += 1
+               try:
+                  checkpoint = json.loads(line)
+               except ValueError:
+                  continue
+
+      if checkpoint is None:
+         # First start, continue from the HA sensor once
+         current_cost_euro = self.get_state(self.entity_id_running_energy_costs)
+         try:
+            self.running_cost_euro = float(current_cost_euro)
+         except (TypeError, ValueError):
+            self.running_cost_euro = 0.0
+         if self.last_energy_import is not None:
+            self.last_cost_time = datetime.now()
+         if self.cost_attribution is not None:
+            self.cost_attribution.restore_from_sensors()
+         self.log(f"No running cost checkpoint, starting from {round(self.running_cost_euro, 2)} euro")
+         return
+
+      self.running_cost_euro = checkpoint["cost"]
+      self.last_energy_import = checkpoint["energy_import"]
+      self.last_cost_time = datetime.fromisoformat(checkpoint["time"])
+      self.last_checkpoint_time = self.last_cost_time
+      if self.cost_attribution is not None:
+         self.cost_attribution.restore(checkpoint.get("devices", {}))
+      self.log(f"Running cost {round(self.running_cost_euro, 2)} euro from the checkpoint of {self.last_cost_time}")
+
+
+   def write_checkpoint(self):
+      if not self.checkpoint_file or self.last_cost_time is None:
+         return
+      checkpoint = {"time": self.last_cost_time.isoformat(), "cost": self.running_cost_euro, "energy_import": self.last_energy_import}
+      if self.cost_attribution is not None:
+         checkpoint["devices"] = self.cost_attribution.totals()
+      line = json.dumps(checkpoint) + "\n"
+
+      if self.checkpoint_lines >= self.checkpoint_max_lines:
+         # Replace the file with only the newest checkpoint, the rename keeps either the old or the new file on a crash
+         temporary_file = self.checkpoint_file + ".tmp"
+         with open(temporary_file, "w") as checkpoint_file:
+            checkpoint_file.write(line)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+         os.replace(temporary_file, self.checkpoint_file)
+         self.checkpoint_lines = 1
+      else:
+         with open(self.checkpoint_file, "a") as checkpoint_file:
+            checkpoint_file.write(line)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+         self.checkpoint_lines += 1
+      self.last_checkpoint_time = self.last_cost_time
+
+
+   def terminate(self):
+      # Called by AppDaemon when the app is stopped or reloaded
+      self.write_checkpoint()
+      # Write the persisted histories to disk, the kernel would otherwise decide when
+      self.energy_import_readings.flush()
+      self.price_history.flush()
+
+
+   def get_current_energy_import(self):
+      # Newest reading delivered by the state listener
+      latest = self.energy_import_readings.latest()
+      if latest is None:
+         return None
+      return latest[1]
+
+
+   def update_energy_price(self, nordpool=None):
+    slot_prices = self.calculate_slot_prices(nordpool)
+    if slot_prices is None:
+      # No prices yet, calculate_energy_cost waits and back-fills the minutes once they are there
+      self.price_now = None
+      return
+    price_now = slot_prices[self.slot_index(datetime.now())]
+    mean_price = self.tariff_cache_mean
+    self.price_now = price_now
+    self.price_history.append(datetime.now(), price_now)
+
+    self.publisher.publish(self.absolute_electricity_price_c_kWh_id, price_now, attributes={
+        "unit_of_measurement": "c/kWh",
+        "friendly_name": "Electricity price history"
+    })
+
+    self.publisher.publish(self.absolute_electricity_price_E_kWh_id, price_now/100, attributes={
+        "unit_of_measurement": "E/kWh",
+        "friendly_name": "Electricity price history Euro/kWh"
+    })
+
+    # The full today+tomorrow vector is published as well, for planning ahead in ACController
+    # Slot i starts at start + i * slot_minutes, the start is timezone aware so the index also holds on DST days
+    self.publisher.publish(self.mean_electricity_price_c_kWh_id, mean_price, attributes={
+        "unit_of_measurement": "c/kWh",
+        "friendly_name": "Electricity price mean history Cent/kWh",
+        "prices": slot_prices,
+        "start": self.tariff_cache_start.isoformat(),
+        "slot_minutes": self.tariff_cache_slot_minutes
+    })
+
+
+   def slot_index(self, timestamp):
+      # Slot of the tariff vector a time falls in, the slots are uniform in UTC so this is one division
+      if timestamp.tzinfo is None:
+         timestamp = timestamp.astimezone()
+      index = int((timestamp - self.tariff_cache_start).total_seconds() // (self.tariff_cache_slot_minutes * 60))
+      return max(0, min(len(self.tariff_cache) - 1, index))
+
+
+   def calculate_slot_prices(self, nordpool=None):
+      # Served from the tariff cache, which is only rebuilt when the listeners marked it dirty and the inputs really changed
+      if not self.tariff_cache_dirty:
+         return self.tariff_cache
+
+      if nordpool is None:
+         nordpool = self.get_state(self.entity_id_nordpool_sensor, attribute="all")
+      attributes = (nordpool or {}).get("attributes") or {}
+      if not attributes.get("raw_today") and not attributes.get("today"):
+         # Nordpool sensor missing or unavailable, keep using the last prices if there are any
+         self.tick_log.error("No prices from %s", self.entity_id_nordpool_sensor)
+         return self.tariff_cache
+      today_start, slot_minutes, today, tomorrow = self.nordpool_prices(attributes, datetime.now())
+
+      if tomorrow:
+         base_prices = today + tomorrow
+      else:
+         # Hacky solution to allow calculations any time of the day, even when tomorrow is not available
+         # Will probably yield acceptable results for the morning/early day, but can be way off in afternoon/evening
+         # The hope is that the next day pricing will have arrived by then
+         # self.log(f"No price for tomorrow, using todays prices as estimation for tomorrow")
+         base_prices = today + today
+
+      # The date is part of the key, the vector always starts at today 00:00
+      key = (today_start, slot_minutes, tuple(base_prices), self.tariff_parameters())
+      if key != self.tariff_cache_key:
+         self.tariff_cache = self.build_tariff_vector(base_prices, today_start, slot_minutes)
+         self.tariff_cache_mean = self.calculate_mean_value(self.tariff_cache)
+         self.tariff_cache_key = key
+         self.tariff_cache_start = today_start
+         self.tariff_cache_slot_minutes = slot_minutes
+         self.tick_log.decision("Rebuilt tariff vector with %s prices of %s minutes, mean %s c/kWh",
+                                len(self.tariff_cache), slot_minutes, self.tariff_cache_mean)
+
+      self.tariff_cache_dirty = False
+      return self.tariff_cache
+
+
+   def nordpool_prices(self, attributes, now):
+      # (today_start, slot_minutes, today, tomorrow) from the nordpool attributes valid at now, tomorrow is empty
+      # until the prices of tomorrow are valid
+      # Offset of local midnight, which differs from the offset of now on DST days
+      today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).astimezone()
+      tomorrow_valid = attributes.get("tomorrow_valid")
+
+      if attributes.get("raw_today"):
+         # Slots with explicit start and end times, any market time unit and 23 or 25 hour days
+         raw_today = attributes["raw_today"]
+         slot_minutes = int((datetime.fromisoformat(str(raw_today[0]["end"])) - datetime.fromisoformat(str(raw_today[0]["start"]))).total_seconds() // 60)
+         today = [slot["value"] for slot in raw_today]
+         tomorrow = [slot["value"] for slot in attributes.get("raw_tomorrow") or []]
+         today_start = datetime.fromisoformat(str(raw_today[0]["start"]))
+      else:
+         # Plain price lists starting at local midnight, the slot width follows from the number of prices per day
+         today = attributes["today"]
+         tomorrow = attributes.get("tomorrow")
+         slot_minutes = max(1, round(24 * 60 / len(today) / 15) * 15)
+
+      if not (tomorrow_valid == True and tomorrow):
+         tomorrow = []
+      return today_start, slot_minutes, today, tomorrow
+
+
+   def tariff_parameters(self):
+      # Current values of every attribute used by the tariff components
+      return tuple(getattr(self, name) for component in self.tariff_components for name in component[1:])
+
+
+   def build_tariff_vector(self, base_prices, start, slot_minutes):
+      # Fold the tariff components into one adder and one multiplier per hour of the day
+      hour_adders = [0.0] * 24
+      hour_multipliers = [1.0] * 24
+      for component in self.tariff_components:
+         kind = component[0]
+         for hour in range(24):
+            if kind == "add":
+               hour_adders[hour] += getattr(self, component[1])
+            elif kind == "day_night":
+               if (hour >= 22 or hour < 7):
+                  # Night transfer charge
+                  hour_adders[hour] += getattr(self, component[2])
+               else:
+                  # Day transfer charge
+                  hour_adders[hour] += getattr(self, component[1])
+            elif kind == "multiply":
+               hour_adders[hour] *= getattr(self, component[1])
+               hour_multipliers[hour] *= getattr(self, component[1])
+
+      # Local hour of every slot, from the UTC start so the 23 and 25 hour DST days get the right day/night charge
+      slot = timedelta(minutes=slot_minutes)
+      slot_hours = [(start + i * slot).astimezone().hour for i in range(len(base_prices))]
+
+      # One pass over the prices: compose, clamp and round
+      # Negative prices are clamped to 0, once in a blue moon we get them and they would give strange calculations later on
+      return [round(max(0, price * hour_multipliers[hour] + hour_adders[hour]), 1) for price, hour in zip(base_prices, slot_hours)]
+   
+
+   def calculate_mean_value(self, item_list):
+      # Calculate the mean value of the hourly prices
+      if item_list:  # Check if the list is not empty
+         mean_value = sum(item_list) / len(item_list)
+      else:
+         mean_value = 0  # or handle empty list case appropriately
+      mean_value = round(mean_value, 1)
+      return mean_value
+   
+
+   def calculate_minutes_in_month(self, now=None):
+      # Get the current date
+      if now is None:
+         now = datetime.now()
+
+      # Get the first day of the next month
+      if now.month == 12:
+         next_month = datetime(now.year + 1, 1, 1)
+      else:
+         next_month = datetime(now.year, now.month + 1, 1)
+
+      # Calculate the number of days in the current month
+      days_in_month = (next_month - datetime(now.year, now.month, 1)).days
+
+      # Number of minutes in a day
+      minutes_per_day = 24 * 60
+
+      # Calculate total minutes in the current month
+      minutes_in_month = days_in_month * minutes_per_day
+
       return minutes_in_month
\ No newline at end of file
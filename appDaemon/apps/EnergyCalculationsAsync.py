@@ -0,0 +1,33 @@
+from EnergyCalculations import EnergyCalculations
+
+
+#
+# Energy calculations app, asyncio variant
+#
+# The same calculations as EnergyCalculations.py with the same args, selected in apps.yaml with module:
+# EnergyCalculationsAsync and class: EnergyCalculationsAsync. A tick starts as a coroutine on the AppDaemon event
+# loop. When the tariff vector has to be rebuilt, the nordpool sensor (today, tomorrow and tomorrow_valid are all
+# attributes of it) is read there, then the price and cost calculation runs unchanged in the app's own worker thread,
+# so it never overlaps with the meter listener or the checkpoint writes. The other ticks make no read at all.
+#
+# The instrumentation measures both halves: main_update_routine is the read on the event loop, and
+# main_update_routine_prefetched the calculation in the worker thread.
+#
+
+class EnergyCalculationsAsync(EnergyCalculations):
+
+   def initialize(self):
+      EnergyCalculations.initialize(self)
+      self.main_update_routine_prefetched = self.instrumentation.timed("main_update_routine_prefetched",
+                                                                       self.main_update_routine_prefetched)
+
+
+   async def main_update_routine(self, kwargs):
+      nordpool = None
+      if self.tariff_cache_dirty:
+         nordpool = await self.get_state(self.entity_id_nordpool_sensor, attribute="all")
+      await self.run_in(self.main_update_routine_prefetched, 0, nordpool=nordpool)
+
+
+   def main_update_routine_prefetched(self, kwargs):
+      EnergyCalculations.main_update_routine(self, kwargs, kwargs.get("nordpool"))
@@ -0,0 +1,223 @@
+import csv
+import time
+from datetime import datetime, timedelta
+
+
+#
+# Energy cost recompute
+#
+# Recomputes the energy costs of any date range from the recorder history, e.g. after sensor.running_energy_costs got
+# corrupted or a tariff parameter was wrong for a month. The range is streamed in chunks of chunk_days, one
+# get_history of the P1 meter and one of the nordpool sensor per chunk, so a year of minute readings is never held in
+# memory at once; only the per hour totals are kept.
+#
+# The spot prices of every day come from the nordpool attributes recorded during the range and get the same tariff
+# composition as the live prices, build_tariff_vector of EnergyCalculations with the current tariff parameters. The
+# energy between two meter readings is priced in the slots it was used in, a gap over several slots is shared out
+# linearly like the back-fill of calculate_energy_cost does. The monthly fixed costs are added for every minute of the
+# range, with calculate_minutes_in_month.
+#
+# The split over the slots is a plain loop on purpose: the apps have no numpy, and a reading interval of a minute or
+# two falls in one slot, so the loop body runs about once per reading.
+#
+# The results are a per hour and a per month table with the columns
+#   period, energy_kwh, energy_cost_euro, fixed_cost_euro, total_euro
+# Energy used in slots without a price is counted in energy_kwh but not priced, those hours are reported as
+# missing_price_hours. The hours are whole UTC hours, which are the local hours with the Finnish time zone.
+#
+# Usage, all chunks at once:
+#   recompute = EnergyCostRecompute(app, chunk_days=1)
+#   hours, months, summary = recompute.run(start, end)
+#   recompute.write_csv(path, months)
+#
+# Or one chunk per callback, so an app's worker thread is released between the get_history calls:
+#   recompute.begin(start, end)
+#   while not recompute.process_chunk(): ...     # e.g. from run_in callbacks
+#   hours, months, summary = recompute.results()
+#
+
+class EnergyCostRecompute:
+  columns = ["period", "energy_kwh", "energy_cost_euro", "fixed_cost_euro", "total_euro"]
+
+  def __init__(self, app, chunk_days=1):
+    self.app = app
+    self.chunk_days = chunk_days
+    self.last_reading = None              # (epoch seconds, kWh) of the newest meter reading of the last run
+
+
+  def run(self, start, end):
+    # start and end are local times, returns (hours, months, summary)
+    self.begin(start, end)
+    while not self.process_chunk():
+      pass
+    return self.results()
+
+
+  def begin(self, start, end):
+    self.start = start
+    self.end = end
+    self.chunk_start = start
+    self.seconds = 0.0                    # Time spent in process_chunk, the waits between the chunks do not count
+    self.hours = {}                       # epoch seconds of the hour start -> [kWh, energy cents, fixed cents]
+    self.vectors = {}                     # date -> (epoch seconds of the first slot, slot seconds, composed prices)
+    self.vector_keys = {}                 # date -> nordpool prices the vector was composed from
+    self.vector = None                    # Vector of the last price lookup, most lookups fall in the same one
+    self.missing_price_hours = set()
+    self.last_reading = None
+    self.readings = 0
+    self.chunks = 0
+
+
+  def process_chunk(self):
+    # Reads and prices the next chunk_days of history, returns True when the whole range is done
+    started = time.perf_counter()
+    if self.chunk_start < self.end:
+      chunk_end = min(self.end, self.chunk_start + timedelta(days=self.chunk_days))
+      self.read_prices(self.chunk_start, chunk_end)
+      for reading in self.read_energy(self.chunk_start, chunk_end):
+        if self.last_reading is not None:
+          self.add_energy(self.last_reading, reading)
+        self.last_reading = reading
+        self.readings += 1
+      self.chunks += 1
+      self.chunk_start = chunk_end
+    done = self.chunk_start >= self.end
+    if done:
+      self.add_fixed_costs(self.start, self.end)
+    self.seconds += time.perf_counter() - started
+    return done
+
+
+  def results(self):
+    # (hours, months, summary) of the processed range
+    start, end = self.start, self.end
+    hours = [self.row(datetime.fromtimestamp(hour).astimezone().isoformat(), values) for hour, values in sorted(self.hours.items())]
+    month_values = {}
+    for hour, values in sorted(self.hours.items()):
+      month = month_values.setdefault(datetime.fromtimestamp(hour).strftime("%Y-%m"), [0.0, 0.0, 0.0])
+      for index in range(3):
+        month[index] += values[index]
+    months = [self.row(month, values) for month, values in month_values.items()]
+
+    totals = [sum(values[index] for values in self.hours.values()) for index in range(3)]
+    summary = dict(zip(self.columns[1:], self.row(None, totals)[1:]))
+    summary.update({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "missing_price_hours": len(self.missing_price_hours),
+        "readings": self.readings,
+        "chunks": self.chunks,
+        "seconds": round(self.seconds, 2)
+    })
+    return hours, months, summary
+
+
+  def row(self, period, values):
+    energy_kwh, energy_cents, fixed_cents = values
+    return [period, round(energy_kwh, 3), round(energy_cents / 100, 4), round(fixed_cents / 100, 4),
+            round((energy_cents + fixed_cents) / 100, 4)]
+
+
+  def local_time(self, timestamp):
+    # The recorder times are UTC, the apps work in naive local time
+    return datetime.fromisoformat(str(timestamp)).astimezone().replace(tzinfo=None)
+
+
+  def epoch_seconds(self, timestamp):
+    # Times with an offset are exact, times without one are local like in local_time
+    return datetime.fromisoformat(str(timestamp)).timestamp()
+
+
+  def read_prices(self, start, end):
+    # Every day of prices in the nordpool attributes of the chunk, today and tomorrow once it is valid
+    history = self.app.get_history(entity_id=self.app.entity_id_nordpool_sensor, start_time=start, end_time=end)
+    for entry in history[0] if history else []:
+      attributes = entry.get("attributes") or {}
+      if not attributes.get("raw_today") and not attributes.get("today"):
+        continue
+      today_start, slot_minutes, today, tomorrow = self.app.nordpool_prices(attributes, self.local_time(entry["last_changed"]))
+      # The sensor changes every slot with the same attributes, compose each day only once
+      key = (today_start, slot_minutes, tuple(today), tuple(tomorrow))
+      day = today_start.date()
+      if self.vector_keys.get(day) == key:
+        continue
+      self.vector_keys[day] = key
+      self.vectors[day] = (today_start.timestamp(), slot_minutes * 60,
+                           self.app.build_tariff_vector(today + tomorrow, today_start, slot_minutes))
+      self.vector = None
+
+
+  def read_energy(self, start, end):
+    # (epoch seconds, kWh) of the P1 meter readings in the chunk, unknown and unavailable states skipped
+    history = self.app.get_history(entity_id=self.app.entity_id_energy_import, start_time=start, end_time=end)
+    for entry in history[0] if history else []:
+      try:
+        reading = float(entry["state"])
+      except (TypeError, ValueError):
+        continue
+      yield self.epoch_seconds(entry["last_changed"]), reading
+
+
+  def price_at(self, timestamp):
+    # (price, end of its slot) of the slot a time falls in, (None, end of the hour) without a price
+    # The vector of a day also covers the next day once tomorrow's prices were valid
+    if self.vector is not None:
+      first, slot_seconds, prices = self.vector
+      index = int((timestamp - first) // slot_seconds)
+      if 0 <= index < len(prices):
+        return prices[index], first + (index + 1) * slot_seconds
+
+    day = datetime.fromtimestamp(timestamp).date()
+    for vector_day in [day, day - timedelta(days=1)]:
+      vector = self.vectors.get(vector_day)
+      if vector is None:
+        continue
+      first, slot_seconds, prices = vector
+      index = int((timestamp - first) // slot_seconds)
+      if 0 <= index < len(prices):
+        self.vector = vector
+        return prices[index], first + (index + 1) * slot_seconds
+    return None, timestamp - timestamp % 3600 + 3600
+
+
+  def add_energy(self, previous, reading):
+    start, start_energy = previous
+    end, end_energy = reading
+    energy = end_energy - start_energy
+    if energy <= 0 or end <= start:
+      # Nothing used, or the meter was reset or replaced
+      return
+
+    at = start
+    while at < end:
+      price, slot_end = self.price_at(at)
+      part_end = min(end, slot_end)
+      part = energy * (part_end - at) / (end - start)
+      hour = at - at % 3600
+      values = self.hours.setdefault(hour, [0.0, 0.0, 0.0])
+      values[0] += part
+      if price is None:
+        self.missing_price_hours.add(hour)
+      else:
+        values[1] += price * part
+      at = part_end
+
+
+  def add_fixed_costs(self, start, end):
+    # The monthly costs of every minute of the range, per hour
+    monthly_cost_euro = self.app.vaasa_elektriska_monthly_cost + self.app.electric_grid_monthly_cost
+    at = start.timestamp()
+    end = end.timestamp()
+    while at < end:
+      hour = at - at % 3600
+      minutes = (min(end, hour + 3600) - at) / 60
+      values = self.hours.setdefault(hour, [0.0, 0.0, 0.0])
+      values[2] += monthly_cost_euro / self.app.calculate_minutes_in_month(datetime.fromtimestamp(hour)) * 100 * minutes
+      at = hour + 3600
+
+
+  def write_csv(self, path, rows):
+    with open(path, "w", newline="") as csv_file:
+      writer = csv.writer(csv_file)
+      writer.writerow(self.columns)
+      writer.writerows(rows)
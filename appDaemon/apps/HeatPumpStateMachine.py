@@ -0,0 +1,115 @@
+from datetime import timedelta
+
+
+#
+# Heat pump state machine
+#
+# Decides when the AC switches between heating and off (fan only), with hysteresis and anti-short-cycle timers:
+#
+#   off      -> heating  when the room is on_band or more below the target temperature
+#   heating  -> off      when the room is off_band or more above the target temperature
+#
+# Between the two thresholds the current mode is kept, so a target that moves by half a degree with the price does
+# not switch the unit. While heating the AC keeps the room at the target with its own thermostat. A switch is only
+# made after the unit ran min_run_time seconds, or was off min_off_time seconds. The min off time is skipped when the
+# room is override_temperature_diff or more below the target, e.g. after a large price drop; the min run time is
+# never skipped, stopping a compressor early is what wears it. Every switch is counted per day.
+#
+# The state is a dict:
+#   mode            "heating" or "off"
+#   since           time of the last switch, None when unknown, e.g. at startup, which allows the next switch right away
+#   day             date the counters are for
+#   transitions     switches on that day
+#   starts          switches to heating on that day
+#   blocked_until   time a wanted switch has to wait for, None when nothing waits
+#
+# step() and force() never modify the state they get, they return a new one. Nothing is read from Home Assistant,
+# so a day of decisions can be replayed from recorded room and target temperatures with replay().
+#
+# Usage:
+#   machine = HeatPumpStateMachine(on_band=0.0, off_band=0.5, min_run_time=1800, min_off_time=1800)
+#   state = machine.initial_state("off")
+#   state, transition = machine.step(state, room_temperature, target_temperature, now)
+#
+
+class HeatPumpStateMachine:
+  modes = ["heating", "off"]
+
+  def __init__(self, on_band, off_band, min_run_time, min_off_time, override_temperature_diff=None):
+    self.on_band = on_band                                        # Degrees below the target to start heating
+    self.off_band = off_band                                      # Degrees above the target to stop heating
+    self.min_run_time = min_run_time                              # Seconds the unit heats before it may stop
+    self.min_off_time = min_off_time                              # Seconds the unit is off before it may start
+    self.override_temperature_diff = override_temperature_diff    # Degrees below the target that skip min_off_time
+
+
+  def initial_state(self, mode, since=None, day=None, transitions=0, starts=0):
+    if mode not in self.modes:
+      raise ValueError(f"Unknown heat pump mode {mode}, expected one of {', '.join(self.modes)}")
+    return {"mode": mode, "since": since, "day": day, "transitions": transitions, "starts": starts, "blocked_until": None}
+
+
+  def wanted_mode(self, mode, room_temperature, target_temperature):
+    if mode == "heating" and room_temperature >= target_temperature + self.off_band:
+      return "off"
+    if mode == "off" and room_temperature <= target_temperature - self.on_band:
+      return "heating"
+    return mode
+
+
+  def earliest_switch(self, state, room_temperature, target_temperature):
+    # Time the current mode may be left, None when it may be left right away
+    if state["since"] is None:
+      return None
+    if state["mode"] == "heating":
+      return state["since"] + timedelta(seconds=self.min_run_time)
+    if self.override_temperature_diff is not None and target_temperature - room_temperature >= self.override_temperature_diff:
+      return None
+    return state["since"] + timedelta(seconds=self.min_off_time)
+
+
+  def new_day(self, state, now):
+    if state["day"] == now.date():
+      return state
+    return dict(state, day=now.date(), transitions=0, starts=0)
+
+
+  def step(self, state, room_temperature, target_temperature, now):
+    # Returns (new state, transition), transition is "start", "stop" or None
+    state = self.new_day(state, now)
+    mode = self.wanted_mode(state["mode"], room_temperature, target_temperature)
+    if mode == state["mode"]:
+      return dict(state, blocked_until=None), None
+
+    earliest = self.earliest_switch(state, room_temperature, target_temperature)
+    if earliest is not None and now < earliest:
+      return dict(state, blocked_until=earliest), None
+    return self.switch(state, mode, now)
+
+
+  def force(self, state, mode, now):
+    # Switch without hysteresis and timers, e.g. to stop heating when the house runs out of power
+    # Returns (new state, transition) like step()
+    state = self.new_day(state, now)
+    if mode == state["mode"]:
+      return dict(state, blocked_until=None), None
+    return self.switch(state, mode, now)
+
+
+  def switch(self, state, mode, now):
+    starts = state["starts"] + 1 if mode == "heating" else state["starts"]
+    state = dict(state, mode=mode, since=now, transitions=state["transitions"] + 1, starts=starts, blocked_until=None)
+    return state, "start" if mode == "heating" else "stop"
+
+
+  def replay(self, samples, state=None):
+    # samples: (time, room temperature, target temperature) in time order
+    # Returns the final state and the list of (time, transition) of all switches
+    if state is None:
+      state = self.initial_state("off")
+    transitions = []
+    for now, room_temperature, target_temperature in samples:
+      state, transition = self.step(state, room_temperature, target_temperature, now)
+      if transition is not None:
+        transitions.append((now, transition))
+    return state, transitions
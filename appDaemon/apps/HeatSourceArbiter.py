@@ -0,0 +1,88 @@
+#
+# Heat source arbiter
+#
+# Compares the cost of one kWh of heat from every heat source of the house, for every price slot of the horizon:
+#
+#   heat_pump  electricity price / COP, the COP changes linearly with the outdoor temperature
+#   electric   electricity price / efficiency, e.g. a resistive heater or a boiler element
+#   fuel       fuel price / efficiency, e.g. a wood stove or a gas boiler, independent of the electricity price
+#
+# The heat demand of every slot is handed out to the sources cheapest first, each up to its capacity, so an expensive
+# source only takes the part of the demand the cheaper ones can not deliver. The plan is calculated once per set of
+# prices, outdoor temperatures and demands; reading the mix of a slot afterwards is a list lookup.
+#
+# Sources, all prices in c/kWh:
+#   - name: ac
+#     type: heat_pump
+#     power_kw: 1.0           electrical power, the heat output is power_kw * COP
+#     cop_intercept: 3.0      COP at 0 C outdoor
+#     cop_slope: 0.08         COP change per degree outdoor
+#     min_cop: 1.0
+#   - name: wood_stove
+#     type: fuel
+#     fuel_price: 5.0         c per kWh of fuel
+#     efficiency: 0.75
+#     capacity_kw: 8.0        heat output
+#
+
+class HeatSourceArbiter:
+  source_types = ["heat_pump", "electric", "fuel"]
+
+  def __init__(self, sources):
+    for source in sources:
+      if source.get("type") not in self.source_types:
+        raise ValueError(f"Unknown heat source type {source.get('type')} of {source.get('name')}, expected one of {', '.join(self.source_types)}")
+    self.sources = sources
+
+
+  def cop(self, source, outdoor_temperature):
+    return max(source.get("min_cop", 1.0), source.get("cop_intercept", 3.0) + source.get("cop_slope", 0.0) * outdoor_temperature)
+
+
+  def heat_cost(self, source, price, outdoor_temperature):
+    # Cost in cent of one kWh of heat, price is the electricity price of the slot
+    if source["type"] == "heat_pump":
+      return max(0, price) / self.cop(source, outdoor_temperature)
+    if source["type"] == "electric":
+      return max(0, price) / source.get("efficiency", 1.0)
+    return source["fuel_price"] / source.get("efficiency", 1.0)
+
+
+  def heat_capacity(self, source, outdoor_temperature):
+    # Heat output in kW when running, None for no limit
+    if source["type"] == "heat_pump":
+      return source.get("power_kw", 1.0) * self.cop(source, outdoor_temperature)
+    return source.get("capacity_kw")
+
+
+  def plan(self, prices, outdoor_temperatures, heat_demands_kw=None):
+    # Returns (cheapest, costs, mix), one item per slot:
+    #   cheapest  name of the cheapest source
+    #   costs     cost per kWh of heat of every source, in the order of the sources
+    #   mix       source name -> kW of heat it delivers, the demand of the slot spread cheapest first
+    # Without demands every slot gets the cheapest source for an unlimited demand
+    cheapest = []
+    costs = []
+    mix = []
+    for slot, price in enumerate(prices):
+      outdoor = outdoor_temperatures[slot]
+      slot_costs = [self.heat_cost(source, price, outdoor) for source in self.sources]
+      order = sorted(range(len(self.sources)), key=lambda index: slot_costs[index])
+      cheapest.append(self.sources[order[0]]["name"])
+      costs.append(slot_costs)
+
+      slot_mix = {}
+      if heat_demands_kw is None:
+        slot_mix[self.sources[order[0]]["name"]] = None
+      else:
+        remaining = heat_demands_kw[slot]
+        for index in order:
+          if remaining <= 0:
+            break
+          capacity = self.heat_capacity(self.sources[index], outdoor)
+          delivered = remaining if capacity is None else min(remaining, capacity)
+          slot_mix[self.sources[index]["name"]] = delivered
+          remaining -= delivered
+      mix.append(slot_mix)
+
+    return cheapest, costs, mix
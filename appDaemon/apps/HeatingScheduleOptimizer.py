@@ -0,0 +1,116 @@
+#
+# Heating schedule optimizer
+#
+# Plans an hourly target temperature schedule over the known price curve (up to 48 hours) with dynamic programming.
+# The house is modelled with a simple first order thermal model, per hour:
+#
+#   T_next = T + heating_rate * heating - heat_loss_rate * (T - T_outdoor)
+#
+# heating is 1 when the AC runs the whole hour and 0 when it is off. The heating rate can be given per hour, as it
+# depends on the outdoor temperature through the COP of the heat pump. The plan minimises the electricity cost plus a
+# comfort cost for every degree hour below the target temperature, and a much higher cost below the min temperature.
+# The room is never heated above the max temperature.
+#
+# With sub-hourly prices every step of the plan is one price slot of slot_hours hours instead of a full hour. The
+# rates are scaled to the slot and the temperature grid gets finer with it, so the small change of one slot does
+# not round away.
+#
+
+class HeatingScheduleOptimizer:
+  temperature_step = 0.1            # Resolution of the temperature grid in the dynamic programming table
+  below_min_cost_multiplier = 100   # Degree hours below the min temperature cost this much more than below the target
+  max_degrees_below_min = 10        # Lowest point of the temperature grid, below the min temperature
+
+  def __init__(self, heat_loss_rate, heating_rate, power_kw, comfort_cost):
+    self.heat_loss_rate = heat_loss_rate    # Fraction of the inside/outside temperature difference lost per hour
+    self.heating_rate = heating_rate        # Degrees per hour the AC adds when running
+    self.power_kw = power_kw                # Average electrical power of the AC when running
+    self.comfort_cost = comfort_cost        # Cost in cent for one degree hour below the target temperature
+
+
+  def plan(self, prices, start_temperature, outdoor_temperatures, min_temperature, target_temperature, max_temperature,
+           heating_rates=None, slot_hours=1.0):
+    # Returns (targets, heating): the planned temperature at the end of every slot and if the AC runs during that slot
+    hours = len(prices)
+    if hours == 0:
+      return [], []
+    if heating_rates is None:
+      heating_rates = [self.heating_rate] * hours
+    heat_loss_rate = self.heat_loss_rate * slot_hours
+    heating_rates = [rate * slot_hours for rate in heating_rates]
+    energy_kwh = self.power_kw * slot_hours
+
+    step = self.temperature_step * min(1.0, slot_hours)
+    # The grid reaches down to the lowest temperature the room gets to without heating, otherwise all colder states
+    # round to the lowest grid point, look equally bad, and the plan sees no point in heating through a cold period
+    low = min(min_temperature, start_temperature) - 1
+    free_temperature = start_temperature
+    for outdoor in outdoor_temperatures[:hours]:
+      free_temperature -= heat_loss_rate * (free_temperature - outdoor)
+      low = min(low, free_temperature)
+    low = max(low, min_temperature - self.max_degrees_below_min)
+    high = max(max_temperature, start_temperature)
+    points = int(round((high - low) / step)) + 1
+    temperatures = [low + i * step for i in range(points)]
+
+    def grid_index(temperature):
+      return max(0, min(points - 1, int(round((temperature - low) / step))))
+
+    def comfort_penalty(temperature):
+      penalty = max(0, target_temperature - temperature) * self.comfort_cost
+      penalty += max(0, min_temperature - temperature) * self.comfort_cost * self.below_min_cost_multiplier
+      return penalty * slot_hours
+
+    penalties = [comfort_penalty(temperature) for temperature in temperatures]
+
+    # Backwards pass: cost_to_go[i] is the cheapest cost from grid point i to the end of the horizon
+    cost_to_go = [0.0] * points
+    decisions = [None] * hours
+    for hour in range(hours - 1, -1, -1):
+      outdoor = outdoor_temperatures[hour]
+      heating_rate = heating_rates[hour]
+      hour_cost = [0.0] * points
+      hour_decision = [0] * points
+      for i, temperature in enumerate(temperatures):
+        free_temperature = temperature - heat_loss_rate * (temperature - outdoor)
+
+        # AC off for the whole hour
+        j = grid_index(free_temperature)
+        best_cost = penalties[j] + cost_to_go[j]
+        best_heating = 0
+
+        # AC on, only for the part of the hour needed to reach the max temperature. The fitted heating rate is 0 when
+        # it is too cold outside for the AC to add heat, then heating is never an option
+        if heating_rate > 0:
+          heated_temperature = free_temperature + heating_rate
+          run_fraction = 1.0
+          if heated_temperature > max_temperature:
+            heated_temperature = max(free_temperature, max_temperature)
+            run_fraction = (heated_temperature - free_temperature) / heating_rate
+          if run_fraction > 0:
+            j = grid_index(heated_temperature)
+            cost = run_fraction * prices[hour] * energy_kwh + penalties[j] + cost_to_go[j]
+            if cost < best_cost:
+              best_cost = cost
+              best_heating = 1
+
+        hour_cost[i] = best_cost
+        hour_decision[i] = best_heating
+      cost_to_go = hour_cost
+      decisions[hour] = hour_decision
+
+    # Forward pass: follow the cheapest decisions from the current temperature
+    targets = []
+    heating = []
+    i = grid_index(start_temperature)
+    for hour in range(hours):
+      temperature = temperatures[i]
+      heating_on = decisions[hour][i]
+      next_temperature = temperature - heat_loss_rate * (temperature - outdoor_temperatures[hour])
+      if heating_on:
+        next_temperature = max(next_temperature, min(next_temperature + heating_rates[hour], max_temperature))
+      i = grid_index(next_temperature)
+      targets.append(round(temperatures[i], 2))
+      heating.append(heating_on)
+
+    return targets, heating
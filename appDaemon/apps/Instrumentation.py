@@ -0,0 +1,231 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+
+#
+# Instrumentation
+#
+# Measures the entry points of an app and counts its Home Assistant API calls, cheap enough to leave on:
+#
+#   tick_duration      how long every tick (e.g. control_climate) takes
+#   scheduler_lag      how late AppDaemon fires the periodic callbacks compared to their schedule
+#   api_calls_per_tick get_state, set_state, get_history and call_service calls made during one tick
+#
+# Every measurement is one perf_counter pair and a few integer increments into fixed histogram buckets, nothing is
+# kept per sample. The summaries are served in Prometheus text format on /app/<endpoint> (AppDaemon register_route)
+# or /api/appdaemon/<endpoint> (register_endpoint) when an endpoint is given, which costs nothing until it is scraped.
+# With a publish_interval they are also published as sensors, sensor.<name>_<tick>_duration,
+# sensor.<name>_scheduler_lag and sensor.<name>_api_calls. A sensor is only written when its summary changed, the
+# sample count alone does not count as a change.
+#
+# Usage:
+#   instrumentation = Instrumentation(app, "ac_controller", publisher, publish_interval=3600, endpoint="ac_controller_metrics")
+#   app.control_climate = instrumentation.timed("control_climate", app.control_climate)
+#   app.run_minutely(instrumentation.periodic(app.control_climate, start_time, 60), start=start_time)
+#
+
+class Histogram:
+  # Upper bounds in seconds, the last bucket takes everything above
+  bounds = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+
+  def __init__(self, bounds=None):
+    if bounds is not None:
+      self.bounds = bounds
+    self.buckets = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+
+  def add(self, value):
+    index = 0
+    while index < len(self.bounds) and value > self.bounds[index]:
+      index += 1
+    self.buckets[index] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+
+  def mean(self):
+    return self.sum / self.count if self.count > 0 else 0.0
+
+
+  def percentile(self, fraction):
+    # Upper bound of the bucket the percentile falls in, never more than the max
+    if self.count == 0:
+      return 0.0
+    wanted = fraction * self.count
+    seen = 0
+    for index, bucket in enumerate(self.buckets):
+      seen += bucket
+      if seen >= wanted and index < len(self.bounds):
+        return min(self.bounds[index], self.max)
+    return self.max
+
+
+  def summary(self, scale=1.0, digits=3):
+    return {
+        "count": self.count,
+        "mean": round(self.mean() * scale, digits),
+        "p50": round(self.percentile(0.5) * scale, digits),
+        "p95": round(self.percentile(0.95) * scale, digits),
+        "max": round(self.max * scale, digits)
+    }
+
+
+class Instrumentation:
+  counted_methods = ["get_state", "set_state", "get_history", "call_service"]
+  call_bounds = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+  def __init__(self, app, name, publisher, publish_interval=0, endpoint=None):
+    self.app = app
+    self.name = name                        # Prefix of the sensors and label of the metrics, e.g. "ac_controller"
+    self.publisher = publisher              # StatePublisher used for the sensors
+
+    self.tick_durations = {}                # tick name -> Histogram of seconds
+    self.scheduler_lag = Histogram()        # Seconds the periodic callbacks fired after their schedule
+    self.calls_per_tick = Histogram(self.call_bounds)
+    self.call_counts = {method: 0 for method in self.counted_methods}
+    self.calls = 0                          # All counted calls since startup, the per tick count is a difference
+    self.published_summaries = {}           # entity_id -> summary of the last sensor write
+
+    for method in self.counted_methods:
+      setattr(app, method, self.counted(method, getattr(app, method)))
+
+    if publish_interval:
+      app.run_every(self.publish_sensors, datetime.now() + timedelta(seconds=publish_interval), publish_interval)
+
+    if endpoint:
+      if hasattr(app, "register_route"):
+        app.register_route(self.metrics_route, endpoint)
+      elif hasattr(app, "register_endpoint"):
+        app.register_endpoint(self.metrics_endpoint, endpoint)
+
+
+  def counted(self, method, function):
+    def counted_call(*args, **kwargs):
+      self.call_counts[method] += 1
+      self.calls += 1
+      return function(*args, **kwargs)
+    return counted_call
+
+
+  def timed(self, name, callback):
+    # Wraps a tick, every call is measured whoever calls it
+    histogram = self.tick_durations.setdefault(name, Histogram())
+
+    def timed_callback(*args, **kwargs):
+      calls_before = self.calls
+      started = time.perf_counter()
+      try:
+        return callback(*args, **kwargs)
+      finally:
+        histogram.add(time.perf_counter() - started)
+        self.calls_per_tick.add(self.calls - calls_before)
+
+    async def timed_coroutine(*args, **kwargs):
+      calls_before = self.calls
+      started = time.perf_counter()
+      try:
+        return await callback(*args, **kwargs)
+      finally:
+        histogram.add(time.perf_counter() - started)
+        self.calls_per_tick.add(self.calls - calls_before)
+
+    # AppDaemon runs coroutine functions on its event loop, the wrapper has to stay one
+    return timed_coroutine if asyncio.iscoroutinefunction(callback) else timed_callback
+
+
+  def periodic(self, callback, start_time, interval):
+    # Wraps a run_every / run_minutely callback, the schedule is start_time + n * interval
+    def measure_lag():
+      elapsed = (datetime.now() - start_time).total_seconds()
+      if elapsed >= 0:
+        self.scheduler_lag.add(max(0.0, elapsed - round(elapsed / interval) * interval))
+
+    def periodic_callback(kwargs):
+      measure_lag()
+      return callback(kwargs)
+
+    async def periodic_coroutine(kwargs):
+      measure_lag()
+      return await callback(kwargs)
+
+    return periodic_coroutine if asyncio.iscoroutinefunction(callback) else periodic_callback
+
+
+  def summary_changed(self, entity_id, summary):
+    # Compares without the count, which grows with every tick even when nothing else moves
+    summary = dict(summary)
+    summary.pop("count", None)
+    if self.published_summaries.get(entity_id) == summary:
+      return False
+    self.published_summaries[entity_id] = summary
+    return True
+
+
+  def publish_sensors(self, kwargs):
+    for name, histogram in self.tick_durations.items():
+      entity_id = f"sensor.{self.name}_{name}_duration"
+      summary = histogram.summary(scale=1000)
+      if self.summary_changed(entity_id, summary):
+        self.publisher.publish(entity_id, summary["mean"], attributes=dict(summary, **{
+            "unit_of_measurement": "ms",
+            "friendly_name": f"{self.name} {name} duration"
+        }))
+
+    entity_id = f"sensor.{self.name}_scheduler_lag"
+    summary = self.scheduler_lag.summary(scale=1000)
+    if self.summary_changed(entity_id, summary):
+      self.publisher.publish(entity_id, summary["mean"], attributes=dict(summary, **{
+          "unit_of_measurement": "ms",
+          "friendly_name": f"{self.name} scheduler lag"
+      }))
+
+    entity_id = f"sensor.{self.name}_api_calls"
+    summary = self.calls_per_tick.summary(digits=1)
+    if self.summary_changed(entity_id, summary):
+      self.publisher.publish(entity_id, self.calls, attributes=dict(self.call_counts, **{
+          "per_tick_mean": summary["mean"],
+          "per_tick_max": summary["max"],
+          "unit_of_measurement": "calls",
+          "friendly_name": f"{self.name} API calls"
+      }))
+
+
+  def prometheus_text(self):
+    lines = []
+
+    def histogram_lines(metric, histogram, labels):
+      cumulative = 0
+      for bound, bucket in zip(histogram.bounds + ["+Inf"], histogram.buckets):
+        cumulative += bucket
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+      lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+      lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+
+    lines.append("# TYPE appdaemon_tick_duration_seconds histogram")
+    for name, histogram in self.tick_durations.items():
+      histogram_lines("appdaemon_tick_duration_seconds", histogram, f'app="{self.name}",tick="{name}"')
+    lines.append("# TYPE appdaemon_scheduler_lag_seconds histogram")
+    histogram_lines("appdaemon_scheduler_lag_seconds", self.scheduler_lag, f'app="{self.name}"')
+    lines.append("# TYPE appdaemon_api_calls_per_tick histogram")
+    histogram_lines("appdaemon_api_calls_per_tick", self.calls_per_tick, f'app="{self.name}"')
+    lines.append("# TYPE appdaemon_api_calls_total counter")
+    for method, count in self.call_counts.items():
+      lines.append(f'appdaemon_api_calls_total{{app="{self.name}",method="{method}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+  async def metrics_route(self, request, kwargs):
+    # aiohttp is always there when AppDaemon serves routes
+    from aiohttp import web
+    return web.Response(text=self.prometheus_text(), content_type="text/plain")
+
+
+  def metrics_endpoint(self, data, kwargs):
+    # Older AppDaemon versions only have JSON endpoints, the text is returned as a JSON string
+    return self.prometheus_text(), 200
@@ -0,0 +1,151 @@
+import appdaemon.plugins.hass.hassapi as hass
+from datetime import datetime, timezone
+from StatePublisher import StatePublisher
+
+
+#
+# Load coordinator app
+#
+# Keeps the total import power of the house below max_import_power, so the controllable loads do not trip the main
+# fuse or raise the peak demand charge. Every change of the live P1 power sensor recalculates the power budgets:
+#
+#   base load = measured import power - power of the controllable loads that are running right now
+#   headroom  = max_import_power - base load
+#
+# The headroom is handed out to the loads in priority order, highest first. A load is allowed to run when its full
+# power fits into what is left. A load that is not running needs resume_margin extra headroom before it is allowed
+# again, so a load does not flap on and off around the limit.
+#
+# The decisions are published as one sensor per load, sensor.load_budget_<entity id with _ instead of .>, with the
+# budget in W as state and "allowed" as attribute. ACController.py reads them when use_load_coordinator is set.
+#
+# Args:
+#   power_sensor: Live import power sensor of the P1 meter in W (default sensor.p1_meter_active_power)
+#   max_import_power: Maximum import power of the house in W (default 11000)
+#   resume_margin: Extra headroom in W a stopped load needs before it is allowed to start again (default 500)
+#   loads: List of controllable loads, each with entity_id, power (W when running) and priority (higher first).
+#          Defaults to the AC unit of ACController.py
+#   publish_max_age: Seconds after which an unchanged budget sensor is written again anyway (default 900, 0 disables)
+#
+
+class LoadCoordinator(hass.Hass):
+  max_import_power = 11000        # Maximum import power of the house in W, below the main fuse and the peak demand limit
+  resume_margin    = 500          # Extra headroom in W a stopped load needs before it is allowed to start again
+  publish_max_age  = 900          # Rewrite unchanged sensors after this many seconds, so they survive an HA restart
+
+  entity_id_power = "sensor.p1_meter_active_power"
+
+  # Controllable loads, power in W when running, the highest priority gets its budget first
+  loads = [
+      {"entity_id": "climate.153931628243065_climate", "power": 1000, "priority": 1},
+  ]
+
+  running_states = ["heat", "cool", "heat_cool", "dry", "on"]
+
+  headroom_id = "sensor.load_coordinator_headroom"
+  latency_id = "sensor.load_coordinator_latency"
+  throttle_count_id = "sensor.load_coordinator_throttle_count"
+
+
+  def initialize(self):
+    self.max_import_power = self.args.get("max_import_power", self.max_import_power)
+    self.resume_margin = self.args.get("resume_margin", self.resume_margin)
+    self.entity_id_power = self.args.get("power_sensor", self.entity_id_power)
+    self.loads = sorted(self.args.get("loads", self.loads), key=lambda load: -load.get("priority", 0))
+    self.publisher = StatePublisher(self, max_age=self.args.get("publish_max_age", self.publish_max_age))
+
+    # Working variables, the load states are kept up to date by state events so a power event needs no reads
+    self.load_states = {}
+    self.allowed = {}
+    self.throttle_count = 0
+    self.power = None
+    for load in self.loads:
+      self.load_states[load["entity_id"]] = self.get_state(load["entity_id"])
+      self.allowed[load["entity_id"]] = True
+      self.listen_state(self.load_state_changed, load["entity_id"])
+
+    self.listen_state(self.power_changed, self.entity_id_power, attribute="all")
+    self.power_changed(self.entity_id_power, "all", None, self.get_state(self.entity_id_power, attribute="all"), {})
+
+
+  def budget_sensor_id(self, entity_id):
+    return "sensor.load_budget_" + entity_id.replace(".", "_")
+
+
+  def load_state_changed(self, entity, attribute, old, new, kwargs):
+    self.load_states[entity] = new
+
+
+  def power_changed(self, entity, attribute, old, new, kwargs):
+    if new is None:
+      return
+    try:
+      self.power = float(new["state"])
+    except (TypeError, ValueError):
+      # unknown / unavailable, keep the last decisions
+      return
+
+    if self.update_budgets():
+      self.publish_latency(new.get("last_changed"))
+
+
+  def running(self, entity_id):
+    return self.load_states.get(entity_id) in self.running_states
+
+
+  def update_budgets(self):
+    base_load = self.power - sum(load["power"] for load in self.loads if self.running(load["entity_id"]))
+    headroom = self.max_import_power - base_load
+    available = headroom
+    changed = False
+
+    for load in self.loads:
+      entity_id = load["entity_id"]
+      needed = load["power"]
+      if not self.running(entity_id) and not self.allowed[entity_id]:
+        needed += self.resume_margin
+
+      allowed = available >= needed
+      budget = max(0, min(available, load["power"]))
+      if allowed:
+        available -= load["power"]
+
+      if self.allowed[entity_id] and not allowed:
+        self.throttle_count += 1
+        self.log(f"Throttling {entity_id}: {round(self.power)} W import, {round(headroom)} W headroom for the loads")
+      elif allowed and not self.allowed[entity_id]:
+        self.log(f"Releasing {entity_id}: {round(self.power)} W import, {round(headroom)} W headroom for the loads")
+      changed = changed or allowed != self.allowed[entity_id]
+      self.allowed[entity_id] = allowed
+
+      # Budgets and headroom are rounded to 100 W, so the sensors are not rewritten for every meter reading
+      self.publisher.publish(self.budget_sensor_id(entity_id), round(budget, -2), attributes={
+          "unit_of_measurement": "W",
+          "friendly_name": f"Power budget {entity_id}",
+          "allowed": allowed,
+          "priority": load.get("priority", 0)
+      })
+
+    self.publisher.publish(self.headroom_id, round(headroom, -2), attributes={
+        "unit_of_measurement": "W",
+        "friendly_name": "Load coordinator headroom"
+    })
+
+    self.publisher.publish(self.throttle_count_id, self.throttle_count, attributes={
+        "unit_of_measurement": "",
+        "friendly_name": "Load coordinator throttled loads since startup"
+    })
+    return changed
+
+
+  def publish_latency(self, last_changed):
+    # Seconds from the meter reading to the published decision, only measured when a decision changed
+    if last_changed is None:
+      return
+    if isinstance(last_changed, str):
+      last_changed = datetime.fromisoformat(last_changed)
+    now = datetime.now(timezone.utc) if last_changed.tzinfo is not None else datetime.now()
+    self.publisher.publish(self.latency_id, round((now - last_changed).total_seconds(), 3), attributes={
+        "unit_of_measurement": "s",
+        "friendly_name": "Load coordinator decision latency"
+    })
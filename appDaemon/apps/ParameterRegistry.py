@@ -0,0 +1,101 @@
+#
+# Parameter registry
+#
+# The input_number and input_boolean entities an app is tuned with from the Home Assistant UI, declared once as a
+# schema in the app:
+#
+#   parameters = [
+#       {"name": "target_room_temperature", "friendly_name": "Target Room Temperature", "initial": 23, "min": 10, "max": 30, "step": 0.5},
+#       {"name": "min_state_change_time", "friendly_name": "Min State Change Time (sec)", "initial": 1800, "min": 0, "max": 3600, "step": 60, "type": int},
+#       {"name": "manual_override_set", "friendly_name": "AC manual override set", "initial": "off", "domain": "input_boolean"},
+#   ]
+#
+# The entity of a parameter is the <name>_id attribute of the app, its value is kept in the <name> attribute. At
+# startup the missing entities are created and all values are read with one get_state per domain. Afterwards a state
+# change only converts and sets the one parameter that changed, found by entity_id in a dict, and calls on_change.
+#
+# The state listeners are registered per entity and the call_service listener only for input_number.set_value, so the
+# app is not woken up by the other service calls of the house. AppDaemon can only filter on the top level of the event
+# data, the entity_id inside service_data is a dict lookup. The set_value calls are written to the entity state, as the
+# entities are created by the app and are unknown to the input_number integration.
+#
+# Usage:
+#   self.parameter_registry = ParameterRegistry(self, self.parameters, on_change=self.parameter_changed)
+#
+
+class ParameterRegistry:
+
+  def __init__(self, app, schema, on_change=None):
+    self.app = app
+    self.on_change = on_change          # Called with (name, old value, new value) after a parameter changed
+    self.parameters = {}                # entity_id -> parameter of the schema
+    for parameter in schema:
+      self.parameters[getattr(app, parameter["name"] + "_id")] = parameter
+
+    # get_state of a domain returns the full states of all its entities
+    states = {}
+    domains = set(parameter.get("domain", "input_number") for parameter in schema)
+    for domain in domains:
+      states.update(app.get_state(domain) or {})
+
+    for entity_id, parameter in self.parameters.items():
+      state = states.get(entity_id)
+      if state is None:
+        self.create(entity_id, parameter)
+        self.apply(entity_id, parameter, parameter["initial"])
+      else:
+        self.apply(entity_id, parameter, state["state"])
+      app.listen_state(self.state_changed, entity_id)
+
+    if "input_number" in domains:
+      app.listen_event(self.set_value_called, "call_service", domain="input_number", service="set_value")
+
+
+  def create(self, entity_id, parameter):
+    self.app.log(f"Creating {entity_id} with initial value {parameter['initial']}")
+    attributes = {"friendly_name": parameter["friendly_name"]}
+    if parameter.get("domain", "input_number") == "input_number":
+      attributes.update({
+          "min": parameter["min"],
+          "max": parameter["max"],
+          "step": parameter["step"],
+          "mode": "slider"
+      })
+    self.app.set_state(entity_id, state=parameter["initial"], attributes=attributes)
+
+
+  def convert(self, parameter, value):
+    if parameter.get("domain", "input_number") == "input_boolean":
+      return value == "on" or value is True
+    # float first, the UI sends 1200.0 also for whole numbers
+    return parameter.get("type", float)(float(value))
+
+
+  def apply(self, entity_id, parameter, value):
+    # Returns False and keeps the old value if the state is not a valid value, e.g. unavailable
+    try:
+      setattr(self.app, parameter["name"], self.convert(parameter, value))
+    except (TypeError, ValueError):
+      self.app.log(f"Ignoring invalid value {value} of {entity_id}", level="WARNING")
+      return False
+    return True
+
+
+  def state_changed(self, entity, attribute, old, new, kwargs):
+    parameter = self.parameters[entity]
+    previous = getattr(self.app, parameter["name"])
+    if not self.apply(entity, parameter, new):
+      return
+    self.app.log(f"{entity} changed from {old} to {new}")
+    if self.on_change is not None:
+      self.on_change(parameter["name"], previous, getattr(self.app, parameter["name"]))
+
+
+  def set_value_called(self, event_name, data, kwargs):
+    service_data = data.get("service_data") or {}
+    entity_ids = service_data.get("entity_id")
+    if isinstance(entity_ids, str):
+      entity_ids = [entity_ids]
+    for entity_id in entity_ids or []:
+      if entity_id in self.parameters:
+        self.app.set_state(entity_id, state=service_data.get("value"))
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+
+#
+# State publisher
+#
+# Wraps set_state for the sensors an app derives itself. Remembers the last state and attributes written to
+# each entity and skips the write if nothing changed, as every write fans out to the recorder, the websocket
+# clients and all state listeners. With max_age set, an unchanged state is still rewritten once it is older
+# than max_age seconds, so the sensor comes back after a Home Assistant restart.
+#
+
+class StatePublisher:
+
+  def __init__(self, app, max_age=None):
+    self.app = app
+    self.max_age = max_age
+    self.published = {}       # entity_id -> (state, attributes, time of the write)
+
+    # Statistics
+    self.writes = 0
+    self.suppressed = 0
+
+
+  def publish(self, entity_id, state, attributes=None, max_age=None):
+    if attributes is None:
+      attributes = {}
+    if max_age is None:
+      max_age = self.max_age
+
+    now = datetime.now()
+    last = self.published.get(entity_id)
+    if last is not None and last[0] == state and last[1] == attributes:
+      if not max_age or (now - last[2]).total_seconds() < max_age:
+        self.suppressed += 1
+        return False
+
+    self.app.set_state(entity_id, state=state, attributes=attributes)
+    self.published[entity_id] = (state, dict(attributes), now)
+    self.writes += 1
+    return True
+
+
+  def forget(self, entity_id):
+    # Makes sure the next publish is written, e.g. when the entity was changed by someone else
+    self.published.pop(entity_id, None)
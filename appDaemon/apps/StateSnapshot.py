@@ -0,0 +1,59 @@
+import asyncio
+
+
+#
+# State snapshot
+#
+# Fetches the full state dict of an entity the first time it is read during a tick and serves every
+# following state/attribute lookup from that copy. Create one snapshot per tick, so each tick only
+# does one get_state round trip per entity and every decision in the tick sees the same view of the house.
+#
+
+class StateSnapshot:
+
+  def __init__(self, app):
+    self.app = app
+    self.states = {}
+
+    # Statistics, used to report how many get_state round trips the snapshot saved
+    self.lookups = 0
+    self.fetches = 0
+
+
+  def get(self, entity_id, attribute="state"):
+    # Called for every input of every zone, keep the cached path to one dict lookup
+    self.lookups += 1
+    full_state = self.states.get(entity_id, self)
+    if full_state is self:
+      self.fetches += 1
+      full_state = self.states[entity_id] = self.app.get_state(entity_id, attribute="all")
+
+    if full_state is None:
+      # Entity does not exist (yet), behave like get_state does
+      return None
+
+    if attribute == "state":
+      return full_state.get("state")
+
+    if attribute == "all":
+      return full_state
+
+    return full_state.get("attributes", {}).get(attribute)
+
+
+  def prefetch_domain(self, domain):
+    # One get_state round trip for every entity of a domain, e.g. all climate units of a multi-zone setup
+    self.fetches += 1
+    self.states.update(self.app.get_state(domain) or {})
+
+
+  def saved_round_trips(self):
+    return self.lookups - self.fetches
+
+
+  async def prefetch_concurrently(self, entity_ids):
+    # From an async app: all get_state round trips in flight at the same time instead of one after the other
+    entity_ids = [entity_id for entity_id in dict.fromkeys(entity_ids) if entity_id not in self.states]
+    states = await asyncio.gather(*[self.app.get_state(entity_id, attribute="all") for entity_id in entity_ids])
+    self.fetches += len(entity_ids)
+    self.states.update(zip(entity_ids, states))
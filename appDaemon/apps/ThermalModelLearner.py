@@ -0,0 +1,264 @@
+import appdaemon.plugins.hass.hassapi as hass
+from datetime import datetime, timedelta
+from ClimateZone import ClimateZone
+from TimeSeriesStore import find_series
+
+
+#
+# Thermal model learner app
+#
+# Fits the thermal model of the house used by the ACController heating schedule optimizer from recorder history:
+#
+#   dT/dt = heat_loss_rate * (T_outdoor - T) + heating * (heating_rate_intercept + heating_rate_slope * T_outdoor)
+#
+# T is the room temperature, heating is the AC on/off history. heating_rate_intercept + heating_rate_slope * T_outdoor
+# is how many degrees per hour the AC adds, which follows the COP of the heat pump versus the outdoor temperature.
+#
+# The history is streamed one day per callback and only the sums of the least squares normal equations are kept,
+# so years of history fit in constant memory. The sums are stored in the attributes of the model sensor, so after
+# a restart only the days that were not processed yet are read. Every night the previous day is added and the
+# model is refitted. The AC on/off history is read from the TimeSeriesStore of ACController when it covers the day,
+# which saves one recorder query per day. A day that is still being caught up on when the nightly run starts is
+# left to the running catch up, so there is only ever one chain of chunks.
+#
+# With several AC zones every zone adds its own equations, from its room temperature and its own on/off history, to
+# one model of the house. The zones are the same list as the zones of ACController, without it the default room
+# temperature sensor and sensor.ac_on_off_history are used.
+#
+# Args:
+#   history_days: Days of history to fit when there is no model yet (default 30)
+#   sample_minutes: Minutes between two samples of the history (default 15)
+#   daily_decay: Weight multiplier applied to the old sums for every new day, so the model follows the seasons (default 0.995)
+#   zones: The zones of ACController, list of name, climate_entity and room_temperature_entity (default one zone)
+#
+
+class ThermalModelLearner(hass.Hass):
+  history_days   = 30       # Days of history to fit when there is no model yet
+  sample_minutes = 15       # Minutes between two samples of the history
+  daily_decay    = 0.995    # Weight multiplier applied to the old sums for every new day of history
+
+  entity_id_room_temperature = "sensor.climate_living_room_temperature"
+  entity_id_weather_forecast = "weather.forecast_home"
+  entity_id_ac_on_off_history = "sensor.ac_on_off_history"
+
+  # Read by ACController.py
+  entity_id_thermal_model = "sensor.ac_thermal_model"
+
+  feature_names = ["heat_loss_rate", "heating_rate_intercept", "heating_rate_slope"]
+
+
+  def initialize(self):
+    self.history_days = self.args.get("history_days", self.history_days)
+    self.sample_minutes = self.args.get("sample_minutes", self.sample_minutes)
+    self.daily_decay = self.args.get("daily_decay", self.daily_decay)
+
+    # (room temperature, AC on/off history) of every zone, with the zone suffixes of ACController
+    self.zone_entities = []
+    for zone in self.args.get("zones") or []:
+      climate_zone = ClimateZone(zone["name"], zone["climate_entity"], zone["room_temperature_entity"])
+      self.zone_entities.append((climate_zone.entity_id_room_temperature, climate_zone.on_off_history_id))
+    if not self.zone_entities:
+      self.zone_entities.append((self.entity_id_room_temperature, self.entity_id_ac_on_off_history))
+
+    # Sums of the normal equations X^T X and X^T y, and the time up to which history has been added to them
+    features = len(self.feature_names)
+    self.xtx = [[0.0] * features for _ in range(features)]
+    self.xty = [0.0] * features
+    self.samples = 0
+    self.fitted_until = None
+    self.coefficients = None
+    self.load_model()
+
+    if self.fitted_until is None:
+      self.fitted_until = self.today_start() - timedelta(days=self.history_days)
+      self.log(f"No thermal model yet, fitting {self.history_days} days of history")
+
+    # Catch up in the background, one day per callback, then add every new day at night
+    self.chunk_timer = self.run_in(self.process_next_chunk, 10)
+    self.run_daily(self.process_new_day, "03:30:00")
+
+
+  def today_start(self):
+    return datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+  def load_model(self):
+    model = self.get_state(self.entity_id_thermal_model, attribute="all")
+    if model is None:
+      return
+    attributes = model.get("attributes", {})
+    if "xtx" not in attributes or "fitted_until" not in attributes:
+      return
+    self.xtx = [list(row) for row in attributes["xtx"]]
+    self.xty = list(attributes["xty"])
+    self.samples = attributes.get("samples", 0)
+    self.fitted_until = datetime.fromisoformat(attributes["fitted_until"])
+    self.log(f"Loaded thermal model sums with {self.samples} samples up to {self.fitted_until}")
+    self.fit()
+
+
+  def process_new_day(self, kwargs):
+    if self.chunk_timer is not None:
+      # Still catching up, the running chain of chunks gets to the new day as well
+      return
+    self.process_next_chunk(kwargs)
+
+
+  def process_next_chunk(self, kwargs):
+    self.chunk_timer = None
+    today_start = self.today_start()
+    if self.fitted_until >= today_start:
+      return
+
+    chunk_start = self.fitted_until
+    chunk_end = min(chunk_start + timedelta(days=1), today_start)
+    added = self.add_history(chunk_start, chunk_end)
+    self.fitted_until = chunk_end
+    self.log(f"Added {added} samples from {chunk_start} to {chunk_end}")
+
+    self.fit()
+    self.publish_model()
+
+    if self.fitted_until < today_start:
+      # More history to catch up on, continue in a new callback so the worker thread is released in between
+      self.chunk_timer = self.run_in(self.process_next_chunk, 1)
+
+
+  def read_history(self, entity_id, start_time, end_time, attribute=None):
+    # Returns a time sorted list of (time, value), skipping values that are not numbers
+    history = self.get_history(entity_id=entity_id, start_time=start_time, end_time=end_time)
+    series = []
+    if not history or len(history[0]) == 0:
+      return series
+    for entry in history[0]:
+      value = entry.get("state") if attribute is None else entry.get("attributes", {}).get(attribute)
+      try:
+        value = float(value)
+      except (TypeError, ValueError):
+        continue
+      series.append((datetime.fromisoformat(entry["last_changed"]), value))
+    series.sort(key=lambda item: item[0])
+    return series
+
+
+  def read_store(self, name, start_time, end_time):
+    # Same format as read_history, or None when the series does not reach back to start_time
+    series = find_series(name)
+    if series is None:
+      return None
+    first = series.first_timestamp()
+    if first is None or first > start_time.timestamp():
+      return None
+    timestamps, values = series.range(start_time, end_time)
+    entries = [(start_time, series.value_at(start_time))]
+    for timestamp, value in zip(timestamps, values):
+      entries.append((datetime.fromtimestamp(timestamp, start_time.tzinfo), value))
+    return entries
+
+
+  def add_history(self, start_time, end_time):
+    outdoor = self.read_history(self.entity_id_weather_forecast, start_time, end_time, attribute="temperature")
+    if not outdoor:
+      return 0
+    zones = []
+    for entity_id_room_temperature, entity_id_ac_on_off_history in self.zone_entities:
+      room = self.read_history(entity_id_room_temperature, start_time, end_time)
+      heating = self.read_store(entity_id_ac_on_off_history, start_time, end_time)
+      if heating is None:
+        heating = self.read_history(entity_id_ac_on_off_history, start_time, end_time)
+      if room and heating:
+        zones.append((room, heating))
+    if not zones:
+      return 0
+
+    # Let the old days weigh a bit less than the new one
+    for row in self.xtx:
+      for i in range(len(row)):
+        row[i] *= self.daily_decay
+    for i in range(len(self.xty)):
+      self.xty[i] *= self.daily_decay
+
+    added = 0
+    for room, heating in zones:
+      added += self.add_equations(room, outdoor, heating, start_time, end_time)
+    return added
+
+
+  def add_equations(self, room, outdoor, heating, start_time, end_time):
+    # Sample the three step functions on a fixed grid and add one equation per pair of samples
+    step = timedelta(minutes=self.sample_minutes)
+    step_hours = self.sample_minutes / 60
+    positions = [0, 0, 0]
+    previous = None
+    added = 0
+    sample_time = start_time
+    while sample_time <= end_time:
+      values = []
+      for index, series in enumerate([room, outdoor, heating]):
+        while positions[index] + 1 < len(series) and series[positions[index] + 1][0] <= sample_time:
+          positions[index] += 1
+        values.append(series[positions[index]][1] if series[positions[index]][0] <= sample_time else None)
+
+      if None not in values:
+        if previous is not None:
+          room_temperature, outdoor_temperature, heating_on = previous
+          features = [outdoor_temperature - room_temperature, heating_on, heating_on * outdoor_temperature]
+          target = (values[0] - room_temperature) / step_hours
+          for i, feature_i in enumerate(features):
+            self.xty[i] += feature_i * target
+            for j, feature_j in enumerate(features):
+              self.xtx[i][j] += feature_i * feature_j
+          self.samples += 1
+          added += 1
+        previous = values
+      sample_time += step
+
+    return added
+
+
+  def fit(self):
+    coefficients = self.solve(self.xtx, self.xty)
+    if coefficients is None:
+      self.log(f"Not enough variation in the history to fit the thermal model yet")
+      return
+    if coefficients[0] <= 0:
+      self.log(f"Ignoring fit with a non positive heat loss rate: {coefficients}")
+      return
+    self.coefficients = coefficients
+
+
+  def solve(self, matrix, vector):
+    # Gaussian elimination with partial pivoting, the system is only 3x3
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+    for column in range(size):
+      pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+      if abs(rows[pivot][column]) < 1e-9:
+        return None
+      rows[column], rows[pivot] = rows[pivot], rows[column]
+      for row in range(column + 1, size):
+        factor = rows[row][column] / rows[column][column]
+        for i in range(column, size + 1):
+          rows[row][i] -= factor * rows[column][i]
+
+    solution = [0.0] * size
+    for row in range(size - 1, -1, -1):
+      known = sum(rows[row][i] * solution[i] for i in range(row + 1, size))
+      solution[row] = (rows[row][size] - known) / rows[row][row]
+    return solution
+
+
+  def publish_model(self):
+    attributes = {
+        "friendly_name": "AC thermal model",
+        "samples": self.samples,
+        "fitted_until": self.fitted_until.isoformat(),
+        "xtx": self.xtx,
+        "xty": self.xty
+    }
+    state = "unknown"
+    if self.coefficients is not None:
+      state = "fitted"
+      for name, value in zip(self.feature_names, self.coefficients):
+        attributes[name] = round(value, 5)
+    self.set_state(self.entity_id_thermal_model, state=state, attributes=attributes)
@@ -0,0 +1,130 @@
+#
+# Tick log
+#
+# Structured, rate limited logging for the apps that run every minute. Instead of a log line for every step, a tick
+# collects its values in one record and the record is written as one key=value line when the tick ends:
+#
+#   control_climate room=21.4 target=21.5 ac_target=21.5 ac_state=heat price=12.3 mean=10.1
+#
+# Values and messages are kept as they are (format string and arguments) and only formatted when the record is
+# written, so a tick that is not written costs a few list appends. What is written depends on the level:
+#
+#   debug    every tick with all its messages, like the old line per step logging
+#   info     every sample_every-th tick as one line, and the full record of every tick with a decision or an error
+#   changes  only the full records of the ticks with a decision or an error
+#   errors   only the full records of the ticks with an error
+#
+# A decision is something the tick changed in the house, e.g. an AC command. Messages outside of a tick are written
+# right away, following the same rules.
+#
+# Usage:
+#   self.tick_log = TickLog(self, level="info", sample_every=15)
+#   self.tick_log.start("control_climate")
+#   self.tick_log.set("room", inside_temperature)
+#   self.tick_log.detail("Time since last state change: %s", elapsed)
+#   self.tick_log.decision("Set AC temperature to %s", target_temperature)
+#   self.tick_log.error("No room temperature")
+#   self.tick_log.finish()
+#
+
+class TickLog:
+  levels = ["debug", "info", "changes", "errors"]
+
+  def __init__(self, app, level="info", sample_every=15):
+    if level not in self.levels:
+      raise ValueError(f"Unknown log level {level}, expected one of {', '.join(self.levels)}")
+    self.app = app
+    self.level = level
+    self.sample_every = max(1, sample_every)  # In info level, write every n-th tick without a decision or error
+
+    # The open record
+    self.name = None
+    self.prefix = None
+    self.fields = []                          # (prefix, key, value)
+    self.messages = []                        # (format, args)
+    self.decisions = 0
+    self.errors = 0
+
+    self.ticks = {}                           # tick name -> ticks since startup, for the sampling
+    self.written = 0                          # Records written since startup
+    self.skipped = 0                          # Records not written since startup
+
+
+  def start(self, name):
+    if self.name is not None:
+      self.finish()
+    self.name = name
+    self.prefix = None
+    self.fields = []
+    self.messages = []
+    self.decisions = 0
+    self.errors = 0
+
+
+  def scope(self, prefix):
+    # Prefix of the following fields, e.g. the zone, None for none
+    self.prefix = prefix
+
+
+  def set(self, key, value):
+    if self.name is not None:
+      self.fields.append((self.prefix, key, value))
+    elif self.level == "debug":
+      self.app.log("%s=%s", key, value)
+
+
+  def detail(self, message, *args):
+    if self.name is not None:
+      self.messages.append((message, args))
+    elif self.level == "debug":
+      self.app.log(message, *args)
+
+
+  def decision(self, message, *args):
+    if self.name is not None:
+      self.decisions += 1
+      self.messages.append((message, args))
+    elif self.level != "errors":
+      self.app.log(message, *args)
+
+
+  def error(self, message, *args):
+    if self.name is not None:
+      self.errors += 1
+      self.messages.append((message, args))
+    else:
+      self.app.log(message, *args, level="WARNING")
+
+
+  def finish(self):
+    if self.name is None:
+      return
+    count = self.ticks.get(self.name, 0)
+    self.ticks[self.name] = count + 1
+
+    full = self.level == "debug" or self.errors > 0 or (self.decisions > 0 and self.level != "errors")
+    sampled = self.level == "info" and count % self.sample_every == 0
+    if full or sampled:
+      self.written += 1
+      self.write(full)
+    else:
+      self.skipped += 1
+    self.name = None
+
+
+  def write(self, full):
+    fields = " ".join(f"{key if prefix is None else prefix + '.' + key}={self.format_value(value)}"
+                      for prefix, key, value in self.fields)
+    line = f"{self.name} {fields}" if fields else self.name
+    if full and self.messages:
+      line += " | " + "; ".join(message % args if args else message for message, args in self.messages)
+    if self.errors > 0:
+      self.app.log(line, level="WARNING")
+    else:
+      self.app.log(line)
+
+
+  def format_value(self, value):
+    if isinstance(value, float):
+      return f"{value:g}"
+    return str(value)
@@ -0,0 +1,232 @@
+import bisect
+import mmap
+import os
+import threading
+from datetime import datetime
+
+
+#
+# Time series store
+#
+# Bounded in-process history shared by the apps, so they do not have to write sensors into Home Assistant or ask
+# the recorder for values they saw themselves a minute earlier. Every series is a ring buffer of two float columns,
+# timestamps (epoch seconds) and values, in one fixed size buffer. Values older than the retention are evicted on
+# append, and when the buffer is full the oldest value is overwritten.
+#
+# With a directory the buffer is a memory mapped file, so the history survives an AppDaemon restart.
+#
+# AppDaemon imports the module once, so get_series returns the same series to every app that asks for the same
+# name. Range queries and aggregates bisect the timestamp column and run over memoryview slices, no recorder
+# round trips.
+#
+# Usage:
+#   series = get_series("sensor.p1_meter_energy_import", capacity=16384, retention=7 * 24 * 3600)
+#   series.append(datetime.now(), 1234.5)
+#   series.aggregate(start, end, "mean")
+#
+
+def seconds(timestamp):
+  # Epoch seconds of a datetime, floats are passed through
+  if isinstance(timestamp, datetime):
+    return timestamp.timestamp()
+  return float(timestamp)
+
+
+class LogicalColumn:
+  # Sequence view of one ring buffer column in time order, so bisect can search it
+
+  def __init__(self, series, column):
+    self.series = series
+    self.column = column
+
+
+  def __len__(self):
+    return self.series.length
+
+
+  def __getitem__(self, index):
+    return self.column[(self.series.start + index) % self.series.capacity]
+
+
+class TimeSeries:
+  header_size = 4         # magic, capacity, start, length
+  magic = 20240101.0      # Marks a file written by this class, anything else is reset
+
+  def __init__(self, name, capacity=16384, retention=7 * 24 * 3600, path=None):
+    self.name = name
+    self.capacity = capacity
+    self.retention = retention
+    self.path = path
+    self.lock = threading.Lock()
+
+    size = (self.header_size + 2 * capacity) * 8
+    self.mmap = None
+    if path is None:
+      self.buffer = bytearray(size)
+    else:
+      with open(path, "a+b") as series_file:
+        if os.path.getsize(path) != size:
+          # New file or a different capacity, start empty
+          series_file.truncate(0)
+          series_file.truncate(size)
+        self.mmap = mmap.mmap(series_file.fileno(), size)
+      self.buffer = self.mmap
+
+    view = memoryview(self.buffer).cast("d")
+    self.header = view[:self.header_size]
+    self.timestamps = view[self.header_size:self.header_size + capacity]
+    self.values = view[self.header_size + capacity:]
+    if self.header[0] != self.magic or self.header[1] != capacity:
+      self.header[0] = self.magic
+      self.header[1] = capacity
+      self.header[2] = 0
+      self.header[3] = 0
+    # Ring position of the oldest value and number of values, mirrored in the header for the persisted file
+    self.start = int(self.header[2])
+    self.length = int(self.header[3])
+    self.time_column = LogicalColumn(self, self.timestamps)
+
+
+  def set_position(self, start, length):
+    self.start = start
+    self.length = length
+    self.header[2] = start
+    self.header[3] = length
+
+
+  def __len__(self):
+    return self.length
+
+
+  def append(self, timestamp, value):
+    timestamp = seconds(timestamp)
+    with self.lock:
+      start = self.start
+      count = self.length
+      if count > 0:
+        last = (start + count - 1) % self.capacity
+        if timestamp < self.timestamps[last]:
+          # Out of order values would break the sorted time column
+          return False
+        if timestamp == self.timestamps[last]:
+          self.values[last] = value
+          return True
+
+      if count == self.capacity:
+        # Full, overwrite the oldest value
+        start = (start + 1) % self.capacity
+        count -= 1
+      index = (start + count) % self.capacity
+      self.timestamps[index] = timestamp
+      self.values[index] = value
+      self.set_position(start, count + 1)
+      self.evict(timestamp - self.retention)
+    return True
+
+
+  def evict(self, cutoff):
+    # Drops the values older than cutoff, the lock is held by the caller
+    # Appends evict one value at a time, so a scan from the oldest value is cheaper than a search
+    drop = 0
+    while drop < self.length and self.timestamps[(self.start + drop) % self.capacity] < cutoff:
+      drop += 1
+    if drop > 0:
+      self.set_position((self.start + drop) % self.capacity, self.length - drop)
+
+
+  def segments(self, start, end):
+    # Physical (from, to) slices of the values in [start, end), at most two because of the wrap around
+    first = 0 if start is None else bisect.bisect_left(self.time_column, seconds(start))
+    last = self.length if end is None else bisect.bisect_left(self.time_column, seconds(end))
+    if first >= last:
+      return []
+    physical_first = (self.start + first) % self.capacity
+    physical_last = physical_first + (last - first)
+    if physical_last <= self.capacity:
+      return [(physical_first, physical_last)]
+    return [(physical_first, self.capacity), (0, physical_last - self.capacity)]
+
+
+  def range(self, start=None, end=None):
+    # Returns (timestamps, values) of [start, end) as two lists of floats
+    with self.lock:
+      timestamps = []
+      values = []
+      for first, last in self.segments(start, end):
+        timestamps.extend(self.timestamps[first:last])
+        values.extend(self.values[first:last])
+    return timestamps, values
+
+
+  def latest(self):
+    # Returns (timestamp, value) of the newest value, or None
+    with self.lock:
+      count = self.length
+      if count == 0:
+        return None
+      last = (self.start + count - 1) % self.capacity
+      return self.timestamps[last], self.values[last]
+
+
+  def first_timestamp(self):
+    with self.lock:
+      if self.length == 0:
+        return None
+      return self.timestamps[self.start]
+
+
+  def value_at(self, timestamp):
+    # Value of the step function at timestamp, i.e. the last value at or before it
+    with self.lock:
+      index = bisect.bisect_right(self.time_column, seconds(timestamp)) - 1
+      if index < 0:
+        return None
+      return self.values[(self.start + index) % self.capacity]
+
+
+  def aggregate(self, start, end, function):
+    # count, sum, mean, min or max of the values in [start, end), None when there are none
+    with self.lock:
+      slices = [self.values[first:last] for first, last in self.segments(start, end)]
+      count = sum(len(values) for values in slices)
+      if count == 0:
+        return 0 if function == "count" else None
+      if function == "count":
+        return count
+      if function == "sum":
+        return sum(sum(values) for values in slices)
+      if function == "mean":
+        return sum(sum(values) for values in slices) / count
+      if function == "min":
+        return min(min(values) for values in slices)
+      if function == "max":
+        return max(max(values) for values in slices)
+    raise ValueError(f"Unknown aggregate {function}")
+
+
+  def flush(self):
+    if self.mmap is not None:
+      self.mmap.flush()
+
+
+# Series shared by all apps in this AppDaemon process
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_series(name, capacity=16384, retention=7 * 24 * 3600, directory=None):
+  # Returns the series with this name, created by the first caller. With a directory it is persisted there
+  with stores_lock:
+    if name not in stores:
+      path = None
+      if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name + ".series")
+      stores[name] = TimeSeries(name, capacity=capacity, retention=retention, path=path)
+    return stores[name]
+
+
+def find_series(name):
+  # Returns the series with this name if an app created it, for readers that should not create one themselves
+  with stores_lock:
+    return stores.get(name)
@@ -0,0 +1,134 @@
+import bisect
+from datetime import datetime
+
+
+#
+# Weather forecast
+#
+# Hourly outdoor temperature forecast of a weather entity, read once every time the entity updates instead of every
+# tick. Older Home Assistant versions have the forecast as attribute of the entity, newer ones only return it from the
+# weather.get_forecasts service, which is called when the attribute is missing. A slow refresh_minutes timer catches
+# forecast updates that do not change the state of the entity.
+#
+# temperatures() interpolates the forecast linearly onto the middle of every price slot, so the plans see the
+# temperature of the slot they heat in. The result is cached until the forecast or the slots change. The hours a new
+# forecast does not cover any more keep the values of the earlier one, so a forecast that only moved on by an hour
+# gives the same slot temperatures and the plans built on them stay valid.
+#
+# Usage:
+#   forecast = WeatherForecast(app, "weather.forecast_home", refresh_minutes=60)
+#   outdoor_temperatures = forecast.temperatures(start, slot_minutes, len(prices), default=0.0)
+#
+
+class WeatherForecast:
+  history_seconds = 2 * 24 * 3600   # Seconds of past forecast points kept, today's price slots start at midnight
+
+  def __init__(self, app, entity_id, refresh_minutes=60):
+    self.app = app
+    self.entity_id = entity_id
+    self.times = []               # Epoch seconds of the forecast points, sorted
+    self.values = []              # Temperature of every forecast point
+    self.version = 0              # Increments with every new forecast
+    self.cache_key = None
+    self.cache = None
+
+    app.listen_state(self.weather_changed, entity_id, attribute="all")
+    if refresh_minutes:
+      app.run_every(self.refresh, "now", refresh_minutes * 60)
+    else:
+      self.refresh({})
+
+
+  def weather_changed(self, entity, attribute, old, new, kwargs):
+    self.update(new)
+
+
+  def refresh(self, kwargs):
+    self.update(self.app.get_state(self.entity_id, attribute="all"))
+
+
+  def update(self, weather):
+    if weather is None:
+      return
+    forecast = (weather.get("attributes") or {}).get("forecast")
+    if forecast is None:
+      forecast = self.service_forecast()
+    if not forecast:
+      return
+
+    points = []
+    for item in forecast:
+      try:
+        points.append((self.seconds(item["datetime"]), float(item["temperature"])))
+      except (KeyError, TypeError, ValueError):
+        continue
+    if not points:
+      return
+    points.sort()
+    times = [point[0] for point in points]
+    values = [point[1] for point in points]
+    keep = bisect.bisect_left(self.times, times[0])
+    first = bisect.bisect_left(self.times, times[0] - self.history_seconds)
+    times = self.times[first:keep] + times
+    values = self.values[first:keep] + values
+    if times == self.times and values == self.values:
+      return
+    self.times = times
+    self.values = values
+    self.version += 1
+
+
+  def service_forecast(self):
+    # weather.get_forecasts returns {entity_id: {"forecast": [...]}}, possibly wrapped in the AppDaemon result
+    try:
+      result = self.app.call_service("weather/get_forecasts", entity_id=self.entity_id, type="hourly", return_result=True)
+    except Exception as error:
+      self.app.log(f"Could not get the forecast of {self.entity_id}: {error}", level="WARNING")
+      return None
+    return self.find_forecast(result)
+
+
+  def find_forecast(self, result):
+    if isinstance(result, dict):
+      if isinstance(result.get("forecast"), list):
+        return result["forecast"]
+      for value in result.values():
+        forecast = self.find_forecast(value)
+        if forecast is not None:
+          return forecast
+    return None
+
+
+  def seconds(self, timestamp):
+    if not isinstance(timestamp, datetime):
+      timestamp = datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
+    if timestamp.tzinfo is None:
+      timestamp = timestamp.astimezone()
+    return timestamp.timestamp()
+
+
+  def temperatures(self, start, slot_minutes, count, default=None):
+    # Forecast temperature in the middle of each of count slots from start, the nearest forecast point outside the
+    # forecast, default everywhere when there is no forecast
+    if not self.times:
+      return [default] * count
+    key = (self.version, self.seconds(start), slot_minutes, count)
+    if key == self.cache_key:
+      return self.cache
+
+    temperatures = []
+    first = key[1] + slot_minutes * 30
+    for slot in range(count):
+      at = first + slot * slot_minutes * 60
+      index = bisect.bisect_right(self.times, at)
+      if index == 0:
+        temperatures.append(self.values[0])
+      elif index == len(self.times):
+        temperatures.append(self.values[-1])
+      else:
+        before, after = self.times[index - 1], self.times[index]
+        fraction = (at - before) / (after - before)
+        temperatures.append(round(self.values[index - 1] + fraction * (self.values[index] - self.values[index - 1]), 2))
+    self.cache_key = key
+    self.cache = temperatures
+    return temperatures
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The apps and the tools, the tools install FakeHass in place of appdaemon
+directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(directory, "..", "apps"))
+sys.path.insert(0, os.path.join(directory, "..", "tools"))
@@ -0,0 +1,49 @@
+import json
+import os
+
+import Benchmark
+
+
+#
+# Regression gate of the hot paths, the pytest form of Benchmark.py --baseline
+#
+# The stored baseline was saved with the default settings of Benchmark.py. API calls per call are exact and memory
+# has the default tolerance. Wall times are compared relative to the calibration workload, i.e. scaled to the speed
+# of the machine. The tiny per minute cases still vary by up to 1.8x between runs on a busy machine, so a case fails
+# at twice its scaled baseline time. A machine that keeps its own baseline (Benchmark.py --save-baseline,
+# BENCHMARK_BASELINE=path) can set BENCHMARK_TIME_TOLERANCE=0.3 for the strict gate.
+#
+
+baseline_path = os.environ.get("BENCHMARK_BASELINE",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"))
+
+
+def test_hot_paths_do_not_regress():
+  results = Benchmark.Benchmark().run()
+  with open(baseline_path) as baseline_file:
+    baseline = json.load(baseline_file)
+  time_tolerance = float(os.environ.get("BENCHMARK_TIME_TOLERANCE", 1.0))
+  assert Benchmark.compare(results, baseline, time_tolerance, memory_tolerance=0.2) == []
+
+
+def test_schedule_plan_plans_the_full_horizon():
+  # Every case starts at 14:00 of the first of the two price days, whatever the cases before it did to the clock
+  benchmark = Benchmark.Benchmark(iterations=10, repeats=1)
+  benchmark.run(["tariff_cached", "schedule_plan"])
+  assert len(benchmark.energy_app.calculate_slot_prices()) - benchmark.energy_app.slot_index(benchmark.home.now) == 136
+
+
+def test_latency_is_added_to_the_wall_time():
+  benchmark = Benchmark.Benchmark(latency={"get_state": 0.001}, iterations=10, repeats=1)
+  result = benchmark.run(["tariff_rebuild"])["cases"]["tariff_rebuild"]
+  # One get_state of the nordpool sensor per rebuild
+  assert result["api_calls_per_call"] == {"get_state": 1.0}
+  assert result["ms_per_call"] >= 1.0
+
+
+def test_baseline_times_scale_with_the_machine_speed():
+  baseline = {"settings": {}, "calibration_ms": 1.0, "cases": {"case": {"ms_per_call": 1.0, "api_calls_per_call": {}, "peak_kib": 1.0}}}
+  results = {"settings": {}, "calibration_ms": 2.0, "cases": {"case": {"ms_per_call": 2.5, "api_calls_per_call": {}, "peak_kib": 1.0}}}
+  assert Benchmark.compare(results, baseline, time_tolerance=0.3, memory_tolerance=0.2) == []
+  results["cases"]["case"]["ms_per_call"] = 2.7
+  assert len(Benchmark.compare(results, baseline, time_tolerance=0.3, memory_tolerance=0.2)) == 1
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+
+from HeatPumpStateMachine import HeatPumpStateMachine
+
+
+#
+# Switching rules of the heat pump, see HeatPumpStateMachine.py
+#
+
+now = datetime(2024, 1, 1, 12, 0)
+machine = HeatPumpStateMachine(on_band=0.5, off_band=0.5, min_run_time=1800, min_off_time=1200, override_temperature_diff=2)
+
+
+def state(mode, since=None, **kwargs):
+  return machine.initial_state(mode, since=since, day=now.date(), **kwargs)
+
+
+def test_starts_at_the_on_band_edge_only():
+  assert machine.step(state("off"), 20.6, 21.0, now)[1] is None
+  new_state, transition = machine.step(state("off"), 20.5, 21.0, now)
+  assert transition == "start"
+  assert new_state["mode"] == "heating"
+  assert new_state["since"] == now
+
+
+def test_stops_at_the_off_band_edge_only():
+  assert machine.step(state("heating"), 21.4, 21.0, now)[1] is None
+  new_state, transition = machine.step(state("heating"), 21.5, 21.0, now)
+  assert transition == "stop"
+  assert new_state["mode"] == "off"
+
+
+def test_keeps_the_mode_inside_the_band():
+  for mode in ["heating", "off"]:
+    new_state, transition = machine.step(state(mode), 21.0, 21.0, now)
+    assert transition is None
+    assert new_state["mode"] == mode
+
+
+def test_min_run_time_blocks_a_stop():
+  since = now - timedelta(seconds=600)
+  new_state, transition = machine.step(state("heating", since), 23.0, 21.0, now)
+  assert transition is None
+  assert new_state["mode"] == "heating"
+  assert new_state["blocked_until"] == since + timedelta(seconds=1800)
+
+  new_state, transition = machine.step(new_state, 23.0, 21.0, since + timedelta(seconds=1800))
+  assert transition == "stop"
+  assert new_state["blocked_until"] is None
+
+
+def test_min_off_time_blocks_a_start():
+  since = now - timedelta(seconds=600)
+  new_state, transition = machine.step(state("off", since), 20.0, 21.0, now)
+  assert transition is None
+  assert new_state["blocked_until"] == since + timedelta(seconds=1200)
+  assert machine.step(new_state, 20.0, 21.0, since + timedelta(seconds=1200))[1] == "start"
+
+
+def test_block_is_cleared_when_the_room_returns_into_the_band():
+  blocked, _ = machine.step(state("off", now - timedelta(seconds=600)), 20.0, 21.0, now)
+  new_state, transition = machine.step(blocked, 21.0, 21.0, now + timedelta(seconds=60))
+  assert transition is None
+  assert new_state["blocked_until"] is None
+
+
+def test_override_skips_the_min_off_time():
+  new_state, transition = machine.step(state("off", now - timedelta(seconds=60)), 19.0, 21.0, now)
+  assert transition == "start"
+
+
+def test_override_never_skips_the_min_run_time():
+  # However far the room is above the target, a run is not cut short
+  new_state, transition = machine.step(state("heating", now - timedelta(seconds=60)), 25.0, 21.0, now)
+  assert transition is None
+  assert new_state["blocked_until"] is not None
+
+
+def test_unknown_since_allows_the_first_switch_right_away():
+  assert machine.step(state("off"), 20.0, 21.0, now)[1] == "start"
+  assert machine.step(state("heating"), 22.0, 21.0, now)[1] == "stop"
+
+
+def test_transitions_and_starts_are_counted_per_day():
+  new_state, _ = machine.step(state("off", transitions=3, starts=2), 20.0, 21.0, now)
+  assert (new_state["transitions"], new_state["starts"]) == (4, 3)
+  new_state, _ = machine.step(new_state, 22.0, 21.0, now + timedelta(seconds=1800))
+  assert (new_state["transitions"], new_state["starts"]) == (5, 3)
+
+
+def test_new_day_resets_the_counters():
+  tomorrow = now + timedelta(days=1)
+  new_state, transition = machine.step(state("heating", now, transitions=7, starts=4), 21.0, 21.0, tomorrow)
+  assert transition is None
+  assert new_state["day"] == tomorrow.date()
+  assert (new_state["transitions"], new_state["starts"]) == (0, 0)
+  assert new_state["since"] == now
+
+
+def test_step_does_not_modify_the_state():
+  old_state = state("off")
+  copy = dict(old_state)
+  machine.step(old_state, 20.0, 21.0, now)
+  assert old_state == copy
+
+
+def test_force_ignores_the_timers_and_counts_the_switch():
+  new_state, transition = machine.force(state("heating", now - timedelta(seconds=60)), "off", now)
+  assert transition == "stop"
+  assert new_state["mode"] == "off"
+  assert new_state["transitions"] == 1
+  assert machine.force(new_state, "off", now)[1] is None
+
+
+def test_replay_collects_the_switches():
+  # A room that swings 0.3 degrees around the target never leaves the band once heating
+  samples = [(now + timedelta(minutes=minute), 20.4 if minute == 0 else 21.0 + (0.3 if minute % 20 < 10 else -0.3), 21.0)
+             for minute in range(180)]
+  final_state, transitions = machine.replay(samples)
+  assert transitions == [(now, "start")]
+  assert final_state["mode"] == "heating"
+
+  # Cold and warm spells of an hour each switch at most once per min run and min off time
+  samples = [(now + timedelta(minutes=minute), 19.0 if (minute // 60) % 2 == 0 else 23.0, 21.0) for minute in range(600)]
+  final_state, transitions = machine.replay(samples)
+  assert [transition for _, transition in transitions] == ["start", "stop"] * 5
+  times = [time for time, _ in transitions]
+  assert all(later - earlier >= timedelta(seconds=1200) for earlier, later in zip(times, times[1:]))
@@ -0,0 +1,21 @@
+from HeatingScheduleOptimizer import HeatingScheduleOptimizer
+
+
+#
+# Planning edge cases of the heating schedule, see HeatingScheduleOptimizer.py
+#
+
+optimizer = HeatingScheduleOptimizer(heat_loss_rate=0.05, heating_rate=1.0, power_kw=1.0, comfort_cost=5)
+
+
+def test_zero_heating_rate_above_the_max_temperature_never_heats():
+  # The fitted heating rate is clamped to 0 at cold outdoor temperatures, the room starts above the max temperature
+  targets, heating = optimizer.plan([10, 20, 30], 23.0, [20, 20, 20], 19, 21, 22, heating_rates=[0, 0, 0])
+  assert heating == [0, 0, 0]
+  assert targets == sorted(targets, reverse=True)
+
+
+def test_zero_heating_rate_slots_are_skipped():
+  targets, heating = optimizer.plan([10, 20, 30], 18.0, [0, 0, 0], 19, 21, 22, heating_rates=[1, 0, 1])
+  assert heating[1] == 0
+  assert heating[0] == 1
@@ -0,0 +1,60 @@
+import time
+from datetime import datetime
+
+import ParameterSweep
+import Simulator
+
+
+#
+# Offline runs of both apps against FakeHass, no Home Assistant or network needed
+#
+# Run from the repository root with: python -m pytest appDaemon/tests
+#
+
+start = datetime(2024, 1, 1)
+
+
+def test_simulation_reports_cost_comfort_and_state_changes():
+  report = Simulator.Simulation(start=start, days=2).run()
+  assert report["running_energy_cost_euro"] > 0
+  assert report["ac_energy_cost_euro"] > 0
+  assert report["comfort_violation_minutes"] >= 0
+  assert report["compressor_starts"] > 0
+  assert report["state_changes"] >= report["compressor_starts"]
+
+
+def test_async_apps_make_the_same_decisions():
+  report = Simulator.Simulation(start=start, days=2).run()
+  async_report = Simulator.Simulation(start=start, days=2, async_apps=True).run()
+  for key in ["running_energy_cost_euro", "ac_energy_cost_euro", "degree_hours_below_target", "compressor_starts", "state_changes"]:
+    assert async_report[key] == report[key]
+
+
+def test_async_apps_time_the_decisions_in_the_worker_thread():
+  simulation = Simulator.Simulation(start=start, days=1, async_apps=True)
+  simulation.run()
+  ac_durations = simulation.ac_app.instrumentation.tick_durations
+  energy_durations = simulation.energy_app.instrumentation.tick_durations
+  assert ac_durations["control_climate_prefetched"].count == ac_durations["control_climate"].count > 0
+  assert energy_durations["main_update_routine_prefetched"].count == energy_durations["main_update_routine"].count > 0
+
+
+def test_call_latency_is_counted_not_waited_for():
+  started = time.perf_counter()
+  simulation = Simulator.Simulation(start=start, days=1, call_latency={"get_state": 1.0})
+  simulation.run()
+  assert time.perf_counter() - started < 60
+  assert simulation.home.latency_seconds["get_state"] == simulation.home.call_counts["get_state"] * 1.0
+
+
+def test_sweep_returns_a_pareto_front():
+  prices = Simulator.synthetic_prices(start, 2)
+  outdoor_temperatures = Simulator.synthetic_outdoor_temperatures(start, 2)
+  scenarios = list(ParameterSweep.grid_scenarios({"min_state_change_time": [600, 1800], "max_mean_price_multiplier": [1.2, 2.0]}))
+  results = ParameterSweep.sweep(scenarios, start, 2, prices, outdoor_temperatures, processes=2)
+
+  assert [result["parameters"] for result in results] == scenarios
+  front = ParameterSweep.pareto_front(results)
+  assert front
+  costs = [result["ac_energy_cost_euro"] for result in front]
+  assert costs == sorted(costs)
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+
+import FakeHass
+
+FakeHass.install()
+
+import ThermalModelLearner
+
+
+#
+# Fitting the thermal model from the recorder history of several zones, see ThermalModelLearner.py
+#
+
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+zones = [{"name": "living_room", "climate_entity": "climate.living_room", "room_temperature_entity": "sensor.living_room_temperature"},
+         {"name": "bedroom", "climate_entity": "climate.bedroom", "room_temperature_entity": "sensor.bedroom_temperature"}]
+heat_loss_rate = 0.05
+heating_rate = 1.0
+
+
+def recorded_home(days):
+  # Every zone follows the thermal model with its own AC cycle, sampled every 15 minutes like the recorder would
+  entity_ids = [ThermalModelLearner.ThermalModelLearner.entity_id_weather_forecast]
+  for zone in zones:
+    entity_ids += [zone["room_temperature_entity"], "sensor.ac_on_off_history_" + zone["name"]]
+  home = FakeHass.FakeHome(start, record_history=entity_ids)
+  FakeHass.use_virtual_clock(ThermalModelLearner, home)
+
+  room_temperatures = [20.0, 18.0]
+  for minute in range(days * 24 * 60):
+    home.now = start + timedelta(minutes=minute)
+    outdoor = -5 + 5 * (minute // 60 % 24) / 24
+    if minute % 15 == 0:
+      home.set_state(ThermalModelLearner.ThermalModelLearner.entity_id_weather_forecast, "cloudy", {"temperature": outdoor})
+    for index, zone in enumerate(zones):
+      heating = minute // (90 + 40 * index) % 2
+      if minute % 15 == 0:
+        home.set_state("sensor.ac_on_off_history_" + zone["name"], heating)
+        home.set_state(zone["room_temperature_entity"], round(room_temperatures[index], 2))
+      room_temperatures[index] += (heat_loss_rate * (outdoor - room_temperatures[index]) + heating * heating_rate) / 60
+  home.now = start + timedelta(days=days, hours=1)
+  return home
+
+
+def test_every_zone_adds_its_own_history():
+  home = recorded_home(3)
+  learner = home.create_app(ThermalModelLearner.ThermalModelLearner, "thermal_model_learner_app", {"history_days": 3, "zones": zones})
+  home.run_until(home.now + timedelta(minutes=1))
+
+  # 96 samples per day and zone
+  assert learner.samples == 3 * 96 * len(zones)
+  assert learner.fitted_until == start + timedelta(days=3)
+  assert abs(learner.coefficients[0] - heat_loss_rate) < 0.01
+  assert abs(learner.coefficients[1] - heating_rate) < 0.1
+
+
+def test_nightly_run_does_not_start_a_second_catch_up():
+  home = recorded_home(3)
+  learner = home.create_app(ThermalModelLearner.ThermalModelLearner, "thermal_model_learner_app", {"history_days": 3, "zones": zones})
+  home.run_until(home.now + timedelta(seconds=10))
+  assert learner.fitted_until == start + timedelta(days=1)
+  assert learner.chunk_timer is not None
+
+  learner.process_new_day({})
+  assert learner.fitted_until == start + timedelta(days=1)
+  home.run_until(home.now + timedelta(minutes=1))
+  assert learner.samples == 3 * 96 * len(zones)
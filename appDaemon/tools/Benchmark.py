@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import Simulator
+from HeatingScheduleOptimizer import HeatingScheduleOptimizer
+from StateSnapshot import StateSnapshot
+
+
+#
+# Benchmark of the control and tariff hot paths
+#
+# Builds both apps against FakeHass with realistic price vectors (today and tomorrow, 15 minute slots by default)
+# and many AC zones, then measures every hot path on its own:
+#
+#   tariff_rebuild               calculate_slot_prices with new nordpool prices, i.e. a full tariff vector rebuild
+#   tariff_cached                update_energy_price from the cached tariff vector, what runs every minute
+#   calculate_energy_cost        one minute of the running cost
+#   calculate_target_temperature the target of every zone from a fresh snapshot
+#   control_climate              one forced tick over all zones, including control_AC and the sensor writes
+#   schedule_plan                HeatingScheduleOptimizer over the remaining price slots, 136 slots at 14:00
+#
+# The two per minute cases advance the virtual clock by a minute and deliver a new P1 meter reading before every call,
+# so each call measures a real tick, the same as calculate_energy_cost does at 1 second past every minute. Every case
+# starts from a fresh simulation at 14:00, so no case runs on the clock another case moved on.
+#
+# Per case the wall time per call (best of the repeats), the API calls per call, the peak memory allocated during one
+# call and the memory still held after all calls (tracemalloc, measured in a separate run so it does not slow the
+# timing) are reported. FakeHass can add a latency to every API call, to see how the paths behave with a slow
+# Home Assistant connection. The latency is not waited for, FakeHass adds it up and it is added to the wall time.
+#
+# With --baseline the results are compared with an earlier run saved by --save-baseline, and the run fails (exit
+# code 1) when a case got slower than the time tolerance, uses more memory than the memory tolerance or makes more
+# API calls. Every run also times a fixed pure Python workload, and the baseline times are scaled with the speed ratio
+# of the two machines, so the comparison gates the cost of the paths relative to the speed of the machine.
+#
+# appDaemon/tests/test_Benchmark.py runs the same comparison under pytest against a stored baseline.
+#
+# Examples:
+#   python Benchmark.py --save-baseline benchmark_baseline.json
+#   python Benchmark.py --baseline benchmark_baseline.json --zones 16 --latency get_state=0.0005
+#
+
+class Benchmark:
+
+  def __init__(self, zones=8, price_minutes=15, latency=None, iterations=200, repeats=5):
+    self.zones = zones
+    self.price_minutes = price_minutes
+    self.latency = latency or {}
+    self.iterations = iterations
+    self.repeats = repeats
+    self.setup()
+
+
+  def setup(self):
+    # A fresh simulation at 14:00 for every case. The per minute cases move the clock on, on a shared clock the later
+    # cases would start near the end of the prices and schedule_plan would plan a single slot
+    # Afternoon, so tomorrow's prices are known and the vectors have their full length
+    zones = self.zones
+    start = datetime(2024, 1, 1)
+    zone_args = [{"name": f"zone_{i}", "climate_entity": f"climate.zone_{i}", "room_temperature_entity": f"sensor.zone_{i}_temperature"}
+                 for i in range(1, zones)]
+    zone_args.insert(0, {"name": "living_room", "climate_entity": Simulator.ACController.ACController.entity_id_climate_control,
+                         "room_temperature_entity": Simulator.ACController.ACController.entity_id_room_temperature})
+    self.simulation = Simulator.Simulation(start=start, days=2, prices=Simulator.synthetic_prices(start, 2, step_minutes=self.price_minutes),
+                                           ac_args={"zones": zone_args, "log_level": "errors", "instrumentation_interval": 0},
+                                           energy_args={"log_level": "errors", "instrumentation_interval": 0},
+                                           call_latency=self.latency)
+    self.home = self.simulation.home
+    for i in range(1, zones):
+      # The other zones are not simulated, a fixed room temperature is enough to exercise the control path
+      self.home.set_state(f"climate.zone_{i}", "fan_only", {"power": True, "temperature": 20.0, "fan_mode": "Silent", "swing_mode": "Horizontal"})
+      self.home.set_state(f"sensor.zone_{i}_temperature", 20.0 + i % 4)
+    self.home.run_until(start + timedelta(hours=14))
+
+    self.ac_app = self.simulation.ac_app
+    self.energy_app = self.simulation.energy_app
+
+
+  def cases(self):
+    # name -> function running the hot path once
+    return {
+        "tariff_rebuild": self.tariff_rebuild,
+        "tariff_cached": self.next_minute(self.energy_app.update_energy_price),
+        "calculate_energy_cost": self.next_minute(self.energy_app.calculate_energy_cost),
+        "calculate_target_temperature": self.calculate_target_temperatures,
+        "control_climate": lambda: self.ac_app.control_climate({"force": True}),
+        "schedule_plan": self.schedule_plan,
+    }
+
+
+  def next_minute(self, function):
+    # The clock moves on by a minute and the meter listener gets a new reading, like between two real ticks
+    # Past the end of the prices the tariff vector serves its last slot, the path stays the same
+    house = self.simulation.house
+
+    def tick():
+      self.home.now += timedelta(minutes=1)
+      house.energy_import += house.base_load_kw / 60
+      self.home.set_state(house.meter_id, round(house.energy_import, 3))
+      function()
+    return tick
+
+
+  def tariff_rebuild(self):
+    self.energy_app.tariff_cache_dirty = True
+    self.energy_app.tariff_cache_key = None
+    self.energy_app.calculate_slot_prices()
+
+
+  def calculate_target_temperatures(self):
+    self.ac_app.snapshot = StateSnapshot(self.ac_app)
+    for zone in self.ac_app.zones:
+      self.ac_app.calculate_target_temperature(zone)
+
+
+  def schedule_plan(self):
+    prices = self.energy_app.calculate_slot_prices()
+    remaining_prices = prices[self.energy_app.slot_index(self.home.now):]
+    slot_hours = self.price_minutes / 60
+    optimizer = HeatingScheduleOptimizer(self.ac_app.heat_loss_rate, self.ac_app.heating_rate, self.ac_app.ac_power_kw, self.ac_app.comfort_cost)
+    optimizer.plan(remaining_prices, 21.0, [0.0] * len(remaining_prices), self.ac_app.target_room_min_temperature,
+                   self.ac_app.target_room_temperature, self.ac_app.target_room_max_temperature, slot_hours=slot_hours)
+
+
+  def measure(self, function, iterations):
+    # Warm up, the first call of a path fills caches and sends the one-off AC commands
+    function()
+
+    calls_before = dict(self.home.call_counts)
+    best = None
+    for repeat in range(self.repeats):
+      latency_before = sum(self.home.latency_seconds.values())
+      started = time.perf_counter()
+      for iteration in range(iterations):
+        function()
+      elapsed = (time.perf_counter() - started + sum(self.home.latency_seconds.values()) - latency_before) / iterations
+      best = elapsed if best is None else min(best, elapsed)
+    calls = self.repeats * iterations
+    api_calls = {method: round((count - calls_before.get(method, 0)) / calls, 2)
+                 for method, count in self.home.call_counts.items() if count != calls_before.get(method, 0)}
+
+    tracemalloc.start()
+    try:
+      before = tracemalloc.get_traced_memory()[0]
+      tracemalloc.reset_peak()
+      function()
+      peak = tracemalloc.get_traced_memory()[1] - before
+      for iteration in range(iterations):
+        function()
+      retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+      tracemalloc.stop()
+
+    return {
+        "ms_per_call": round(best * 1000, 4),
+        "api_calls_per_call": api_calls,
+        "peak_kib": round(peak / 1024, 1),
+        "retained_kib": round(retained / 1024, 1)
+    }
+
+
+  def calibrate(self):
+    # Wall time of a fixed pure Python workload, the speed of this machine. compare() scales the baseline times with
+    # it, so a baseline saved on another machine still gates the relative cost of the paths
+    values = [(i * 7919) % 1000 / 10 for i in range(5000)]
+    best = None
+    for repeat in range(self.repeats):
+      started = time.perf_counter()
+      lookup = {}
+      for value in sorted(values):
+        lookup[value] = lookup.get(value, 0.0) + value * 1.5
+      elapsed = time.perf_counter() - started
+      best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 4)
+
+
+  def run(self, only=None):
+    results = {}
+    for name in self.cases():
+      if only and name not in only:
+        continue
+      self.setup()
+      function = self.cases()[name]
+      # The optimizer is orders of magnitude slower than the other paths, fewer calls are enough
+      iterations = max(1, self.iterations // 200) if name == "schedule_plan" else self.iterations
+      results[name] = self.measure(function, iterations)
+    return {
+        "settings": {"zones": self.zones, "price_minutes": self.price_minutes, "latency": self.latency},
+        "calibration_ms": self.calibrate(),
+        "cases": results
+    }
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+  # Returns the regressions as readable lines, empty when there are none
+  regressions = []
+  if results["settings"] != baseline.get("settings"):
+    regressions.append(f"Settings {results['settings']} differ from the baseline settings {baseline.get('settings')}")
+    return regressions
+
+  # Baseline times scaled to the speed of this machine
+  speed = 1.0
+  if results.get("calibration_ms") and baseline.get("calibration_ms"):
+    speed = results["calibration_ms"] / baseline["calibration_ms"]
+
+  for name, result in results["cases"].items():
+    expected = baseline["cases"].get(name)
+    if expected is None:
+      continue
+    expected_ms = round(expected["ms_per_call"] * speed, 4)
+    if result["ms_per_call"] > expected_ms * (1 + time_tolerance):
+      regressions.append(f"{name}: {result['ms_per_call']} ms per call, baseline {expected_ms} ms on this machine")
+    # 1 KiB slack, small allocations move around between Python versions
+    if result["peak_kib"] > expected["peak_kib"] * (1 + memory_tolerance) + 1:
+      regressions.append(f"{name}: {result['peak_kib']} KiB peak memory per call, baseline {expected['peak_kib']} KiB")
+    for method, count in result["api_calls_per_call"].items():
+      if count > expected["api_calls_per_call"].get(method, 0):
+        regressions.append(f"{name}: {count} {method} calls per call, baseline {expected['api_calls_per_call'].get(method, 0)}")
+  return regressions
+
+
+def parse_latency(assignments):
+  # method=seconds pairs, e.g. get_state=0.001
+  latency = {}
+  for assignment in assignments or []:
+    method, seconds = assignment.split("=", 1)
+    latency[method] = float(seconds)
+  return latency
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the control and tariff hot paths against FakeHass")
+  parser.add_argument("--zones", type=int, default=8, help="Number of AC zones")
+  parser.add_argument("--price-minutes", type=int, default=15, help="Slot width of the prices")
+  parser.add_argument("--latency", action="append", help="Simulated latency of an API call in seconds, e.g. get_state=0.001")
+  parser.add_argument("--iterations", type=int, default=200, help="Calls per repeat")
+  parser.add_argument("--repeats", type=int, default=5, help="Repeats, the fastest one counts")
+  parser.add_argument("--case", action="append", help="Only run this case, can be given more than once")
+  parser.add_argument("--baseline", help="JSON of an earlier run to compare with, regressions fail the run")
+  parser.add_argument("--save-baseline", help="Write the results to this JSON file")
+  parser.add_argument("--time-tolerance", type=float, default=0.3, help="Allowed slowdown against the baseline, 0.3 is 30%%")
+  parser.add_argument("--memory-tolerance", type=float, default=0.2, help="Allowed peak memory growth against the baseline")
+  options = parser.parse_args()
+
+  benchmark = Benchmark(zones=options.zones, price_minutes=options.price_minutes, latency=parse_latency(options.latency),
+                        iterations=options.iterations, repeats=options.repeats)
+  results = benchmark.run(options.case)
+  print(json.dumps(results, indent=2))
+
+  if options.save_baseline:
+    with open(options.save_baseline, "w") as baseline_file:
+      json.dump(results, baseline_file, indent=2)
+
+  if options.baseline:
+    if not os.path.exists(options.baseline):
+      print(f"No baseline {options.baseline}, save one with --save-baseline", file=sys.stderr)
+      sys.exit(1)
+    with open(options.baseline) as baseline_file:
+      regressions = compare(results, json.load(baseline_file), options.time_tolerance, options.memory_tolerance)
+    for regression in regressions:
+      print("REGRESSION " + regression, file=sys.stderr)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,310 @@
+import asyncio
+import bisect
+import functools
+import heapq
+import sys
+import types
+from datetime import datetime, timedelta
+
+
+#
+# Fake Home Assistant
+#
+# In-memory stand-in for appdaemon's hass.Hass, so the apps can run without AppDaemon, Home Assistant or a network.
+# Time is virtual: the scheduler jumps straight to the next timer, and every app module gets a datetime class whose
+# now() returns the virtual time, so a simulated day takes milliseconds instead of a day.
+# Coroutine callbacks, e.g. of ACControllerAsync, run on an event loop of their own, and the API calls they make
+# return futures like in AppDaemon.
+#
+# Usage:
+#   home = FakeHome(start_time)
+#   FakeHass.install()                      # Before importing the app modules
+#   import ACController
+#   FakeHass.use_virtual_clock(ACController, home)
+#   app = home.create_app(ACController.ACController, "ac_control_app", args={})
+#   home.run_until(start_time + timedelta(days=1))
+#
+
+class FakeHome:
+
+  def __init__(self, start_time, record_history=None, call_latency=None):
+    self.now = start_time
+    self.states = {}              # entity_id -> {"state": ..., "attributes": {...}}
+    self.state_listeners = {}     # entity_id -> list of (handle, app, callback, attribute, kwargs)
+    self.event_listeners = {}     # event -> list of (handle, app, callback, filters)
+    self.timers = []              # heap of (time, handle)
+    self.timer_entries = {}       # handle -> (callback, kwargs, interval)
+    self.sequence = 0
+    self.apps = []
+    self.service_handlers = {}    # "domain/service" -> function(home, service_data), for simulated devices
+
+    # Recorder, only for the entities listed in record_history
+    self.record_history = set(record_history or [])
+    self.history = {}             # entity_id -> list of (time, state, attributes)
+
+    # Statistics per API method, and an optional simulated latency per call in seconds (see Benchmark.py)
+    # The latency is only added up in latency_seconds, waiting for it would make the virtual clock as slow as a real one
+    self.call_counts = {}
+    self.call_latency = call_latency or {}
+    self.latency_seconds = {}
+
+
+  def create_app(self, app_class, name, args=None):
+    app = app_class(self, name, args or {})
+    self.apps.append(app)
+    app.initialize()
+    return app
+
+
+  # State machine
+
+  def set_state(self, entity_id, state, attributes=None):
+    old = self.states.get(entity_id)
+    new = {"state": state, "attributes": dict(attributes) if attributes else {}, "last_changed": self.now}
+    self.states[entity_id] = new
+    if entity_id in self.record_history:
+      self.history.setdefault(entity_id, []).append((self.now, state, new["attributes"]))
+
+    # Most entities have no listener, e.g. the sensors the apps publish
+    listeners = self.state_listeners.get(entity_id)
+    if not listeners:
+      return
+    for handle, app, callback, attribute, kwargs in list(listeners):
+      if attribute == "all":
+        old_value, new_value = self.full_state(old), self.full_state(new)
+      elif attribute is None or attribute == "state":
+        old_value, new_value = (old["state"] if old else None), state
+      else:
+        old_value = old["attributes"].get(attribute) if old else None
+        new_value = new["attributes"].get(attribute)
+      if old_value != new_value:
+        self.run_callback(callback, entity_id, attribute, old_value, new_value, kwargs)
+
+
+  def read_state(self, entity_id, attribute=None):
+    if entity_id is not None and "." not in entity_id:
+      # A domain returns the full states of all its entities, like get_state("climate") does
+      return {other_id: self.read_state(other_id, "all") for other_id in self.states if other_id.startswith(entity_id + ".")}
+    full_state = self.states.get(entity_id)
+    if full_state is None:
+      return None
+    if attribute == "all":
+      return self.full_state(full_state)
+    if attribute is None or attribute == "state":
+      return full_state["state"]
+    return full_state["attributes"].get(attribute)
+
+
+  def full_state(self, full_state):
+    # Copy in the format of get_state(attribute="all")
+    if full_state is None:
+      return None
+    return {"state": full_state["state"], "attributes": dict(full_state["attributes"]), "last_changed": full_state["last_changed"].isoformat()}
+
+
+  def read_history(self, entity_id, start_time, end_time):
+    # The history is in time order, the range is found by bisection so reading it in chunks stays linear
+    history = self.history.get(entity_id, [])
+    first = bisect.bisect_left(history, (start_time,))
+    last = bisect.bisect_left(history, (end_time + timedelta(microseconds=1),))
+    entries = [{"entity_id": entity_id, "state": state, "attributes": attributes, "last_changed": time.isoformat()}
+               for time, state, attributes in history[first:last]]
+    return [entries] if entries else []
+
+
+  # Services and events
+
+  def call_service(self, service, service_data):
+    domain, service_name = service.split("/")
+    self.fire_event("call_service", {"domain": domain, "service": service_name, "service_data": service_data})
+    handler = self.service_handlers.get(service)
+    if handler is not None:
+      # Services with a response, like weather/get_forecasts, return it from the handler
+      return handler(self, service_data)
+    return None
+
+
+  def fire_event(self, event, data):
+    for handle, app, callback, filters in list(self.event_listeners.get(event, [])):
+      if all(data.get(key) == value for key, value in filters.items()):
+        self.run_callback(callback, event, data, {})
+
+
+  # Scheduler
+
+  def add_timer(self, time, callback, kwargs, interval=None):
+    self.sequence += 1
+    handle = self.sequence
+    self.timer_entries[handle] = (callback, kwargs, interval)
+    heapq.heappush(self.timers, (time, handle))
+    return handle
+
+
+  def cancel_timer(self, handle):
+    self.timer_entries.pop(handle, None)
+
+
+  def run_until(self, end_time):
+    while self.timers and self.timers[0][0] <= end_time:
+      time, handle = heapq.heappop(self.timers)
+      entry = self.timer_entries.get(handle)
+      if entry is None:
+        continue
+      callback, kwargs, interval = entry
+      self.now = time
+      if interval is None:
+        del self.timer_entries[handle]
+      else:
+        heapq.heappush(self.timers, (time + interval, handle))
+      self.run_callback(callback, dict(kwargs))
+    self.now = end_time
+
+
+  def run_callback(self, callback, *args):
+    # Coroutine callbacks of async apps run to the end on their own event loop, like AppDaemon runs them on its loop
+    result = callback(*args)
+    if result is not None and asyncio.iscoroutine(result):
+      asyncio.run(result)
+
+
+  def count(self, method):
+    self.call_counts[method] = self.call_counts.get(method, 0) + 1
+    if self.call_latency:
+      latency = self.call_latency.get(method)
+      if latency:
+        self.latency_seconds[method] = self.latency_seconds.get(method, 0.0) + latency
+
+
+def api(method):
+  # Like AppDaemon, an API call made from a coroutine on the event loop returns a future instead of the result
+  @functools.wraps(method)
+  def api_method(self, *args, **kwargs):
+    result = method(self, *args, **kwargs)
+    try:
+      loop = asyncio.get_running_loop()
+    except RuntimeError:
+      return result
+    future = loop.create_future()
+    future.set_result(result)
+    return future
+  return api_method
+
+
+class Hass:
+  # Subset of appdaemon.plugins.hass.hassapi.Hass used by the apps
+
+  def __init__(self, home, name, args):
+    self.home = home
+    self.name = name
+    self.args = args
+    self.log_lines = None         # Set to a list to keep the log output
+
+
+  def log(self, msg, *args, **kwargs):
+    if self.log_lines is not None:
+      self.log_lines.append(msg % args if args else msg)
+
+
+  @api
+  def get_state(self, entity_id=None, attribute=None, **kwargs):
+    self.home.count("get_state")
+    return self.home.read_state(entity_id, attribute)
+
+
+  @api
+  def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+    self.home.count("set_state")
+    self.home.set_state(entity_id, state, attributes)
+
+
+  @api
+  def get_history(self, entity_id=None, start_time=None, end_time=None, **kwargs):
+    self.home.count("get_history")
+    return self.home.read_history(entity_id, start_time, end_time or self.home.now)
+
+
+  @api
+  def call_service(self, service, **kwargs):
+    self.home.count("call_service")
+    return self.home.call_service(service, kwargs)
+
+
+  @api
+  def listen_state(self, callback, entity_id=None, attribute=None, **kwargs):
+    self.home.sequence += 1
+    self.home.state_listeners.setdefault(entity_id, []).append((self.home.sequence, self, callback, attribute, kwargs))
+    return self.home.sequence
+
+
+  @api
+  def listen_event(self, callback, event=None, **kwargs):
+    self.home.sequence += 1
+    self.home.event_listeners.setdefault(event, []).append((self.home.sequence, self, callback, kwargs))
+    return self.home.sequence
+
+
+  @api
+  def run_in(self, callback, delay, **kwargs):
+    return self.home.add_timer(self.home.now + timedelta(seconds=delay), callback, kwargs)
+
+
+  @api
+  def run_every(self, callback, start, interval, **kwargs):
+    if start == "now":
+      start = self.home.now
+    return self.home.add_timer(start, callback, kwargs, timedelta(seconds=interval))
+
+
+  @api
+  def run_minutely(self, callback, start=None, **kwargs):
+    if start is None:
+      start = self.home.now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    return self.home.add_timer(start, callback, kwargs, timedelta(minutes=1))
+
+
+  @api
+  def run_daily(self, callback, start, **kwargs):
+    if isinstance(start, str):
+      hour, minute, second = [int(part) for part in start.split(":")]
+      start = self.home.now.replace(hour=hour, minute=minute, second=second, microsecond=0)
+    if start <= self.home.now:
+      start += timedelta(days=1)
+    return self.home.add_timer(start, callback, kwargs, timedelta(days=1))
+
+
+  @api
+  def cancel_timer(self, handle):
+    self.home.cancel_timer(handle)
+
+
+  def datetime(self):
+    return self.home.now
+
+
+  def get_now(self):
+    return self.home.now
+
+
+def install():
+  # Registers this module as appdaemon.plugins.hass.hassapi, must run before the app modules are imported
+  if "appdaemon.plugins.hass.hassapi" in sys.modules:
+    return
+  module_names = ["appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass", "appdaemon.plugins.hass.hassapi"]
+  for module_name in module_names:
+    sys.modules.setdefault(module_name, types.ModuleType(module_name))
+  sys.modules["appdaemon.plugins.hass.hassapi"].Hass = Hass
+  sys.modules["appdaemon"].plugins = sys.modules["appdaemon.plugins"]
+  sys.modules["appdaemon.plugins"].hass = sys.modules["appdaemon.plugins.hass"]
+  sys.modules["appdaemon.plugins.hass"].hassapi = sys.modules["appdaemon.plugins.hass.hassapi"]
+
+
+def use_virtual_clock(module, home):
+  # Replaces the datetime class used by an app module with one whose now() returns the virtual time of the home
+  class VirtualDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+      if tz is not None:
+        return home.now.astimezone(tz)
+      return home.now
+
+  module.datetime = VirtualDatetime
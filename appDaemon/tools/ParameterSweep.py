@@ -0,0 +1,193 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import urllib.request
+from array import array
+from datetime import datetime
+from multiprocessing import Pool, shared_memory
+
+import Simulator
+
+
+#
+# Parameter sweep for the ACController price/comfort thresholds
+#
+# Runs one Simulator scenario per parameter combination on a process pool and reports the Pareto front of AC energy
+# cost against comfort (degree hours below the target temperature). The price and outdoor temperature series are
+# put in shared memory once and every worker reads them from there, instead of pickling them into each task.
+#
+# A point of the front can be written back into the input_number entities through the Home Assistant REST API.
+# The ParameterRegistry of ACController picks up the input_number.set_value calls.
+#
+# Examples:
+#   python ParameterSweep.py --days 14 --grid min_state_change_time=600,1200,1800 --grid max_mean_price_multiplier=1.2,1.5,2.0
+#   python ParameterSweep.py --days 14 --samples 200 --output front.json
+#   python ParameterSweep.py --front front.json --apply 3 --url http://homeassistant.local:8123   (token in HA_TOKEN)
+#
+# sweep() runs a list of scenarios without the command line, e.g. from the tests in appDaemon/tests.
+#
+
+# Search range (low, high, step) of every ACController tunable, within the range of its input_number
+parameter_ranges = {
+    "target_room_min_temperature": (16, 21, 0.5),
+    "target_room_temperature": (20, 24, 0.5),
+    "target_room_max_temperature": (22, 26, 0.5),
+    "min_mean_price_multiplier": (0.1, 1.0, 0.1),
+    "max_mean_price_multiplier": (1.0, 2.0, 0.1),
+    "min_absolute_price": (0.0, 15.0, 0.5),
+    "max_absolute_price": (10.0, 60.0, 0.5),
+    "min_state_change_time": (0, 3600, 60),
+    "ignore_change_time_temp_diff": (0, 10, 0.5),
+}
+
+# Filled in every worker process by attach_series
+worker_series = {}
+
+
+def share_series(series):
+  # Copies the values of a Series into a new shared memory block
+  values = array("d", series.values)
+  block = shared_memory.SharedMemory(create=True, size=max(1, len(values) * values.itemsize))
+  block.buf[:len(values) * values.itemsize] = values.tobytes()
+  return block, {"name": block.name, "length": len(values), "start": series.start.isoformat(), "step_minutes": series.step_minutes}
+
+
+def attach_series(descriptions):
+  # Pool initializer, maps the shared blocks as Series without copying them
+  for key, description in descriptions.items():
+    # The workers share the resource tracker of the main process, which unlinks the blocks after the sweep
+    block = shared_memory.SharedMemory(name=description["name"])
+    values = block.buf.cast("d")[:description["length"]]
+    worker_series[key] = (block, Simulator.Series(datetime.fromisoformat(description["start"]), description["step_minutes"], values))
+
+
+def run_scenario(task):
+  parameters, start, days, ac_args = task
+  simulation = Simulator.Simulation(start=start, days=days, prices=worker_series["prices"][1],
+                                    outdoor_temperatures=worker_series["outdoor_temperatures"][1],
+                                    parameters=parameters, ac_args=ac_args)
+  report = simulation.run()
+  return {"parameters": parameters,
+          "ac_energy_cost_euro": report["ac_energy_cost_euro"],
+          "degree_hours_below_target": report["degree_hours_below_target"],
+          "comfort_violation_minutes": report["comfort_violation_minutes"],
+          "compressor_starts": report["compressor_starts"]}
+
+
+def grid_scenarios(grid):
+  names = list(grid.keys())
+  for values in itertools.product(*[grid[name] for name in names]):
+    yield dict(zip(names, values))
+
+
+def random_scenarios(samples, seed):
+  generator = random.Random(seed)
+  for _ in range(samples):
+    parameters = {}
+    for name, (low, high, step) in parameter_ranges.items():
+      parameters[name] = round(low + step * generator.randint(0, int(round((high - low) / step))), 2)
+    # Keep the comfort band ordered
+    band = sorted([parameters["target_room_min_temperature"], parameters["target_room_temperature"], parameters["target_room_max_temperature"]])
+    parameters["target_room_min_temperature"], parameters["target_room_temperature"], parameters["target_room_max_temperature"] = band
+    yield parameters
+
+
+def sweep(scenarios, start, days, prices, outdoor_temperatures, ac_args=None, processes=None):
+  # Runs every scenario on a process pool, returns one result per scenario in the same order
+  processes = processes or os.cpu_count()
+  blocks = []
+  descriptions = {}
+  for key, series in [("prices", prices), ("outdoor_temperatures", outdoor_temperatures)]:
+    block, descriptions[key] = share_series(series)
+    blocks.append(block)
+
+  try:
+    with Pool(processes, initializer=attach_series, initargs=(descriptions,)) as pool:
+      tasks = [(parameters, start, days, ac_args or {}) for parameters in scenarios]
+      return pool.map(run_scenario, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+  finally:
+    for block in blocks:
+      block.close()
+      block.unlink()
+
+
+def pareto_front(results):
+  # Results that no other result beats on both cost and comfort, cheapest first
+  front = []
+  for result in sorted(results, key=lambda item: (item["ac_energy_cost_euro"], item["degree_hours_below_target"])):
+    if not front or result["degree_hours_below_target"] < front[-1]["degree_hours_below_target"]:
+      front.append(result)
+  return front
+
+
+def apply_parameters(parameters, url, token):
+  # Writes one point of the front into the input_number entities
+  for name, value in parameters.items():
+    entity_id = getattr(Simulator.ACController.ACController, name + "_id")
+    request = urllib.request.Request(url.rstrip("/") + "/api/services/input_number/set_value", method="POST",
+                                     data=json.dumps({"entity_id": entity_id, "value": value}).encode(),
+                                     headers={"Authorization": "Bearer " + token, "Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+      response.read()
+    print(f"Set {entity_id} to {value}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Sweep the ACController thresholds over simulated days")
+  parser.add_argument("--days", type=int, default=14)
+  parser.add_argument("--start", default="2024-01-01")
+  parser.add_argument("--prices", help="CSV with time,spot price c/kWh, generated when omitted")
+  parser.add_argument("--price-minutes", type=int, default=60, help="Slot width of the generated prices, e.g. 15")
+  parser.add_argument("--temperatures", help="CSV with time,outdoor temperature, generated when omitted")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--grid", action="append", help="name=value1,value2,... for a grid sweep")
+  parser.add_argument("--samples", type=int, help="Number of random parameter combinations instead of a grid")
+  parser.add_argument("--ac-arg", action="append", help="ACController apps.yaml arg used in every scenario")
+  parser.add_argument("--processes", type=int, default=os.cpu_count())
+  parser.add_argument("--output", help="Write the Pareto front to this JSON file")
+  parser.add_argument("--front", help="Pareto front JSON file to apply a point from, skips the sweep")
+  parser.add_argument("--apply", type=int, help="Index of the point of the front to write into the input_number entities")
+  parser.add_argument("--url", default="http://homeassistant.local:8123", help="Home Assistant URL for --apply")
+  options = parser.parse_args()
+
+  if options.front is not None:
+    with open(options.front) as front_file:
+      front = json.load(front_file)
+  else:
+    start = datetime.fromisoformat(options.start)
+    prices = Simulator.load_series(options.prices) if options.prices else Simulator.synthetic_prices(start, options.days, options.seed, options.price_minutes)
+    outdoor_temperatures = (Simulator.load_series(options.temperatures) if options.temperatures
+                            else Simulator.synthetic_outdoor_temperatures(start, options.days, options.seed))
+
+    if options.samples:
+      scenarios = list(random_scenarios(options.samples, options.seed))
+    else:
+      grid = {}
+      for assignment in options.grid or []:
+        name, values = assignment.split("=", 1)
+        if name not in parameter_ranges:
+          parser.error(f"Unknown parameter {name}, expected one of {', '.join(parameter_ranges)}")
+        grid[name] = [json.loads(value) for value in values.split(",")]
+      scenarios = list(grid_scenarios(grid))
+
+    results = sweep(scenarios, start, options.days, prices, outdoor_temperatures,
+                    ac_args=Simulator.parse_assignments(options.ac_arg), processes=options.processes)
+    front = pareto_front(results)
+    print(f"{len(results)} scenarios, {len(front)} on the Pareto front")
+
+  for index, result in enumerate(front):
+    print(f"{index:3d}: cost {result['ac_energy_cost_euro']:8.2f} euro, {result['degree_hours_below_target']:8.1f} degree hours "
+          f"below target, {result['compressor_starts']:5d} starts  {result['parameters']}")
+
+  if options.output:
+    with open(options.output, "w") as output_file:
+      json.dump(front, output_file, indent=2)
+
+  if options.apply is not None:
+    apply_parameters(front[options.apply]["parameters"], options.url, os.environ["HA_TOKEN"])
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,360 @@
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import FakeHass
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps"))
+FakeHass.install()
+
+import ACController
+import ACControllerAsync
+import ActuationQueue
+import CostAttribution
+import EnergyCalculations
+import EnergyCalculationsAsync
+import Instrumentation
+import LoadCoordinator
+import StatePublisher
+import TimeSeriesStore
+
+
+#
+# Offline replay / simulation of ACController and EnergyCalculations
+#
+# Runs both apps against FakeHass with a virtual clock and a simulated house: a room heated by the AC with the same
+# first order thermal model as HeatingScheduleOptimizer.py, a P1 meter and a nordpool sensor. Prices and outdoor
+# temperatures are replayed from CSV files (time,value with a fixed step) or generated. No Home Assistant, AppDaemon
+# or network is needed.
+#
+# Throughput is about 250 simulated days per minute when polling and 500 in reactive mode, on one core of a small
+# machine. Three quarters of that time is the apps' own per minute work (decisions, publishing, instrumentation, the
+# time series), which runs unchanged on purpose; FakeHass and the house are the other quarter. So one process stays in
+# the hundreds of days per minute, and thousands come from ParameterSweep.py running the scenarios on all cores.
+#
+# Example:
+#   python Simulator.py --days 30 --param min_state_change_time=1200 --ac-arg control_mode=reactive
+#   python Simulator.py --days 7 --energy-arg 'cost_devices=[{"name": "ac", "entity_id": "sensor.simulated_ac_power"}]'
+#   python Simulator.py --days 30 --async-apps      # ACControllerAsync and EnergyCalculationsAsync, same results expected
+#
+
+class Series:
+  # Values with a fixed step, value_at returns the value of the step the time falls in (the last value after the end)
+
+  def __init__(self, start, step_minutes, values):
+    self.start = start
+    self.step_minutes = step_minutes
+    self.values = values
+
+
+  def value_at(self, at_time):
+    index = int((at_time - self.start).total_seconds() // (self.step_minutes * 60))
+    return self.values[max(0, min(len(self.values) - 1, index))]
+
+
+  def day_values(self, day_start):
+    # All values of one day, used for the nordpool today/tomorrow attributes
+    steps = 24 * 60 // self.step_minutes
+    return [self.value_at(day_start + timedelta(minutes=i * self.step_minutes)) for i in range(steps)]
+
+
+  def raw_day_values(self, day_start):
+    # Same with start and end times, like the raw_today/raw_tomorrow attributes of the nordpool integration
+    step = timedelta(minutes=self.step_minutes)
+    return [{"start": (day_start + i * step).astimezone().isoformat(), "end": (day_start + (i + 1) * step).astimezone().isoformat(),
+             "value": value} for i, value in enumerate(self.day_values(day_start))]
+
+
+def load_series(path):
+  # CSV with a time column in ISO format and a value column, rows at a fixed step
+  with open(path, newline="") as csv_file:
+    rows = [row for row in csv.reader(csv_file) if row and not row[0].startswith("#")]
+  if rows and not rows[0][1].replace(".", "", 1).replace("-", "", 1).isdigit():
+    rows = rows[1:]
+  times = [datetime.fromisoformat(row[0]) for row in rows]
+  step_minutes = int((times[1] - times[0]).total_seconds() // 60)
+  return Series(times[0], step_minutes, [float(row[1]) for row in rows])
+
+
+def synthetic_prices(start, days, seed=0, step_minutes=60):
+  # Spot prices in c/kWh with morning and evening peaks, day to day variation and the odd negative price
+  generator = random.Random(seed)
+  values = []
+  for day in range(days + 2):
+    level = generator.uniform(2, 15)
+    for step in range(24 * 60 // step_minutes):
+      hour = step * step_minutes / 60
+      peak = 1.0 + 0.6 * math.exp(-((hour - 8) ** 2) / 4) + 0.8 * math.exp(-((hour - 18) ** 2) / 6)
+      values.append(round(level * peak + generator.gauss(0, 1.5), 2))
+  return Series(start.replace(hour=0, minute=0, second=0, microsecond=0), step_minutes, values)
+
+
+def synthetic_outdoor_temperatures(start, days, seed=0):
+  # Hourly outdoor temperatures with a daily cycle and slowly drifting weather
+  generator = random.Random(seed + 1)
+  values = []
+  level = 0.0
+  for hour in range(24 * (days + 2)):
+    level += generator.gauss(0, 0.3) - level * 0.01
+    values.append(round(level - 3 - 4 * math.cos((hour % 24 - 3) / 24 * 2 * math.pi), 1))
+  return Series(start.replace(hour=0, minute=0, second=0, microsecond=0), 60, values)
+
+
+class SimulatedHouse:
+  # Room, AC unit with a power sensor, P1 meter and nordpool sensor, updated every simulated minute
+
+  heat_loss_rate = 0.02       # Fraction of the inside/outside temperature difference lost per hour
+  heating_rate = 1.0          # Degrees per hour the AC adds when heating, at 0 C outdoor
+  cop_intercept = 3.0         # COP of the AC at 0 C outdoor
+  cop_slope = 0.0             # COP change per degree outdoor, with 0 the heating rate does not depend on the weather
+  ac_power_kw = 1.0           # Electrical power of the AC when heating
+  fan_power_kw = 0.02         # Electrical power of the AC in fan only mode
+  base_load_kw = 0.4          # Everything else in the house
+
+  ac_power_id = "sensor.simulated_ac_power"   # Sub-meter of the AC in W, for cost_devices of EnergyCalculations
+
+  def __init__(self, home, prices, outdoor_temperatures, room_temperature=21.0):
+    self.home = home
+    self.prices = prices
+    self.outdoor_temperatures = outdoor_temperatures
+    self.room_temperature = room_temperature
+    self.energy_import = 10000.0
+
+    self.climate_id = ACController.ACController.entity_id_climate_control
+    self.room_id = ACController.ACController.entity_id_room_temperature
+    self.meter_id = EnergyCalculations.EnergyCalculations.entity_id_energy_import
+    self.power_id = LoadCoordinator.LoadCoordinator.entity_id_power
+    self.nordpool_id = EnergyCalculations.EnergyCalculations.entity_id_nordpool_sensor
+    self.weather_id = ACController.ACController.entity_id_weather_forecast
+
+    # Statistics
+    self.minutes = 0
+    self.ac_energy = 0.0
+    self.ac_energy_cost_cents = 0.0
+    self.comfort_violation_minutes = 0
+    self.degree_hours_below_target = 0.0
+    self.compressor_starts = 0
+    self.state_changes = 0
+
+    home.set_state(self.climate_id, "fan_only", {"power": True, "temperature": 20.0, "fan_mode": "Silent", "swing_mode": "Horizontal"})
+    home.set_state(self.room_id, round(self.room_temperature, 1))
+    home.set_state(self.meter_id, round(self.energy_import, 3))
+    home.set_state(self.power_id, round(self.base_load_kw * 1000))
+    home.set_state(self.ac_power_id, round(self.fan_power_kw * 1000))
+    self.update_nordpool()
+    self.update_weather()
+
+    for service in ["set_hvac_mode", "set_temperature", "set_fan_mode", "set_swing_mode"]:
+      home.service_handlers["climate/" + service] = self.climate_service
+    home.service_handlers["climate/turn_on"] = lambda home, service_data: self.climate_service(home, {"power": True})
+    home.service_handlers["climate/turn_off"] = lambda home, service_data: self.climate_service(home, {"power": False})
+    home.service_handlers["weather/get_forecasts"] = self.forecast_service
+
+    start = home.now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    home.add_timer(start, self.step, {}, timedelta(minutes=1))
+
+
+  def climate_service(self, home, service_data):
+    climate = home.states[self.climate_id]
+    state = climate["state"]
+    attributes = dict(climate["attributes"])
+    if "hvac_mode" in service_data:
+      state = service_data["hvac_mode"]
+      attributes["power"] = state != "off"
+    for attribute in ["power", "temperature", "fan_mode", "swing_mode"]:
+      if attribute in service_data:
+        attributes[attribute] = service_data[attribute]
+
+    if state != climate["state"]:
+      self.state_changes += 1
+      if state == "heat":
+        self.compressor_starts += 1
+    home.set_state(self.climate_id, state, attributes)
+
+
+  def heating(self):
+    climate = self.home.states[self.climate_id]
+    attributes = climate["attributes"]
+    return climate["state"] == "heat" and attributes.get("power") and self.room_temperature < float(attributes.get("temperature", 0))
+
+
+  def update_nordpool(self):
+    now = self.home.now
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    tomorrow_valid = now.hour >= 13
+    attributes = {
+        "today": self.prices.day_values(day_start),
+        "tomorrow": self.prices.day_values(day_start + timedelta(days=1)) if tomorrow_valid else [],
+        "raw_today": self.prices.raw_day_values(day_start),
+        "raw_tomorrow": self.prices.raw_day_values(day_start + timedelta(days=1)) if tomorrow_valid else [],
+        "tomorrow_valid": tomorrow_valid
+    }
+    self.home.set_state(self.nordpool_id, self.prices.value_at(now), attributes)
+
+
+  def update_weather(self):
+    # Like a current Home Assistant weather entity, the forecast is only available from weather/get_forecasts
+    self.home.set_state(self.weather_id, "cloudy", {"temperature": self.outdoor_temperatures.value_at(self.home.now),
+                                                    "forecast_updated": self.home.now.isoformat()})
+
+
+  def forecast_service(self, home, service_data):
+    # Hourly forecast for the next 48 hours, the outdoor temperature series itself, i.e. a perfect forecast
+    hour_start = home.now.replace(minute=0, second=0, microsecond=0)
+    forecast = [{"datetime": (hour_start + timedelta(hours=hour)).astimezone().isoformat(),
+                 "temperature": self.outdoor_temperatures.value_at(hour_start + timedelta(hours=hour))} for hour in range(48)]
+    return {"response": {service_data["entity_id"]: {"forecast": forecast}}}
+
+
+  def step(self, kwargs):
+    now = self.home.now
+    outdoor = self.outdoor_temperatures.value_at(now)
+    heating = self.heating()
+
+    heating_rate = self.heating_rate * max(1.0, self.cop_intercept + self.cop_slope * outdoor) / max(1.0, self.cop_intercept)
+    self.room_temperature += (self.heat_loss_rate * (outdoor - self.room_temperature) + (heating_rate if heating else 0)) / 60
+    ac_kwh = (self.ac_power_kw if heating else self.fan_power_kw) / 60
+    self.energy_import += ac_kwh + self.base_load_kw / 60
+    self.ac_energy += ac_kwh
+
+    price = self.home.read_state(ACController.ACController.absolute_electricity_price_c_kWh_id)
+    if price is not None:
+      self.ac_energy_cost_cents += ac_kwh * float(price)
+
+    min_temperature = self.home.read_state(ACController.ACController.target_room_min_temperature_id)
+    target_temperature = self.home.read_state(ACController.ACController.target_room_temperature_id)
+    if min_temperature is not None and self.room_temperature < float(min_temperature):
+      self.comfort_violation_minutes += 1
+    if target_temperature is not None:
+      self.degree_hours_below_target += max(0, float(target_temperature) - self.room_temperature) / 60
+    self.minutes += 1
+
+    if now.minute % self.prices.step_minutes == 0:
+      self.update_nordpool()
+    if now.minute == 0:
+      self.update_weather()
+    self.home.set_state(self.room_id, round(self.room_temperature, 1))
+    self.home.set_state(self.meter_id, round(self.energy_import, 3))
+    ac_power_kw = self.ac_power_kw if self.heating() else self.fan_power_kw
+    self.home.set_state(self.power_id, round((self.base_load_kw + ac_power_kw) * 1000))
+    self.home.set_state(self.ac_power_id, round(ac_power_kw * 1000))
+
+
+class Simulation:
+
+  def __init__(self, start=None, days=7, prices=None, outdoor_temperatures=None, parameters=None,
+               ac_args=None, energy_args=None, coordinator_args=None, house_args=None, seed=0, call_latency=None, async_apps=False):
+    if start is None:
+      start = datetime(2024, 1, 1)
+    self.start = start
+    self.days = days
+    self.home = FakeHass.FakeHome(start, call_latency=call_latency)
+    # Every simulation starts with an empty history, also when several run in the same process
+    TimeSeriesStore.stores.clear()
+    for module in [ACController, ActuationQueue, CostAttribution, EnergyCalculations, Instrumentation, LoadCoordinator, StatePublisher]:
+      FakeHass.use_virtual_clock(module, self.home)
+
+    prices = prices or synthetic_prices(start, days, seed)
+    outdoor_temperatures = outdoor_temperatures or synthetic_outdoor_temperatures(start, days, seed)
+    self.house = SimulatedHouse(self.home, prices, outdoor_temperatures)
+    # e.g. {"cop_slope": 0.08} for a heat pump that loses heating power in the cold
+    for name, value in (house_args or {}).items():
+      setattr(self.house, name, value)
+
+    # Parameters are the input_number entities of the apps, e.g. "min_state_change_time": 1200
+    for name, value in (parameters or {}).items():
+      for app_class in [ACController.ACController, EnergyCalculations.EnergyCalculations]:
+        entity_id = getattr(app_class, name + "_id", None)
+        if entity_id is not None:
+          self.home.set_state(entity_id, value)
+
+    # Keep the running cost in memory only, unless a checkpoint file is given
+    energy_args = dict(energy_args or {})
+    energy_args.setdefault("checkpoint_file", None)
+    energy_class = EnergyCalculationsAsync.EnergyCalculationsAsync if async_apps else EnergyCalculations.EnergyCalculations
+    self.energy_app = self.home.create_app(energy_class, "energy_calculations_app", energy_args)
+    self.coordinator_app = None
+    if coordinator_args is not None:
+      self.coordinator_app = self.home.create_app(LoadCoordinator.LoadCoordinator, "load_coordinator_app", coordinator_args)
+    ac_class = ACControllerAsync.ACControllerAsync if async_apps else ACController.ACController
+    self.ac_app = self.home.create_app(ac_class, "ac_control_app", ac_args)
+
+
+  def run(self):
+    wall_start = time.perf_counter()
+    self.home.run_until(self.start + timedelta(days=self.days))
+    wall_seconds = time.perf_counter() - wall_start
+    return self.report(wall_seconds)
+
+
+  def report(self, wall_seconds):
+    house = self.house
+    running_cost = self.home.read_state(EnergyCalculations.EnergyCalculations.entity_id_running_energy_costs)
+    return {
+        "days": self.days,
+        "running_energy_cost_euro": round(float(running_cost or 0), 2),
+        "ac_energy_kwh": round(house.ac_energy, 2),
+        "ac_energy_cost_euro": round(house.ac_energy_cost_cents / 100, 2),
+        "comfort_violation_minutes": house.comfort_violation_minutes,
+        "degree_hours_below_target": round(house.degree_hours_below_target, 1),
+        "compressor_starts": house.compressor_starts,
+        "state_changes": house.state_changes,
+        "load_throttles": self.coordinator_app.throttle_count if self.coordinator_app is not None else None,
+        "device_costs_euro": ({name: round(totals[1], 2) for name, totals in self.energy_app.cost_attribution.totals().items()}
+                              if self.energy_app.cost_attribution is not None else None),
+        "api_calls": dict(self.home.call_counts),
+        "control_climate_ms": self.ac_app.instrumentation.tick_durations["control_climate"].summary(scale=1000),
+        "wall_seconds": round(wall_seconds, 3),
+        "simulated_days_per_minute": round(self.days / wall_seconds * 60) if wall_seconds > 0 else None
+    }
+
+
+def parse_assignments(assignments):
+  # name=value pairs from the command line, values are parsed as JSON when possible
+  values = {}
+  for assignment in assignments or []:
+    name, value = assignment.split("=", 1)
+    try:
+      values[name] = json.loads(value)
+    except ValueError:
+      values[name] = value
+  return values
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay ACController and EnergyCalculations against a simulated house")
+  parser.add_argument("--days", type=int, default=7)
+  parser.add_argument("--start", default="2024-01-01", help="Start date, ISO format")
+  parser.add_argument("--prices", help="CSV with time,spot price c/kWh, generated when omitted")
+  parser.add_argument("--price-minutes", type=int, default=60, help="Slot width of the generated prices, e.g. 15")
+  parser.add_argument("--temperatures", help="CSV with time,outdoor temperature, generated when omitted")
+  parser.add_argument("--seed", type=int, default=0, help="Seed for the generated series")
+  parser.add_argument("--param", action="append", help="input_number parameter, e.g. min_state_change_time=1200")
+  parser.add_argument("--ac-arg", action="append", help="ACController apps.yaml arg, e.g. control_mode=reactive")
+  parser.add_argument("--energy-arg", action="append", help="EnergyCalculations apps.yaml arg")
+  parser.add_argument("--coordinator-arg", action="append", help="LoadCoordinator apps.yaml arg, runs the coordinator when given")
+  parser.add_argument("--house-arg", action="append", help="Simulated house property, e.g. cop_slope=0.08")
+  parser.add_argument("--async-apps", action="store_true", help="Run the asyncio variants of both apps")
+  options = parser.parse_args()
+
+  start = datetime.fromisoformat(options.start)
+  simulation = Simulation(start=start, days=options.days,
+                          prices=load_series(options.prices) if options.prices else synthetic_prices(start, options.days, options.seed, options.price_minutes),
+                          outdoor_temperatures=load_series(options.temperatures) if options.temperatures else None,
+                          parameters=parse_assignments(options.param),
+                          ac_args=parse_assignments(options.ac_arg),
+                          energy_args=parse_assignments(options.energy_arg),
+                          coordinator_args=parse_assignments(options.coordinator_arg) if options.coordinator_arg else None,
+                          house_args=parse_assignments(options.house_arg),
+                          seed=options.seed, async_apps=options.async_apps)
+  print(json.dumps(simulation.run(), indent=2))
+
+
+if __name__ == "__main__":
+  main()